@@ -1,37 +1,111 @@
-from langchain_community.callbacks import get_openai_callback
-from llm import LLM, DEEP_RESEARCH_LLM, GEMINI_PRO
+import sqlite3
+import time
+from typing import Dict
+
+from llm import get_llm, get_deep_research_llm, GEMINI_PRO, GEMINI_FLASH
 from graph_state import RAGState
-from prompts import CQL_GENERATION_PROMPT, AgentCqlPrompt, CONFLUENCE_PAGE_SYSTEM_MESSAGE, SUMMARIZATION_PROMPT
+from prompts import CQL_GENERATION_PROMPT, AgentCqlPrompt, CONFLUENCE_PAGE_SYSTEM_MESSAGE, SUMMARIZATION_PROMPT, \
+    CONFLUENCE_PAGE_TRIAGE_PROMPT, PageRelevanceDecisions
+from cascade import CascadePolicy, split_decisions, cascade_stats
+from blob_store import blob_stores, resolve_pages, store_pages
+from conversation_store import conversation_store
+from retrieval_cache import RetrievalCache, fetch_through
 from agents_helper import get_tools, search_confluence_with_cql_queries, iterator, download_pages, merge_maps, \
-    get_weaviate_client, transform_search_result, convert_llm_response_to_dict, create_page_map
-from langfuse import observe
-from tracking import track_llm_generation
+    get_weaviate_client, transform_search_result, convert_llm_response_to_dict, create_page_map, query_variants
+from tracking import observe, track_llm_generation
+from prompt_encoding import LocalIds, encode_confluence_pages, encode_tool_outputs, decode_filtered_pages, \
+    count_tokens
+from llm_cache import get_cql_cache, make_cache_key, normalize_query
+from hedging import hedged_call
+from resilience import DependencyUnavailableError
+from near_duplicates import filter_candidates, filter_prompt_pages, query_time_threshold
+from cql_planner import plan_cql_queries
+from profiling import record_wait
+from rate_limiter import llm_rate_limit, is_saturated, PRIORITY_ANSWER, PRIORITY_IN_PROGRESS, PRIORITY_NEW_SESSION
 
+# Rough completion size used to reserve tokens-per-minute budget before a call; settled with the real usage after.
+ESTIMATED_OUTPUT_TOKENS = 1000
 
-async def run_langchain_expression(lcl_expression, expression_input):
-    with get_openai_callback() as cb:
-        result = await lcl_expression.ainvoke(input=expression_input)
 
-    return {
-        'result': result,
-        'token_usage': {
-            'total_tokens': cb.total_tokens,
-            'input_tokens': cb.prompt_tokens,
-            'output_tokens': cb.completion_tokens,
-            'total_cost': cb.total_cost
+async def run_langchain_expression(lcl_expression, expression_input, model_name: str = GEMINI_FLASH,
+                                   priority: int = PRIORITY_NEW_SESSION, hedge_key: str | None = None):
+    """
+    Run one LLM call under the model's rate limit. With a `hedge_key` (the prompt name) a slow call may be hedged
+    with a duplicate request; see hedging.py.
+    """
+    estimated_tokens = len(str(expression_input)) // 4 + ESTIMATED_OUTPUT_TOKENS
+
+    async def invoke_once():
+        from langchain_community.callbacks import get_openai_callback
+
+        async with llm_rate_limit(model_name, priority, estimated_tokens) as grant:
+            record_wait(f"rate limit {model_name}", grant['queue_wait_seconds'])
+            with get_openai_callback() as cb:
+                result = await lcl_expression.ainvoke(input=expression_input)
+            grant['actual_tokens'] = cb.total_tokens
+
+        return {
+            'queue_wait_seconds': grant['queue_wait_seconds'],
+            'result': result,
+            'token_usage': {
+                'total_tokens': cb.total_tokens,
+                'input_tokens': cb.prompt_tokens,
+                'output_tokens': cb.completion_tokens,
+                'total_cost': cb.total_cost
+            }
         }
-    }
+
+    if hedge_key is None:
+        return await invoke_once()
+    return await hedged_call(f"{model_name}:{hedge_key}", invoke_once, can_hedge=lambda: not is_saturated(model_name))
+
+
+def get_retrieval_cache(state: RAGState) -> RetrievalCache | None:
+    """Retrieval cache shared by the turns of this conversation (or the queries of this batch), if any."""
+    conversation = conversation_store.get(state.get('conversation_id'))
+    return conversation.retrieval if conversation is not None else None
 
 
 @track_llm_generation(name="agent_1_generate_cql")
 async def agent_1_generate_cql(state: RAGState):
     print("Starting agent_1_generate_cql")
-    cql_generation_chain = CQL_GENERATION_PROMPT | LLM.with_structured_output(AgentCqlPrompt)
-    response = await run_langchain_expression(cql_generation_chain, {
-        'user_query': state.get("user_query")
-    })
+    cql_cache = get_cql_cache()
+    cache_key = make_cache_key(state.get("user_query"), CQL_GENERATION_PROMPT.template, GEMINI_FLASH)
+    cached_cql = None
+    if cql_cache:
+        try:
+            cached_cql = await cql_cache.get(cache_key)
+        except sqlite3.Error as e:
+            # A locked, read-only or full cache file must not fail the request; the LLM answers instead.
+            print(f"CQL cache read failed, generating CQL: {e!r}")
+
+    if cached_cql:
+        # Cache hit: skip the LLM entirely but still report (zero) usage to tracking.
+        print(f"CQL cache hit for user query {state.get('user_query')}.")
+        response = {
+            'result': AgentCqlPrompt.model_validate_json(cached_cql),
+            'token_usage': {
+                'total_tokens': 0,
+                'input_tokens': 0,
+                'output_tokens': 0,
+                'total_cost': 0
+            }
+        }
+    else:
+        cql_generation_chain = CQL_GENERATION_PROMPT | get_llm().with_structured_output(AgentCqlPrompt)
+        response = await run_langchain_expression(cql_generation_chain, {
+            'user_query': state.get("user_query")
+        }, model_name=GEMINI_FLASH, priority=PRIORITY_NEW_SESSION, hedge_key="agent_1_generate_cql")
+        if cql_cache:
+            try:
+                await cql_cache.set(cache_key, response['result'].model_dump_json())
+            except sqlite3.Error as e:
+                print(f"CQL cache write failed, not caching this query: {e!r}")
 
-    confluence_response = await search_confluence_with_cql_queries(response['result'].cql_queries)
+    # Duplicate and overlapping queries are merged before anything is searched, see cql_planner.py.
+    plan = plan_cql_queries(response['result'].cql_queries)
+    print(f"CQL plan {plan.report()}.")
+    confluence_response = await search_confluence_with_cql_queries(plan.queries, get_retrieval_cache(state))
 
     """
     # Iterating response.
@@ -41,6 +115,7 @@ async def agent_1_generate_cql(state: RAGState):
     return {
         'cql_queries': response['result'],
         'confluence_response': {page['page_id']: page for page in confluence_response},
+        'agent_1_cql_plan': plan.report(),
         'agent_1_generate_cql_token_usage': response['token_usage']
     }
 
@@ -48,32 +123,47 @@ async def agent_1_generate_cql(state: RAGState):
 @observe(name="agent_2_search_vector_db")
 async def agent_2_search_vector_db(state: RAGState):
     print("Starting agent_2_search_vector_db")
-    async with get_weaviate_client() as async_knowledgebase:
-        results = await async_knowledgebase.search_knowledgebase(
-            state.get("user_query")
-        ) or []
-    # iterator(results)
-    vector_db_response = [transform_search_result(res) for res in results]
+    retrieval = get_retrieval_cache(state)
+    query_key = normalize_query(state.get("user_query"))
 
-    return {'vector_db_response': vector_db_response}
+    async def search():
+        # Several variants of the question are searched concurrently and their results fused into one list.
+        variants = query_variants(state.get("user_query"))
+        vectors = [
+            retrieval.get('embedding', normalize_query(variant)) if retrieval is not None else None
+            for variant in variants
+        ]
+        async with get_weaviate_client() as async_knowledgebase:
+            results = await async_knowledgebase.search_knowledgebase_multi(variants, vectors=vectors) or []
+        # iterator(results)
+        return [transform_search_result(res) for res in results]
 
+    try:
+        vector_db_response = await fetch_through(retrieval, 'vector', query_key, search)
+    except DependencyUnavailableError as e:
+        # The answer is generated from the Confluence branch alone; nothing is cached for later turns.
+        print(f"Vector search skipped, {e}.")
+        vector_db_response = []
 
-@track_llm_generation(name="agent_3_confluence_filter_pages", model_name=GEMINI_PRO)
-async def agent_3_confluence_filter_pages(state: RAGState):
-    print("Starting agent_3_confluence_filter_pages")
+    return {'vector_db_response': store_pages(blob_stores.get(state.get('session_id')), vector_db_response)}
+
+
+async def filter_pages_with_planner(user_query: str, candidates: Dict, tools, content_map: Dict | None = None,
+                                    retrieval: RetrievalCache | None = None):
     """
-      Filter the pages from Confluence based on their usefulness in answering the user query.
-      Optionally download page content in Markdown format if needed.
+    Run the tool-using planner model over `candidates` until it returns the filtered pages list.
+    Pages it asks for are downloaded into `content_map` along the way, or taken from `retrieval` when an earlier turn
+    or another query of the same batch already downloaded them.
     """
-
-    # Fetch LLM tools from MCP Server
-    tools = await get_tools()
     tools_map = {t.name: t for t in tools}  # Map tool name -> tool object
 
     # Create the LangChain pipeline for filtering pages
-    filter_pages_lcl = CONFLUENCE_PAGE_SYSTEM_MESSAGE | DEEP_RESEARCH_LLM.bind_tools(tools)
+    filter_pages_lcl = CONFLUENCE_PAGE_SYSTEM_MESSAGE | get_deep_research_llm().bind_tools(tools)
+    # Candidates go to the model as a compact table keyed by short local ids (p1, p2, ...)
+    local_ids = LocalIds(candidates.keys())
+    confluence_pages_list = encode_confluence_pages(list(candidates.values()), local_ids)
     # Store downloaded page content
-    content_map = {}
+    content_map = content_map if content_map is not None else {}
     # Track token usage for debugging/monitoring
     token_usage = {}
     no_of_tries = 0
@@ -84,21 +174,23 @@ async def agent_3_confluence_filter_pages(state: RAGState):
 
         # Run the LLM to decide which pages are useful and whether any need downloading
         filtered_response = await run_langchain_expression(filter_pages_lcl, {
-            'user_query': state['user_query'],
-            'confluence_pages_list': list(state['confluence_response'].values()),
+            'user_query': user_query,
+            'confluence_pages_list': confluence_pages_list,
             'tool_outputs': (
                 "Right now there is no output. You have to indentify pages for which tool needs to be called."
-                if len(content_map) == 0 else content_map
+                if len(content_map) == 0 else encode_tool_outputs(content_map, local_ids)
             )
-        })
+        }, model_name=GEMINI_PRO, priority=PRIORITY_IN_PROGRESS, hedge_key="agent_3_filter_pages")
 
         filtered_pages = filtered_response['result']
         # Download any pages the LLM identified as needed
         content_map = await download_pages(
             filtered_pages,
             tools_map,
-            state['confluence_response'],
-            content_map
+            candidates,
+            content_map,
+            local_ids,
+            retrieval
         )
 
         print(f"Filtered pages llm response [Try Count: {no_of_tries}] {content_map.keys()} LLM: {filtered_pages}.")
@@ -110,16 +202,146 @@ async def agent_3_confluence_filter_pages(state: RAGState):
         print(
             f"Filtered pages token usage [Continue calling {continue_calling}] [Try Count: {no_of_tries}] {token_usage}.")
 
-        if not continue_calling:
-            # Parse the final LLM output into a dictionary
-            parsed_llm_response = convert_llm_response_to_dict(filtered_pages.content)
-            await create_page_map(parsed_llm_response, content_map, state['confluence_response'])
+    # Parse the final LLM output into a dictionary
+    parsed_llm_response = decode_filtered_pages(
+        convert_llm_response_to_dict(filtered_pages.content), local_ids, candidates
+    )
+    prompt_encoding = {
+        'before_tokens': count_tokens(str(list(candidates.values())))
+        + count_tokens(str(content_map) if content_map else ""),
+        'after_tokens': count_tokens(confluence_pages_list)
+        + count_tokens(encode_tool_outputs(content_map, local_ids)),
+    }
+    print(f"Filter prompt input tokens before/after compact encoding {prompt_encoding}.")
+
+    return {
+        'filtered_pages': parsed_llm_response,
+        'content_map': content_map,
+        'token_usage': token_usage,
+        'prompt_encoding': prompt_encoding
+    }
 
-            return {
-                'filtered_pages': parsed_llm_response,
-                'agent_3_confluence_filter_pages_token_usage': token_usage,
-                'page_map': content_map
-            }
+
+async def triage_pages_with_worker(user_query: str, candidates: Dict, policy: CascadePolicy):
+    """First cascade tier: the worker model decides what it is confident about, the rest gets escalated."""
+    local_ids = LocalIds(candidates.keys())
+    triage_lcl = CONFLUENCE_PAGE_TRIAGE_PROMPT | get_llm().with_structured_output(PageRelevanceDecisions)
+    confluence_pages_list = encode_confluence_pages(list(candidates.values()), local_ids)
+    prompt_encoding = {
+        'before_tokens': count_tokens(str(list(candidates.values()))),
+        'after_tokens': count_tokens(confluence_pages_list),
+    }
+    try:
+        triage_response = await run_langchain_expression(triage_lcl, {
+            'user_query': user_query,
+            'confluence_pages_list': confluence_pages_list
+        }, model_name=GEMINI_FLASH, priority=PRIORITY_IN_PROGRESS, hedge_key="agent_3_triage_pages")
+    except Exception as e:
+        print(f"Worker triage failed, escalating every candidate: {e}")
+        return [], list(candidates.keys()), {}, prompt_encoding
+
+    relevant, ambiguous = split_decisions(
+        triage_response['result'].decisions, list(candidates.keys()), local_ids, policy
+    )
+    return relevant, ambiguous, triage_response['token_usage'], prompt_encoding
+
+
+def remember_selected_pages(conversation, filtered_pages, candidates: Dict):
+    if conversation is not None and isinstance(filtered_pages, list):
+        conversation.selected_pages = {
+            page['page_id']: candidates.get(page['page_id'], page) for page in filtered_pages
+        }
+
+
+@track_llm_generation(name="agent_3_confluence_filter_pages", model_name=GEMINI_PRO)
+async def agent_3_confluence_filter_pages(state: RAGState):
+    print("Starting agent_3_confluence_filter_pages")
+    """
+      Filter the pages from Confluence based on their usefulness in answering the user query.
+      Optionally download page content in Markdown format if needed.
+      In cascade mode the worker model triages first and only ambiguous pages reach the planner model.
+    """
+
+    # Fetch LLM tools from MCP Server
+    try:
+        tools = await get_tools()
+    except DependencyUnavailableError as e:
+        # Without the MCP server no page can be downloaded; the answer is generated from the vector branch alone.
+        print(f"Confluence page filtering skipped, {e}.")
+        return {'filtered_pages': [], 'page_map': {}}
+    conversation = conversation_store.get(state.get('conversation_id'))
+    candidates = state['confluence_response']
+    if conversation is not None and conversation.selected_pages:
+        # Follow-up turn: the pages the previous turn relied on stay available to build on.
+        candidates = {**candidates, **{
+            page_id: page for page_id, page in conversation.selected_pages.items() if page_id not in candidates
+        }}
+    near_duplicates = None
+    threshold = query_time_threshold()
+    if threshold is not None:
+        # Near-identical candidates would be downloaded and summarized twice; keep the best-ranked of each cluster.
+        candidates, near_duplicates = filter_candidates(candidates, threshold)
+        if near_duplicates['clusters']:
+            print(f"Agent 3 dropped near-duplicate candidates {near_duplicates}.")
+    policy = CascadePolicy.from_env()
+
+    if not policy.enabled:
+        planner_result = await filter_pages_with_planner(
+            state['user_query'], candidates, tools, retrieval=get_retrieval_cache(state)
+        )
+        await create_page_map(planner_result['filtered_pages'], planner_result['content_map'], candidates,
+                              get_retrieval_cache(state))
+        remember_selected_pages(conversation, planner_result['filtered_pages'], candidates)
+        return {
+            'filtered_pages': planner_result['filtered_pages'],
+            'agent_3_confluence_filter_pages_token_usage': planner_result['token_usage'],
+            'agent_3_prompt_encoding': planner_result['prompt_encoding'],
+            'agent_3_near_duplicates': near_duplicates,
+            'page_map': store_pages(blob_stores.get(state.get('session_id')), planner_result['content_map'])
+        }
+
+    started = time.perf_counter()
+    relevant, ambiguous, token_usage, prompt_encoding = await triage_pages_with_worker(
+        state['user_query'], candidates, policy
+    )
+    worker_seconds = time.perf_counter() - started
+
+    filtered_pages = [candidates[page_id] for page_id in relevant]
+    content_map = {}
+    planner_seconds = None
+    if ambiguous:
+        started = time.perf_counter()
+        planner_result = await filter_pages_with_planner(
+            state['user_query'], {page_id: candidates[page_id] for page_id in ambiguous}, tools,
+            retrieval=get_retrieval_cache(state)
+        )
+        planner_seconds = time.perf_counter() - started
+        if isinstance(planner_result['filtered_pages'], list):
+            filtered_pages.extend(planner_result['filtered_pages'])
+        content_map = planner_result['content_map']
+        token_usage = merge_maps(token_usage, planner_result['token_usage'])
+        prompt_encoding = merge_maps(prompt_encoding, planner_result['prompt_encoding'])
+
+    cascade_stats.record(len(candidates), len(ambiguous), worker_seconds, planner_seconds)
+    cascade_report = {
+        'candidates': len(candidates),
+        'accepted_by_worker': len(relevant),
+        'escalated': len(ambiguous),
+        'worker_seconds': worker_seconds,
+        'planner_seconds': planner_seconds,
+    }
+    print(f"Agent 3 cascade {cascade_report}.")
+
+    await create_page_map(filtered_pages, content_map, candidates, get_retrieval_cache(state))
+    remember_selected_pages(conversation, filtered_pages, candidates)
+    return {
+        'filtered_pages': filtered_pages,
+        'agent_3_confluence_filter_pages_token_usage': token_usage,
+        'agent_3_prompt_encoding': prompt_encoding,
+        'agent_3_cascade': cascade_report,
+        'agent_3_near_duplicates': near_duplicates,
+        'page_map': store_pages(blob_stores.get(state.get('session_id')), content_map)
+    }
 
 
 @track_llm_generation(name="agent_4_vector_db_filter_records")
@@ -149,12 +371,23 @@ async def agent_5_summarize_the_answer(state: RAGState):
     Ask LLM to generate final answer to user query based on the information provided.
     """
 
-    summary_lcl = SUMMARIZATION_PROMPT | LLM
+    # The state only references page contents; this is the one node that needs the text.
+    blobs = blob_stores.get(state.get('session_id'))
+    filtered_pages = resolve_pages(blobs, state['page_map'])
+    vector_db_response = resolve_pages(blobs, state['vector_db_response'])
+    threshold = query_time_threshold()
+    if threshold is not None and isinstance(filtered_pages, dict):
+        filtered_pages, vector_db_response, clusters = filter_prompt_pages(
+            filtered_pages, vector_db_response, threshold
+        )
+        if clusters:
+            print(f"Agent 5 dropped near-duplicate pages, clusters {clusters}.")
+    summary_lcl = SUMMARIZATION_PROMPT | get_llm()
     summary_response = await run_langchain_expression(summary_lcl, {
         'user_query': state['user_query'],
-        'filtered_pages': state['page_map'],
-        'vector_db_response': state['vector_db_response']
-    })
+        'filtered_pages': filtered_pages,
+        'vector_db_response': vector_db_response
+    }, model_name=GEMINI_FLASH, priority=PRIORITY_ANSWER, hedge_key="agent_5_summarize_the_answer")
 
     return {
         'answer': summary_response['result'].content,
@@ -4,31 +4,54 @@ import asyncio
 import json
 import uuid
 from collections import Counter
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, nullcontext
 from enum import Enum
-from typing import List, Dict
-from langfuse import observe
-from langchain_mcp_adapters.client import MultiServerMCPClient
+from typing import List, Dict, TYPE_CHECKING
 from pydantic import BaseModel
 
-from kb_weaviate import AsyncWeaviateKnowledgeBase, get_weaviate_async_client, _Source
+from async_utils import BoundedExecutor
+from cql_planner import PlannedQuery, fetch_planned_query
+from resilience import MCP, call_dependency, circuit_open
+from retrieval_cache import RetrievalCache, fetch_through
+from tracking import observe
 import re
 
+if TYPE_CHECKING:
+    from kb_weaviate import _Source
+
 MCP_SERVER_NAME = "Confluence MCP Server"
-client = MultiServerMCPClient(
-    {
-        MCP_SERVER_NAME: {
-            "transport": "sse",
-            "url": "http://127.0.0.1:8000/sse"
-        },
-    }
-)
+# Created by get_mcp_client() on first use; the benchmark swaps in a local client by assigning it directly.
+client = None
+
+
+def get_mcp_client():
+    global client
+    if client is None:
+        from langchain_mcp_adapters.client import MultiServerMCPClient
+        client = MultiServerMCPClient(
+            {
+                MCP_SERVER_NAME: {
+                    "transport": "sse",
+                    "url": "http://127.0.0.1:8000/sse"
+                },
+            }
+        )
+    return client
+
 
 CONFLUENCE_URL = os.getenv("CONFLUENCE_URL")
 
 
 @asynccontextmanager
 async def get_weaviate_client():
+    # VECTOR_BACKEND=local answers from the in-process index built by `python3 -m kb_local build` instead.
+    if os.getenv("VECTOR_BACKEND", "weaviate").lower() == "local":
+        from kb_local import LocalKnowledgeBase, get_local_index
+        yield LocalKnowledgeBase(get_local_index(), alpha=float(os.getenv("LOCAL_VECTOR_HYBRID_ALPHA", "0.75")))
+        return
+
+    from kb_weaviate import AsyncWeaviateKnowledgeBase, get_weaviate_async_client
+
     async_weaviate_client = get_weaviate_async_client(
         http_host=os.getenv("WEAVIATE_HTTP_HOST"),
         http_port=os.getenv("WEAVIATE_HTTP_PORT"),
@@ -50,7 +73,7 @@ async def get_weaviate_client():
             await async_weaviate_client.close()
 
 
-def transform_search_result(response: _Source) -> dict:
+def transform_search_result(response: "_Source") -> dict:
     return {
         'page_id': extract_id(response.source.title),
         'title': response.source.title,
@@ -65,51 +88,125 @@ def extract_id(text: str) -> str | None:
     return None
 
 
+def query_variants(user_query: str) -> List[str]:
+    """
+    Variants agent 2 searches the knowledge base with: the question as asked and its keywords alone. The CQL terms of
+    agent 1 are not among them, as agent 2 runs in parallel with agent 1.
+    """
+    from cql_index import STOP_WORDS
+
+    variants = [user_query]
+    keywords = " ".join(word for word in re.findall(r"[\w'-]+", user_query) if word.lower() not in STOP_WORDS)
+    if keywords and keywords.lower() != user_query.lower().strip():
+        variants.append(keywords)
+    return variants
+
+
+def page_download_executor() -> BoundedExecutor:
+    """
+    Executor for page downloads on the request path, PAGE_DOWNLOAD_CONCURRENCY (default 4) at a time. A page that
+    fails to download is returned as its exception, so the other pages of the request are still used.
+    """
+    return BoundedExecutor(concurrency=int(os.getenv("PAGE_DOWNLOAD_CONCURRENCY", "4")), return_exceptions=True)
+
+
 async def get_tools():
-    tools = await client.get_tools()
+    tools = await call_dependency(MCP, get_mcp_client().get_tools)
     print(f"Tools available in MCP Server are {tools}")
     return tools
 
 
-@observe(name="mcp_server_call_search_confluence_with_cql_queries")
-async def search_confluence_with_cql_queries(cql_queries: List[str]):
-    async with client.session(MCP_SERVER_NAME) as session:
-        all_corr = []
+def parse_cql_search_result(result: Dict) -> List[Dict]:
+    parsed_cql_search_list = []
+    for page in result["results"]:
+        content = page['content']
+        # Planned queries filter by type in the CQL (see cql_planner.py); this only catches unplanned ones.
+        if content.get('type') == 'attachment':
+            continue
+
+        parsed_cql_search_list.append({
+            'page_id': content['id'],
+            'title': content['title'],
+            'matched_content': page['excerpt'],
+            'page_url': f"{CONFLUENCE_URL}/wiki{page['url']}",
+            'lastModified': page['lastModified'],
+            'match_score': page['score']
+        })
+    return parsed_cql_search_list
+
+
+def get_local_cql_index():
+    """Index of the ingested mirror when CQL_BACKEND=local, see cql_index.py."""
+    if os.getenv("CQL_BACKEND", "confluence").lower() != "local":
+        return None
+    from cql_index import get_cql_index
+    return get_cql_index()
+
+
+async def fetch_cql_search_results(session, query: str, local_index=None, start: int = 0,
+                                   limit: int = 10) -> List[Dict]:
+    if local_index is not None and local_index.supports(query):
+        return parse_cql_search_result(local_index.search(query, start, limit))
+
+    response = await call_dependency(MCP, lambda: session.call_tool(
+        name="search_confluence_based_on_cql_query",
+        arguments={
+            "cql": query,
+            "start": start,
+            "limit": limit
+        }
+    ))
+    results = []
+    for query_resp in response.content:
+        results.extend(parse_cql_search_result(json.loads(query_resp.text)))
+    return results
 
-        for query in cql_queries:
-            all_corr.append(session.call_tool(
-                name="search_confluence_based_on_cql_query",
-                arguments={
-                    "cql": query
-                }
-            ))
-
-        page_id_set = set()
-        parsed_cql_search_list = []
-        confluence_response = await asyncio.gather(*all_corr, return_exceptions=True)
-        for res in confluence_response:
-            for query_resp in res.content:
-                result = json.loads(query_resp.text)
-                for page in result["results"]:
-                    content = page['content']
-                    title = content['title']
-                    if '.pdf' in title or '.png' in title or '.docx' in title or '.jpeg' in title or '.jpg' in title:
-                        continue
-
-                    page_id = content['id']
-
-                    if page_id not in page_id_set:
-                        page_id_set.add(page_id)
-                        parsed_cql_search_list.append({
-                            'page_id': page_id,
-                            'title': title,
-                            'matched_content': page['excerpt'],
-                            'page_url': f"{CONFLUENCE_URL}/wiki{page['url']}",
-                            'lastModified': page['lastModified'],
-                            'match_score': page['score']
-                        })
-        parsed_cql_search_list.sort(key=lambda x: x['match_score'], reverse=True)
-        return parsed_cql_search_list
+
+@observe(name="mcp_server_call_search_confluence_with_cql_queries")
+async def search_confluence_with_cql_queries(cql_queries: List[PlannedQuery], retrieval: RetrievalCache | None = None):
+    """Results of the queries planned by `cql_planner.plan_cql_queries`, best match first and one entry per page."""
+    local_index = get_local_cql_index()
+    queries = [query.cql for query in cql_queries]
+    # Only queries that are neither cached nor answerable from the local index need a session with the MCP server.
+    remote_queries = [
+        query for query in queries
+        if not (retrieval is not None and retrieval.has('cql', query))
+        and not (local_index is not None and local_index.supports(query))
+    ]
+    if retrieval is not None and all(retrieval.has('cql', query) for query in queries):
+        print(f"Reusing cached results for CQL queries {queries}.")
+        confluence_response = [retrieval.get('cql', query) for query in queries]
+    else:
+        # While the MCP circuit is open the remote queries fail fast in fetch_cql_search_results without a session.
+        session_context = (
+            get_mcp_client().session(MCP_SERVER_NAME) if remote_queries and not circuit_open(MCP) else nullcontext()
+        )
+        async with session_context as session:
+            confluence_response = await asyncio.gather(*(
+                fetch_through(
+                    retrieval, 'cql', query.cql,
+                    lambda query=query: fetch_planned_query(
+                        query,
+                        lambda start, limit, cql=query.cql: fetch_cql_search_results(
+                            session, cql, local_index, start, limit
+                        )
+                    )
+                )
+                for query in cql_queries
+            ), return_exceptions=True)
+
+    page_id_set = set()
+    parsed_cql_search_list = []
+    for query, results in zip(queries, confluence_response):
+        if isinstance(results, BaseException):
+            print(f"CQL query {query} failed: {results}")
+            continue
+        for page in results:
+            if page['page_id'] not in page_id_set:
+                page_id_set.add(page['page_id'])
+                parsed_cql_search_list.append(page)
+    parsed_cql_search_list.sort(key=lambda x: x['match_score'], reverse=True)
+    return parsed_cql_search_list
 
 
 def iterator(values):
@@ -118,38 +215,54 @@ def iterator(values):
 
 
 @observe(name="mcp_server_call_download_pages_by_page_id_from_confluence")
-async def download_pages(filtered_pages, tools_map, confluence_response: Dict, content_map: Dict):
-    try:
-        if content_map is None:
-            content_map = {}
-
-        if hasattr(filtered_pages, 'additional_kwargs') and filtered_pages.additional_kwargs:
-            if 'tool_calls' in filtered_pages.additional_kwargs:
-                for tool in filtered_pages.additional_kwargs['tool_calls']:
-                    input_param = json.loads(tool['function']["arguments"])
-                    title = input_param["title"]
-                    page_id = input_param["page_id"]
-                    tool_name = tool["function"]["name"]
-
-                    if page_id not in content_map:
-                        print(f"Need to call function {tool_name} with title {title} and page_id {page_id}.")
-
-                        page_content = await tools_map[tool_name].ainvoke({
-                            'page_id': page_id,
-                            'title': title
-                        })
-
-                        content_map[page_id] = {
-                            'page_id': page_id,
-                            'title': title,
-                            'page_content': page_content,
-                            'page_url': confluence_response.get(page_id, {}).get('page_url')
-                        }
-
-        return content_map
-
-    except Exception as e:
-        return content_map
+async def download_pages(filtered_pages, tools_map, confluence_response: Dict, content_map: Dict, local_ids=None,
+                         retrieval: RetrievalCache | None = None):
+    if content_map is None:
+        content_map = {}
+
+    if hasattr(filtered_pages, 'additional_kwargs') and filtered_pages.additional_kwargs:
+        if 'tool_calls' in filtered_pages.additional_kwargs:
+            requested = {}
+            for tool in filtered_pages.additional_kwargs['tool_calls']:
+                input_param = json.loads(tool['function']["arguments"])
+                # The filter prompt refers to pages by short local ids (p1, p2, ...)
+                page_id = local_ids.resolve(input_param["page_id"]) if local_ids else input_param["page_id"]
+                title = input_param.get("title") or confluence_response.get(page_id, {}).get('title', "")
+                if page_id not in content_map:
+                    requested.setdefault(page_id, (title, tool["function"]["name"]))
+
+            async def download(page_id):
+                title, tool_name = requested[page_id]
+
+                async def fetch():
+                    print(f"Need to call function {tool_name} with title {title} and page_id {page_id}.")
+                    page_content = await call_dependency(MCP, lambda: tools_map[tool_name].ainvoke({
+                        'page_id': page_id,
+                        'title': title
+                    }))
+                    return {
+                        'page_id': page_id,
+                        'title': title,
+                        'page_content': page_content,
+                        'page_url': confluence_response.get(page_id, {}).get('page_url')
+                    }
+
+                return await fetch_through(retrieval, 'page', page_id, fetch)
+
+            # The requested pages download concurrently; content_map keeps the order the model asked for them.
+            pages = await page_download_executor().map(download, list(requested))
+            add_downloaded_pages(content_map, requested, pages)
+
+    return content_map
+
+
+def add_downloaded_pages(content_map: Dict, page_ids, pages: List):
+    """Add the pages that downloaded to `content_map`; failed downloads are logged and left out."""
+    for page_id, page in zip(page_ids, pages):
+        if isinstance(page, BaseException):
+            print(f"Downloading page {page_id} failed: {page!r}")
+        else:
+            content_map[page_id] = page
 
 
 def merge_maps(map1: Dict[str, int], map2: Dict[str, int]) -> Dict[str, int]:
@@ -165,27 +278,39 @@ def convert_llm_response_to_dict(content: str) -> Dict:
 
 
 async def download_page_directly_from_mcp(page_id: str, title: str = ""):
-    async with client.session(MCP_SERVER_NAME) as session:
-        response = await session.call_tool(
-            name="get_page_by_id",
-            arguments={
-                'page_id': page_id,
-                'title': title
-            }
-        )
-        return response.content[0].text
+    async def download():
+        async with get_mcp_client().session(MCP_SERVER_NAME) as session:
+            response = await session.call_tool(
+                name="get_page_by_id",
+                arguments={
+                    'page_id': page_id,
+                    'title': title
+                }
+            )
+            return response.content[0].text
 
+    return await call_dependency(MCP, download)
 
-async def create_page_map(parsed_llm_response, content_map: Dict, confluence_response):
+
+async def create_page_map(parsed_llm_response, content_map: Dict, confluence_response,
+                          retrieval: RetrievalCache | None = None):
     print(parsed_llm_response)
     if isinstance(parsed_llm_response, list):
-        download_pages_map = {page['page_id']: {
-            'page_id': page['page_id'],
-            'title': page['title'],
-            'page_content': await download_page_directly_from_mcp(page['page_id'], page['title']),
-            'page_url': confluence_response.get(page['page_id'], {}).get('page_url')
-        } for page in parsed_llm_response if page['page_id'] not in content_map}
-        content_map.update(download_pages_map)
+        missing = {page['page_id']: page for page in parsed_llm_response if page['page_id'] not in content_map}
+
+        async def download(page):
+            async def fetch():
+                return {
+                    'page_id': page['page_id'],
+                    'title': page['title'],
+                    'page_content': await download_page_directly_from_mcp(page['page_id'], page['title']),
+                    'page_url': confluence_response.get(page['page_id'], {}).get('page_url')
+                }
+
+            return await fetch_through(retrieval, 'page', page['page_id'], fetch)
+
+        pages = await page_download_executor().map(download, list(missing.values()))
+        add_downloaded_pages(content_map, missing, pages)
 
 
 class CustomEncoder(json.JSONEncoder):
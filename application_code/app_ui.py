@@ -1,13 +1,36 @@
+import os
+import threading
+
 import gradio as gr
-from graph import execute_user_query
-import asyncio
 
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
+CHAT_SERVER_URL = os.getenv("CHAT_SERVER_URL")
+
+
+async def chat_via_server(message, history, request: gr.Request = None):
+    from server import stream_chat_from_server
+
+    user_id = request.session_hash if request else None
+    async for chunk in stream_chat_from_server(CHAT_SERVER_URL, message, history, user_id):
+        yield chunk
+
+
+async def chat_locally(message, history, request: gr.Request = None):
+    from graph import execute_user_query
+
+    user_id = request.session_hash if request else None
+    async for chunk in execute_user_query(message, history, user_id=user_id):
+        yield chunk
+
+
+def preload_graph():
+    from graph import preload
+    preload()
+
 
+chat_fn = chat_via_server if CHAT_SERVER_URL else chat_locally
 
 demo = gr.ChatInterface(
-    execute_user_query,
+    chat_fn,
     type="messages",
     flagging_mode="manual",
     flagging_options=["Like", "Spam", "Inappropriate", "Other"],
@@ -15,4 +38,7 @@ demo = gr.ChatInterface(
 )
 
 if __name__ == "__main__":
+    if not CHAT_SERVER_URL:
+        # Load the graph in the background so the UI comes up immediately and the first question does not wait for it.
+        threading.Thread(target=preload_graph, daemon=True).start()
     demo.launch()
@@ -1,13 +1,16 @@
 """Utils for async workflows."""
 
 import asyncio
+import itertools
+import random
+import time
 import types
-from typing import Any, Awaitable, Callable, Coroutine, Sequence, TypeVar
-
-from rich.progress import Progress
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Coroutine, Iterable, Sequence, TypeVar
 
 
 T = TypeVar("T")
+R = TypeVar("R")
 
 
 async def indexed(index: int, coro: Coroutine[None, None, T]) -> tuple[int, T]:
@@ -41,6 +44,8 @@ async def gather_with_progress(
         for index, coro in enumerate(coros)
     ]
 
+    from rich.progress import Progress
+
     # Pre‐allocate a results list; we'll fill in each slot as its Task completes
     results: list[T | None] = [None] * len(tasks)
 
@@ -57,3 +62,163 @@ async def gather_with_progress(
     # At this point, every slot in `results` is guaranteed to be non‐None
     # so we can safely cast it back to List[T]
     return results  # type: ignore
+
+
+@dataclass
+class RetryPolicy:
+    """Bounded retries with full-jitter exponential backoff, for the exception types in `retry_on` only."""
+
+    attempts: int = 1
+    base_delay: float = 0.5
+    max_delay: float = 10.0
+    retry_on: tuple[type[BaseException], ...] = (Exception,)
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        return attempt < self.attempts and isinstance(error, self.retry_on)
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class IntervalLimiter:
+    """Spaces call starts at least `1 / rate_per_second` apart. One limiter can be shared by several executors."""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1.0 / rate_per_second
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_start > now:
+                await asyncio.sleep(self.next_start - now)
+            self.next_start = max(now, self.next_start) + self.interval
+
+
+class BoundedExecutor:
+    """
+    Run an async function over many items with at most `concurrency` calls in flight.
+
+    Each call can be rate limited (`rate_per_second`), bounded by a per-attempt `timeout` and retried according to
+    `retry`. Results are streamed as (index, result) pairs, either as they complete or in input order. The first
+    failure that is not retried cancels every call still outstanding and is raised, unless `return_exceptions` is set,
+    in which case failures are yielded in place of results. Items are pulled from the input lazily, so a long
+    generator is never materialized; an async iterable is consumed as its items arrive. `limiter` shares one rate limit
+    between executors instead of `rate_per_second`. `progress` names a rich progress bar to show, if any.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 8,
+        rate_per_second: float | None = None,
+        timeout: float | None = None,
+        retry: RetryPolicy | None = None,
+        return_exceptions: bool = False,
+        progress: str | None = None,
+        limiter: IntervalLimiter | None = None,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.limiter = limiter or (IntervalLimiter(rate_per_second) if rate_per_second else None)
+        self.timeout = timeout
+        self.retry = retry or RetryPolicy()
+        self.return_exceptions = return_exceptions
+        self.progress = progress
+
+    async def _call(self, fn: Callable[[T], Awaitable[R]], item: T) -> R:
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.limiter is not None:
+                await self.limiter.wait()
+            try:
+                if self.timeout is None:
+                    return await fn(item)
+                return await asyncio.wait_for(fn(item), self.timeout)
+            except Exception as e:
+                if not self.retry.should_retry(e, attempt):
+                    raise
+                await asyncio.sleep(self.retry.delay(attempt))
+
+    async def stream(
+        self, fn: Callable[[T], Awaitable[R]], items: Iterable[T] | AsyncIterable[T], ordered: bool = False
+    ) -> AsyncIterator[tuple[int, R | BaseException]]:
+        """Yield (index, result) for every item, in completion order or, with `ordered`, in input order."""
+        if hasattr(items, "__aiter__"):
+            async_source, counter, source_lock = aiter(items), itertools.count(), asyncio.Lock()
+
+            async def next_item() -> tuple[int, T] | None:
+                async with source_lock:
+                    try:
+                        item = await anext(async_source)
+                    except StopAsyncIteration:
+                        return None
+                    return next(counter), item
+        else:
+            source = enumerate(items)
+
+            async def next_item() -> tuple[int, T] | None:
+                return next(source, None)
+
+        done: asyncio.Queue = asyncio.Queue()
+
+        async def worker():
+            while (entry := await next_item()) is not None:
+                index, item = entry
+                try:
+                    done.put_nowait((index, await self._call(fn, item), None))
+                except Exception as e:
+                    done.put_nowait((index, None, e))
+                    if not self.return_exceptions:
+                        return  # The failure cancels the run; take no more items.
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        finished_workers = asyncio.gather(*workers)
+        progress, progress_task = None, None
+        if self.progress is not None:
+            from rich.progress import Progress
+
+            progress = Progress()
+            progress.start()
+            progress_task = progress.add_task(self.progress, total=len(items) if hasattr(items, "__len__") else None)
+
+        pending: dict[int, R | BaseException] = {}
+        next_index = 0
+        try:
+            while True:
+                if done.empty() and finished_workers.done():
+                    break
+                getter = asyncio.ensure_future(done.get())
+                await asyncio.wait([getter, finished_workers], return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    continue
+                index, result, error = getter.result()
+                if progress is not None:
+                    progress.update(progress_task, advance=1)
+                if error is not None and not self.return_exceptions:
+                    raise error
+                outcome = error if error is not None else result
+                if not ordered:
+                    yield index, outcome
+                    continue
+                pending[index] = outcome
+                while next_index in pending:
+                    yield next_index, pending.pop(next_index)
+                    next_index += 1
+        finally:
+            # Cancel the workers themselves: the gather is already done if one of them failed pulling an item.
+            for task in workers:
+                task.cancel()
+            try:
+                await finished_workers
+            except asyncio.CancelledError:
+                pass
+            if progress is not None:
+                progress.stop()
+
+    async def map(
+        self, fn: Callable[[T], Awaitable[R]], items: Iterable[T] | AsyncIterable[T]
+    ) -> list[R | BaseException]:
+        """Results for every item, in input order."""
+        return [result async for _, result in self.stream(fn, items, ordered=True)]
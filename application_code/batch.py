@@ -0,0 +1,194 @@
+"""
+Batch entry point for pushing many questions through `graph.execute_user_query`.
+
+Meant for nightly FAQ regeneration and evaluation jobs. Queries run with bounded concurrency and share one
+`RetrievalCache`, so CQL searches, page downloads and vector searches common to several questions are fetched once
+(concurrent requests for the same item wait for the first fetch instead of repeating it). Query embeddings are
+computed up front in batched embedding requests. Results are yielded, and written as JSON lines, in completion order
+as each query finishes.
+
+Input format: one query per line, either plain text or JSON such as `{"query": "What is Maple trust bank?"}`.
+
+Usage:
+    python3 -m batch --input questions.txt --output answers.jsonl --concurrency 8
+    python3 -m batch --input questions.txt --offline
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import AsyncIterator, Dict, List, Sequence
+
+from conversation_store import ConversationContext, conversation_store
+from llm_cache import normalize_query
+from metrics import summarize_latencies
+from retrieval_cache import RetrievalCache
+
+
+@dataclass
+class BatchResult:
+    index: int
+    query: str
+    answer: str | None = None
+    sources: List[Dict] = field(default_factory=list)
+    token_usage: Dict[str, float] = field(default_factory=dict)
+    latency_seconds: float = 0.0
+    error: str | None = None
+
+
+async def precompute_embeddings(queries: Sequence[str], retrieval: RetrievalCache, batch_size: int):
+    """Embed every distinct query variant agent 2 searches with in batched requests and store the vectors."""
+    from agents import get_weaviate_client
+    from agents_helper import query_variants
+
+    distinct = {}
+    for query in queries:
+        for variant in query_variants(query):
+            distinct.setdefault(normalize_query(variant), variant)
+    try:
+        async with get_weaviate_client() as knowledge_base:
+            vectors = await knowledge_base.vectorize_batch(list(distinct.values()), batch_size=batch_size)
+    except Exception as e:
+        print(f"Batched embedding failed, agent 2 will embed each query itself: {e}")
+        return
+    for query_key, vector in zip(distinct, vectors):
+        retrieval.put('embedding', query_key, vector)
+
+
+async def answer_query(index: int, query: str, batch_id: str, retrieval: RetrievalCache) -> BatchResult:
+    from agents_helper import merge_maps
+    from graph import execute_user_query
+
+    conversation = ConversationContext(f"batch-{batch_id}-{index}", retrieval=retrieval)
+    conversation_store.attach(conversation)
+    result = BatchResult(index=index, query=query)
+    started = time.perf_counter()
+    try:
+        async for chunk in execute_user_query(query, conversation_id=conversation.conversation_id):
+            for update in json.loads(chunk).values():
+                if not update:
+                    continue
+                result.answer = update.get('answer') or result.answer
+                if update.get('page_map'):
+                    result.sources = [
+                        {'page_id': page['page_id'], 'title': page['title'], 'page_url': page.get('page_url')}
+                        for page in update['page_map'].values()
+                    ]
+                for key, value in update.items():
+                    if key.endswith('_token_usage') and value:
+                        result.token_usage = merge_maps(result.token_usage, value)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        conversation_store.detach(conversation.conversation_id)
+        result.latency_seconds = time.perf_counter() - started
+    return result
+
+
+async def run_batch(
+    queries: Sequence[str],
+    concurrency: int = 8,
+    embedding_batch_size: int = 64,
+    retrieval: RetrievalCache | None = None,
+) -> AsyncIterator[BatchResult]:
+    """Answer `queries` with at most `concurrency` in flight, yielding each result as soon as it is ready."""
+    retrieval = retrieval if retrieval is not None else RetrievalCache()
+    batch_id = uuid.uuid4().hex[:8]
+    await precompute_embeddings(queries, retrieval, embedding_batch_size)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(index: int, query: str) -> BatchResult:
+        async with semaphore:
+            return await answer_query(index, query, batch_id, retrieval)
+
+    tasks = [asyncio.create_task(bounded(index, query)) for index, query in enumerate(queries)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def load_queries(path: str | os.PathLike) -> List[str]:
+    queries = []
+    with open(path, mode='r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                line = json.loads(line)["query"]
+            queries.append(line)
+    return queries
+
+
+async def write_batch(args: argparse.Namespace, queries: List[str], output, log) -> Dict:
+    retrieval = RetrievalCache()
+    results = []
+    async for result in run_batch(queries, args.concurrency, args.embedding_batch_size, retrieval):
+        results.append(result)
+        output.write(json.dumps(asdict(result), default=str) + "\n")
+        output.flush()
+        print(f"[{len(results)}/{len(queries)}] {result.latency_seconds:.2f}s "
+              f"{'ERROR ' + result.error if result.error else 'ok'}: {result.query}", file=log)
+
+    token_usage = {}
+    for result in results:
+        for key, value in result.token_usage.items():
+            token_usage[key] = token_usage.get(key, 0) + value
+    answered = sum(1 for result in results if not result.error)
+    if answered and not token_usage.get('total_tokens'):
+        # Usage only reaches the batch through the state stream, see graph_state.RAGState.
+        print(f"WARNING: {answered} queries were answered but no token usage was reported.", file=log)
+
+    return {
+        'queries': len(queries),
+        'errors': len(results) - answered,
+        'latency': summarize_latencies([result.latency_seconds for result in results]),
+        'token_usage': token_usage,
+        'retrieval_cache': retrieval.stats(),
+    }
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Answer a batch of questions with shared retrieval.")
+    parser.add_argument("--input", required=True, help="File with one query per line (plain text or JSON).")
+    parser.add_argument("--output", help="JSON lines result file (defaults to stdout).")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--embedding-batch-size", type=int, default=64)
+    parser.add_argument("--offline", action="store_true", help="Use the benchmark's local service stand-ins.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the workflow's own prints.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None):
+    args = parse_args(argv)
+    queries = load_queries(args.input)
+
+    services = contextlib.nullcontext()
+    if args.offline:
+        from benchmark import offline_services
+        from corpus import iter_ingested_pages
+        services = offline_services(list(iter_ingested_pages()), jitter=0.2)
+
+    output = open(args.output, mode='w', encoding='utf-8') if args.output else sys.stdout
+    log = sys.stderr if output is sys.stdout else sys.stdout
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    with services, output if args.output else contextlib.nullcontext():
+        with quiet:
+            summary = asyncio.run(write_batch(args, queries, output, log))
+
+    print(json.dumps(summary, indent=2), file=log)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,611 @@
+"""
+Offline end-to-end benchmark for the confluence workflow.
+
+Runs the compiled `graph.get_confluence_workflow()` against deterministic local stand-ins instead of the live services:
+
+- a scripted chat model with configurable latency in place of Gemini Flash/Pro,
+- an in-process FastMCP server serving the `ingestion_docs` corpus in place of the Confluence MCP server,
+- an in-memory bag-of-words vector store in place of Weaviate.
+
+Reports per-node and end-to-end latency percentiles, throughput at several concurrency levels and peak memory,
+and writes the results as JSON under `benchmark_results/` so runs can be compared over time. The client-side LLM rate
+limits are off, since the scripted models have no provider quota; `--rate-limits` keeps them and reports the time
+requests queued for them next to the node latencies.
+
+Usage:
+    python3 -m benchmark --concurrency 1 4 16 --requests 32
+    python3 -m benchmark --compare benchmark_results/<previous run>.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+import zlib
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+# Repeated benchmark queries would otherwise be answered from the persistent CQL cache; see --cql-cache.
+os.environ.setdefault("CQL_CACHE_ENABLED", "false")
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+from langchain_core.tools import StructuredTool
+from mcp.server.fastmcp import FastMCP
+from mcp.shared.memory import create_connected_server_and_client_session
+
+import agents
+import agents_helper
+import rate_limiter
+from blob_store import blob_stores
+from corpus import INGESTION_FOLDER, iter_ingested_pages
+from graph import get_confluence_workflow
+from graph_state import RAGState
+from kb_weaviate import _SearchResult, fuse_search_results
+from hedging import hedge_stats
+from metrics import summarize_latencies
+
+RESULTS_FOLDER = Path(__file__).parent / "benchmark_results"
+
+DEFAULT_QUERIES = [
+    "What is Maple trust bank?",
+    "What credit cards does Maple Trust Bank offer?",
+    "How many days of paid time off do employees get?",
+    "What are the remote and hybrid work guidelines?",
+    "How is the deployment and DevOps pipeline set up?",
+    "What are the Q3 sales targets?",
+    "Which loan products are available for business banking?",
+    "How does monitoring and observability work in the platform?",
+]
+
+_STOP_WORDS = {
+    "a", "about", "an", "and", "are", "at", "be", "by", "can", "do", "does", "for", "from", "get", "how", "i",
+    "in", "is", "it", "me", "many", "of", "on", "or", "set", "tell", "that", "the", "their", "there", "this",
+    "to", "up", "what", "when", "where", "which", "who", "why", "with", "work",
+}
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+_USER_QUERY_PATTERN = re.compile(r"User (?:Query|Question):\**\s*(\S[^\n]*)")
+_CANDIDATE_ROW_PATTERN = re.compile(r"^(p\d+) \| ([^|\n]*) \|", re.MULTILINE)
+
+
+def _tokenize(text: str) -> List[str]:
+    return _WORD_PATTERN.findall(text.lower())
+
+
+def _keywords(text: str) -> List[str]:
+    return [token for token in _tokenize(text) if token not in _STOP_WORDS]
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Deterministic chat model that answers the three workflow prompts without a provider.
+
+    - Structured output (agent 1): CQL `siteSearch` queries built from the user query keywords.
+    - Structured output (agent 3 cascade triage): a decision per candidate with a prompt-derived confidence.
+    - Tools bound (agent 3): tool calls for the first candidates, then the JSON list of selected pages.
+    - Plain prompt (agent 5): a markdown answer citing the pages it was given.
+
+    Latency is `latency_seconds` plus a jitter derived from the prompt hash, with an optional slow tail that is drawn
+    per call (like a provider's), so a duplicate of a slow request is usually fast.
+    """
+
+    latency_seconds: float = 0.5
+    jitter_seconds: float = 0.0
+    tail_probability: float = 0.0
+    tail_multiplier: float = 5.0
+    max_tool_calls: int = 2
+    max_selected_pages: int = 3
+    answer_words: int = 250
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-benchmark"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[getattr(tool, 'name', tool) for tool in tools], **kwargs)
+
+    def with_structured_output(self, schema, **kwargs):
+        return self.bind(response_schema=schema) | RunnableLambda(
+            lambda message: schema.model_validate_json(message.content)
+        )
+
+    def _latency_for(self, prompt: str) -> float:
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        latency = self.latency_seconds + rng.uniform(0, self.jitter_seconds)
+        if random.random() < self.tail_probability:
+            latency *= self.tail_multiplier
+        return latency
+
+    def _respond(self, prompt: str, response_schema=None, tools: Optional[List[str]] = None) -> AIMessage:
+        match = _USER_QUERY_PATTERN.search(prompt)
+        user_query = match.group(1).strip() if match else ""
+        keywords = _keywords(user_query) or ["maple", "trust", "bank"]
+
+        tool_calls = []
+        if response_schema is not None and 'decisions' in response_schema.model_fields:
+            content = json.dumps({'decisions': [
+                {
+                    'id': local_id,
+                    'relevant': index < self.max_selected_pages,
+                    'confidence': 0.5 + (zlib.crc32(f"{user_query}{title}".encode("utf-8")) % 50) / 100,
+                }
+                for index, (local_id, title) in enumerate(_CANDIDATE_ROW_PATTERN.findall(prompt))
+            ]})
+        elif response_schema is not None:
+            phrases = [" ".join(keywords), " ".join(keywords[:2]), keywords[-1]]
+            content = json.dumps({
+                'cql_queries': [f'siteSearch ~ "{phrase}"' for phrase in dict.fromkeys(phrases)],
+                'justifications': ["Keeps the main entity of the user query."] * len(dict.fromkeys(phrases)),
+            })
+        elif tools:
+            candidates = _CANDIDATE_ROW_PATTERN.findall(prompt)
+            if "Right now there is no output" in prompt and candidates:
+                content = ""
+                for local_id, title in candidates[:self.max_tool_calls]:
+                    tool_calls.append({
+                        'id': f"call_{uuid.uuid4().hex[:12]}",
+                        'type': 'function',
+                        'function': {
+                            'name': 'get_page_by_id',
+                            'arguments': json.dumps({'page_id': local_id, 'title': title.strip()}),
+                        },
+                    })
+            else:
+                content = json.dumps([{'id': local_id} for local_id, _ in candidates[:self.max_selected_pages]])
+        else:
+            words = (" ".join(keywords) + " ") * math.ceil(self.answer_words / len(keywords))
+            content = "**Answer:**\n\n" + " ".join(words.split()[:self.answer_words])
+
+        input_tokens = _estimate_tokens(prompt)
+        output_tokens = _estimate_tokens(content + json.dumps(tool_calls))
+        return AIMessage(
+            content=content,
+            additional_kwargs={'tool_calls': tool_calls} if tool_calls else {},
+            usage_metadata={
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'total_tokens': input_tokens + output_tokens,
+            },
+        )
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        prompt = "\n".join(str(message.content) for message in messages)
+        time.sleep(self._latency_for(prompt))
+        message = self._respond(prompt, kwargs.get('response_schema'), kwargs.get('tools'))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        prompt = "\n".join(str(message.content) for message in messages)
+        await asyncio.sleep(self._latency_for(prompt))
+        message = self._respond(prompt, kwargs.get('response_schema'), kwargs.get('tools'))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class LocalCorpusSearch:
+    """Term-frequency search over the ingested pages, used by both offline stand-ins."""
+
+    def __init__(self, pages: Sequence[Dict]):
+        self.pages = {page['page_id']: page for page in pages}
+        self.term_counts = {page['page_id']: Counter(_tokenize(page['text'])) for page in pages}
+        self.norms = {
+            page_id: math.sqrt(sum(count * count for count in counts.values()))
+            for page_id, counts in self.term_counts.items()
+        }
+        document_frequency = Counter(term for counts in self.term_counts.values() for term in counts)
+        self.idf = {
+            term: math.log(1 + len(pages) / frequency) for term, frequency in document_frequency.items()
+        }
+
+    def score(self, terms: Sequence[str]) -> List[tuple[str, float]]:
+        scored = []
+        for page_id, counts in self.term_counts.items():
+            score = sum(math.log1p(counts[term]) * self.idf.get(term, 0.0) for term in terms)
+            if score > 0:
+                scored.append((page_id, score))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored
+
+    def cosine(self, terms: Sequence[str]) -> List[tuple[str, float]]:
+        query = Counter(terms)
+        query_norm = math.sqrt(sum(count * count for count in query.values())) or 1.0
+        scored = []
+        for page_id, counts in self.term_counts.items():
+            dot = sum(counts[term] * weight for term, weight in query.items())
+            if dot:
+                scored.append((page_id, dot / (query_norm * (self.norms[page_id] or 1.0))))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored
+
+    def excerpt(self, page_id: str, terms: Sequence[str], width: int = 240) -> str:
+        text = self.pages[page_id]['text']
+        lowered = text.lower()
+        positions = [lowered.find(term) for term in terms if lowered.find(term) >= 0]
+        start = max(0, min(positions) - width // 4) if positions else 0
+        snippet = text[start:start + width]
+        for term in sorted(set(terms), key=len, reverse=True):
+            snippet = re.sub(rf"(?i)\b({re.escape(term)})\b", r"@@@hl@@@\1@@@endhl@@@", snippet)
+        return snippet
+
+
+def build_local_mcp_server(search: LocalCorpusSearch, latency_seconds: float = 0.0) -> FastMCP:
+    """FastMCP server exposing the same tools as `mcp_server.py`, backed by the local corpus."""
+    server = FastMCP(name=agents_helper.MCP_SERVER_NAME)
+
+    @server.tool()
+    async def search_confluence_based_on_cql_query(cql: str, start: int = 0, limit: int = 10) -> Dict:
+        """Search the ingested corpus for the quoted phrases in a CQL query."""
+        await asyncio.sleep(latency_seconds)
+        terms = [term for phrase in re.findall(r'"([^"]+)"', cql) for term in _keywords(phrase)]
+        results = []
+        for page_id, score in search.score(terms)[start:start + limit]:
+            title = search.pages[page_id]['title']
+            results.append({
+                'content': {'id': page_id, 'type': 'page', 'title': title},
+                'excerpt': search.excerpt(page_id, terms),
+                'url': f"/spaces/BENCH/pages/{page_id}/{title.replace(' ', '+')}",
+                'lastModified': '2025-01-01T00:00:00.000Z',
+                'score': score,
+            })
+        return {'results': results, 'start': start, 'limit': limit, 'size': len(results)}
+
+    @server.tool()
+    async def get_page_by_id(page_id: str, title: str = None) -> str:
+        """Return the ingested markdown of a page."""
+        await asyncio.sleep(latency_seconds)
+        page = search.pages.get(page_id)
+        if page is None:
+            raise ValueError(f"Page {page_id} is not part of the ingested corpus.")
+        return page['text']
+
+    return server
+
+
+class LocalMCPClient:
+    """Drop-in for `MultiServerMCPClient` that talks to an in-process FastMCP server over memory streams."""
+
+    def __init__(self, server: FastMCP):
+        self.server = server
+
+    @asynccontextmanager
+    async def session(self, server_name: str):
+        async with create_connected_server_and_client_session(self.server._mcp_server) as session:
+            yield session
+
+    async def get_tools(self):
+        async with self.session(agents_helper.MCP_SERVER_NAME) as session:
+            listed = await session.list_tools()
+        return [self._to_langchain_tool(tool) for tool in listed.tools]
+
+    def _to_langchain_tool(self, tool):
+        async def call_tool(**arguments):
+            async with self.session(agents_helper.MCP_SERVER_NAME) as session:
+                result = await session.call_tool(tool.name, arguments)
+            return "\n".join(content.text for content in result.content if content.type == "text")
+
+        return StructuredTool(
+            name=tool.name,
+            description=tool.description or "",
+            args_schema=tool.inputSchema,
+            coroutine=call_tool,
+        )
+
+
+class InMemoryKnowledgeBase:
+    """Stand-in for `AsyncWeaviateKnowledgeBase` ranking pages by bag-of-words cosine similarity."""
+
+    def __init__(self, search: LocalCorpusSearch, num_results: int = 5, latency_seconds: float = 0.0):
+        self.search = search
+        self.num_results = num_results
+        self.latency_seconds = latency_seconds
+
+    async def search_knowledgebase(self, keyword: str, vector: List[float] | None = None) -> List[_SearchResult]:
+        await asyncio.sleep(self.latency_seconds)
+        hits = []
+        for page_id, _ in self.search.cosine(_keywords(keyword))[:self.num_results]:
+            page = self.search.pages[page_id]
+            hits.append(_SearchResult.model_validate({
+                "_source": {"title": f"{page_id}_{page['title']}", "section": None},
+                "highlight": {"text": [page['text']]},
+            }))
+        return hits
+
+    async def search_knowledgebase_multi(
+        self, queries: List[str], vectors: List[List[float] | None] | None = None
+    ) -> List[_SearchResult]:
+        result_lists = await asyncio.gather(*(self.search_knowledgebase(query) for query in queries))
+        return fuse_search_results(list(result_lists), self.num_results, queries, snippet_chars=1000)
+
+    async def vectorize_batch(self, texts: List[str], batch_size: int = 64) -> List[List[float]]:
+        # Ranking is keyword based; the vectors only stand in for the embedding round trips.
+        for _ in range(0, len(texts), batch_size):
+            await asyncio.sleep(self.latency_seconds)
+        return [[float(zlib.crc32(text.encode("utf-8")))] for text in texts]
+
+
+@contextmanager
+def offline_services(
+    pages: Sequence[Dict],
+    worker_latency: float = 0.5,
+    planner_latency: float = 1.5,
+    jitter: float = 0.0,
+    tail_probability: float = 0.0,
+    mcp_latency: float = 0.0,
+    vector_latency: float = 0.0,
+    rate_limits: bool = False,
+):
+    """
+    Swap the workflow's LLMs, MCP client and Weaviate client for local stand-ins while the block runs. The scripted
+    models have no provider quota, so the client-side LLM rate limits are off unless `rate_limits` is set.
+    """
+    search = LocalCorpusSearch(pages)
+    knowledge_base = InMemoryKnowledgeBase(search, latency_seconds=vector_latency)
+
+    @asynccontextmanager
+    async def get_local_knowledge_base():
+        yield knowledge_base
+
+    model_options = {'jitter_seconds': jitter, 'tail_probability': tail_probability}
+    originals = (agents.get_llm, agents.get_deep_research_llm, agents.get_weaviate_client, agents_helper.client)
+    worker_model = ScriptedChatModel(latency_seconds=worker_latency, **model_options)
+    planner_model = ScriptedChatModel(latency_seconds=planner_latency, **model_options)
+    agents.get_llm = lambda: worker_model
+    agents.get_deep_research_llm = lambda: planner_model
+    agents.get_weaviate_client = get_local_knowledge_base
+    agents_helper.client = LocalMCPClient(build_local_mcp_server(search, latency_seconds=mcp_latency))
+    try:
+        with contextlib.nullcontext() if rate_limits else rate_limiter.limits_disabled():
+            yield search
+    finally:
+        agents.get_llm, agents.get_deep_research_llm, agents.get_weaviate_client, agents_helper.client = originals
+
+
+class NodeTimer(BaseCallbackHandler):
+    """Callback handler recording the wall time of every graph node run."""
+
+    run_inline = True
+
+    def __init__(self):
+        self._started: Dict[Any, tuple[str, float]] = {}
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get('langgraph_node')
+        if node and not node.startswith('__') and kwargs.get('name') == node:
+            self._started[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        if run_id in self._started:
+            node, started = self._started.pop(run_id)
+            self.durations[node].append(time.perf_counter() - started)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.on_chain_end(None, run_id=run_id)
+
+
+async def run_single_query(user_query: str) -> Dict:
+    timer = NodeTimer()
+    state = RAGState(
+        session_id=str(uuid.uuid4()),
+        user_query=user_query,
+        confluence_response={},
+        filtered_pages=[],
+        vector_db_response=[],
+        answer="",
+        cql_queries=[],
+        page_map={}
+    )
+    started = time.perf_counter()
+    with blob_stores.scope(state['session_id']), rate_limiter.record_waits() as waits:
+        await get_confluence_workflow().ainvoke(input=state, config={'callbacks': [timer]})
+    # Node durations include the time their LLM calls queued for the rate limiter; it is reported on its own as well.
+    return {'latency': time.perf_counter() - started, 'nodes': dict(timer.durations), 'rate_limit_wait': sum(waits)}
+
+
+async def run_level(queries: Sequence[str], concurrency: int, requests: int) -> Dict:
+    """Run `requests` queries (cycling through `queries`) with at most `concurrency` in flight."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(user_query: str):
+        async with semaphore:
+            return await run_single_query(user_query)
+
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(
+        *(bounded(queries[index % len(queries)]) for index in range(requests)),
+        return_exceptions=True,
+    )
+    wall_seconds = time.perf_counter() - started
+
+    runs = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+    errors = [repr(outcome) for outcome in outcomes if isinstance(outcome, BaseException)]
+    node_samples = defaultdict(list)
+    for run in runs:
+        for node, durations in run['nodes'].items():
+            node_samples[node].extend(durations)
+
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': len(errors),
+        'error_samples': errors[:3],
+        'wall_seconds': wall_seconds,
+        'throughput_rps': len(runs) / wall_seconds if wall_seconds else 0.0,
+        'end_to_end': summarize_latencies(run['latency'] for run in runs),
+        'rate_limit_wait': summarize_latencies(run['rate_limit_wait'] for run in runs),
+        'nodes': {node: summarize_latencies(samples) for node, samples in sorted(node_samples.items())},
+    }
+
+
+async def measure_peak_memory(queries: Sequence[str], concurrency: int, requests: int) -> Dict:
+    """Separate pass under tracemalloc, so tracing overhead does not distort the latency numbers."""
+    tracemalloc.start()
+    try:
+        await run_level(queries, concurrency, requests)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'concurrency': concurrency,
+        'tracemalloc_peak_bytes': peak,
+        # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+        'max_rss_bytes': max_rss if sys.platform == "darwin" else max_rss * 1024,
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict:
+    if args.cql_cache:
+        os.environ["CQL_CACHE_ENABLED"] = "true"
+    if args.hedging:
+        os.environ["LLM_HEDGING"] = "true"
+    pages = list(iter_ingested_pages(args.corpus))
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, mode='r', encoding='utf-8') as file:
+            queries = [line.strip() for line in file if line.strip()]
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    if not args.verbose:
+        logging.getLogger("mcp").setLevel(logging.WARNING)
+    levels = []
+    with offline_services(
+            pages,
+            worker_latency=args.worker_latency,
+            planner_latency=args.planner_latency,
+            jitter=args.jitter,
+            tail_probability=args.tail_probability,
+            mcp_latency=args.mcp_latency,
+            vector_latency=args.vector_latency,
+            rate_limits=args.rate_limits,
+    ), output:
+        await run_level(queries, concurrency=1, requests=1)  # warm-up: imports, tool listing, caches
+        for concurrency in args.concurrency:
+            levels.append(await run_level(queries, concurrency, max(args.requests, concurrency)))
+        memory = await measure_peak_memory(queries, max(args.concurrency), max(args.requests, max(args.concurrency)))
+
+    return {
+        'benchmark': 'confluence_workflow_offline',
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'config': {
+            'corpus_pages': len(pages),
+            'queries': len(queries),
+            'requests_per_level': args.requests,
+            'worker_latency': args.worker_latency,
+            'planner_latency': args.planner_latency,
+            'jitter': args.jitter,
+            'tail_probability': args.tail_probability,
+            'mcp_latency': args.mcp_latency,
+            'vector_latency': args.vector_latency,
+            'cql_cache': args.cql_cache,
+            'hedging': args.hedging,
+            'rate_limits': args.rate_limits,
+        },
+        'levels': levels,
+        'memory': memory,
+        'hedging': hedge_stats.stats(),
+    }
+
+
+def print_report(report: Dict, baseline: Dict | None = None):
+    baseline_levels = {level['concurrency']: level for level in (baseline or {}).get('levels', [])}
+    print(f"Offline benchmark @ {report['git_commit']} ({report['config']['corpus_pages']} pages)")
+    for level in report['levels']:
+        e2e = level['end_to_end']
+        line = (f"  concurrency={level['concurrency']:<3} rps={level['throughput_rps']:.2f} "
+                f"p50={e2e['p50']:.3f}s p95={e2e['p95']:.3f}s p99={e2e['p99']:.3f}s errors={level['errors']}")
+        previous = baseline_levels.get(level['concurrency'])
+        if previous:
+            line += (f" | vs baseline: rps {level['throughput_rps'] - previous['throughput_rps']:+.2f} "
+                     f"p95 {e2e['p95'] - previous['end_to_end']['p95']:+.3f}s")
+        print(line)
+        wait = level.get('rate_limit_wait')
+        if wait and wait['max'] > 0:
+            print(f"      {'LLM rate limiter wait per request':<36} p50={wait['p50']:.3f}s p95={wait['p95']:.3f}s")
+        for node, summary in level['nodes'].items():
+            print(f"      {node:<36} p50={summary['p50']:.3f}s p95={summary['p95']:.3f}s")
+    hedging = report.get('hedging')
+    if hedging and hedging['hedges']:
+        print(f"  hedged {hedging['hedges']}/{hedging['calls']} LLM calls, {hedging['hedge_wins']} won by the hedge, "
+              f"extra token usage {hedging['extra_token_usage']}")
+    memory = report['memory']
+    print(f"  peak python heap {memory['tracemalloc_peak_bytes'] / 2 ** 20:.1f} MiB, "
+          f"max RSS {memory['max_rss_bytes'] / 2 ** 20:.1f} MiB")
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the confluence workflow.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level.")
+    parser.add_argument("--queries", help="File with one query per line (defaults to a built-in set).")
+    parser.add_argument("--corpus", default=str(INGESTION_FOLDER))
+    parser.add_argument("--worker-latency", type=float, default=0.5, help="Seconds per Flash call.")
+    parser.add_argument("--planner-latency", type=float, default=1.5, help="Seconds per Pro call.")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Max extra seconds added per LLM call.")
+    parser.add_argument("--tail-probability", type=float, default=0.0, help="Share of LLM calls that are slow.")
+    parser.add_argument("--mcp-latency", type=float, default=0.05)
+    parser.add_argument("--vector-latency", type=float, default=0.05)
+    parser.add_argument("--cql-cache", action="store_true", help="Let agent 1 use the persistent CQL cache.")
+    parser.add_argument("--hedging", action="store_true", help="Enable hedged LLM requests (LLM_HEDGING).")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="Keep the client-side LLM rate limits (llm.AGENT_LLM_RATE_LIMITS) for the scripted models.")
+    parser.add_argument("--output", help="Result file (defaults to benchmark_results/<timestamp>.json).")
+    parser.add_argument("--compare", help="Previous result file to compare against.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the workflow's own prints.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None):
+    args = parse_args(argv)
+    report = asyncio.run(run_benchmark(args))
+
+    output_path = Path(args.output) if args.output else (
+            RESULTS_FOLDER / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{report['git_commit'] or 'local'}.json"
+    )
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, mode='w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, mode='r', encoding='utf-8') as file:
+            baseline = json.load(file)
+    print_report(report, baseline)
+    print(f"Results written to {output_path}")
+
+
+if __name__ == '__main__':
+    main()
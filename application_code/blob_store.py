@@ -0,0 +1,107 @@
+"""
+Per-request, content-addressed store for large page bodies.
+
+The graph state only carries references to page contents (`content_ref`, the hash of the text, plus `content_chars`)
+next to the page's id, title and URL. The text itself is put into the request's `BlobStore` once and resolved only by
+the nodes that need it (agent 5 building the summarization prompt). LangGraph's per-step copies and merges of the state,
+the streamed update chunks and the trace spans therefore stay small no matter how large the pages are, and a page
+seen twice in one request (Confluence and vector results) is stored once.
+
+Stores live in a registry keyed by the graph run's `session_id` and are dropped when the run finishes. Nodes running
+without a store (calling an agent directly from a test script) keep page contents in the state by value.
+"""
+
+import hashlib
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+CONTENT_KEY = 'page_content'
+REFERENCE_KEY = 'content_ref'
+
+
+class BlobStore:
+    """Texts by the hash of their content."""
+
+    def __init__(self):
+        self._blobs: Dict[str, str] = {}
+        self.deduplicated = 0
+
+    def put(self, text: str) -> str:
+        ref = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+        if ref in self._blobs:
+            self.deduplicated += 1
+        else:
+            self._blobs[ref] = text
+        return ref
+
+    def get(self, ref: str) -> str:
+        return self._blobs[ref]
+
+    def approximate_size(self) -> int:
+        return sum(len(text) for text in self._blobs.values())
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+
+class BlobStores:
+    """The blob stores of the graph runs in flight, by session id."""
+
+    def __init__(self):
+        self._stores: Dict[str, BlobStore] = {}
+
+    def get(self, session_id: str | None) -> BlobStore | None:
+        return self._stores.get(session_id) if session_id is not None else None
+
+    @contextmanager
+    def scope(self, session_id: str) -> Iterator[BlobStore]:
+        """A fresh store for the run `session_id`, dropped when the block exits."""
+        store = self._stores[session_id] = BlobStore()
+        try:
+            yield store
+        finally:
+            self._stores.pop(session_id, None)
+
+    def stats(self) -> Dict:
+        return {
+            'requests': len(self._stores),
+            'blobs': sum(len(store) for store in self._stores.values()),
+            'approximate_bytes': sum(store.approximate_size() for store in self._stores.values()),
+        }
+
+
+def store_page(blobs: BlobStore | None, page: Dict) -> Dict:
+    """Copy of `page` with its content replaced by a reference into `blobs`."""
+    if blobs is None or CONTENT_KEY not in page:
+        return page
+    reference = {key: value for key, value in page.items() if key != CONTENT_KEY}
+    content = str(page[CONTENT_KEY] or "")
+    reference[REFERENCE_KEY] = blobs.put(content)
+    reference['content_chars'] = len(content)
+    return reference
+
+
+def resolve_page(blobs: BlobStore | None, page: Dict) -> Dict:
+    """Copy of a page reference with its content read back from `blobs`."""
+    if blobs is None or REFERENCE_KEY not in page:
+        return page
+    resolved = {key: value for key, value in page.items() if key not in (REFERENCE_KEY, 'content_chars')}
+    resolved[CONTENT_KEY] = blobs.get(page[REFERENCE_KEY])
+    return resolved
+
+
+def store_pages(blobs: BlobStore | None, pages):
+    """`store_page` over a list of pages or a dict of pages by id."""
+    if isinstance(pages, dict):
+        return {page_id: store_page(blobs, page) for page_id, page in pages.items()}
+    return [store_page(blobs, page) for page in pages or []]
+
+
+def resolve_pages(blobs: BlobStore | None, pages):
+    """`resolve_page` over a list of pages or a dict of pages by id."""
+    if isinstance(pages, dict):
+        return {page_id: resolve_page(blobs, page) for page_id, page in pages.items()}
+    return [resolve_page(blobs, page) for page in pages or []]
+
+
+blob_stores = BlobStores()
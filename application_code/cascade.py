@@ -0,0 +1,92 @@
+"""
+Model cascade for agent 3's page filtering.
+
+In cascade mode the cheap `worker` model (Flash) first triages every candidate with a relevance decision and a
+confidence. Candidates it is confident about are kept or dropped directly; only the ambiguous ones (low confidence,
+missing from the answer, or all of them when the triage failed or too many were ambiguous) are escalated to the
+tool-using `planner` model (Pro) flow. Escalation rate and latency per tier are recorded process-wide.
+
+Configuration (environment):
+    AGENT_3_CASCADE                      "true" to enable the cascade (default "false": planner only)
+    AGENT_3_CASCADE_MIN_CONFIDENCE       decisions below this confidence are escalated (default 0.8)
+    AGENT_3_CASCADE_ESCALATE_ALL_RATIO   escalate every candidate when more than this share is ambiguous (default 0.6)
+"""
+
+import os
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List
+
+from metrics import summarize_latencies
+
+
+@dataclass
+class CascadePolicy:
+    enabled: bool = False
+    min_confidence: float = 0.8
+    escalate_all_ratio: float = 0.6
+
+    @classmethod
+    def from_env(cls) -> "CascadePolicy":
+        return cls(
+            enabled=os.getenv("AGENT_3_CASCADE", "false").lower() == "true",
+            min_confidence=float(os.getenv("AGENT_3_CASCADE_MIN_CONFIDENCE", "0.8")),
+            escalate_all_ratio=float(os.getenv("AGENT_3_CASCADE_ESCALATE_ALL_RATIO", "0.6")),
+        )
+
+
+def split_decisions(decisions, candidate_ids: List[str], local_ids, policy: CascadePolicy) -> tuple[List, List]:
+    """
+    Split triage decisions into (confidently relevant page ids, page ids to escalate).
+
+    Candidates the worker model left out of its answer count as ambiguous. When the ambiguous share exceeds
+    `policy.escalate_all_ratio` every candidate is escalated, so the planner sees the full picture.
+    """
+    decided = {}
+    for decision in decisions:
+        page_id = local_ids.resolve(decision.id)
+        if page_id in candidate_ids:
+            decided[page_id] = decision
+
+    relevant, ambiguous = [], []
+    for page_id in candidate_ids:
+        decision = decided.get(page_id)
+        if decision is None or decision.confidence < policy.min_confidence:
+            ambiguous.append(page_id)
+        elif decision.relevant:
+            relevant.append(page_id)
+
+    if candidate_ids and len(ambiguous) / len(candidate_ids) > policy.escalate_all_ratio:
+        return [], list(candidate_ids)
+    return relevant, ambiguous
+
+
+class CascadeStats:
+    """Process-wide escalation rate and per-tier latency of the agent 3 cascade."""
+
+    def __init__(self, window: int = 1000):
+        self.runs = 0
+        self.escalated_runs = 0
+        self.candidates = 0
+        self.escalated_candidates = 0
+        self.latency: Dict[str, deque] = {'worker': deque(maxlen=window), 'planner': deque(maxlen=window)}
+
+    def record(self, candidates: int, escalated: int, worker_seconds: float, planner_seconds: float | None):
+        self.runs += 1
+        self.candidates += candidates
+        self.escalated_candidates += escalated
+        self.latency['worker'].append(worker_seconds)
+        if planner_seconds is not None:
+            self.escalated_runs += 1
+            self.latency['planner'].append(planner_seconds)
+
+    def stats(self) -> Dict:
+        return {
+            'runs': self.runs,
+            'escalation_rate': self.escalated_runs / self.runs if self.runs else 0.0,
+            'candidate_escalation_rate': self.escalated_candidates / self.candidates if self.candidates else 0.0,
+            'latency': {tier: summarize_latencies(samples) for tier, samples in self.latency.items()},
+        }
+
+
+cascade_stats = CascadeStats()
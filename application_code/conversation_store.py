@@ -0,0 +1,137 @@
+"""
+Per-conversation retrieval state shared across chat turns.
+
+A conversation keeps a `RetrievalCache` with the Confluence pages it downloaded, the results of every CQL query it
+ran and its vector hits per query, plus the pages the last turn selected. Follow-up turns reuse all of it: repeated CQL
+queries and vector searches are answered from memory, downloads of known pages skip the MCP server, and the previously
+selected pages are offered to agent 3 again so a follow-up can extend the existing context instead of starting from
+scratch.
+
+Conversations expire after a TTL and the least recently used ones are evicted once the store grows beyond its memory
+cap. State lives in the process; with several server workers a follow-up only benefits when it lands on the same
+worker.
+
+Configuration (environment):
+    CONVERSATION_STORE_TTL_SECONDS      idle time after which a conversation is forgotten (default 3600)
+    CONVERSATION_STORE_MAX_MB           approximate memory cap for all conversations (default 256)
+    CONVERSATION_MAX_PAGES              downloaded pages kept per conversation, oldest dropped first (default 50)
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from llm_cache import normalize_query
+from retrieval_cache import RetrievalCache
+
+
+@dataclass
+class ConversationContext:
+    conversation_id: str
+    retrieval: RetrievalCache = field(default_factory=RetrievalCache)
+    turns: List[str] = field(default_factory=list)
+    selected_pages: Dict[str, Dict] = field(default_factory=dict)
+    last_access: float = field(default_factory=time.monotonic)
+
+    def approximate_size(self) -> int:
+        """Rough size in bytes, dominated by page contents."""
+        size = self.retrieval.approximate_size() + len(str(self.selected_pages))
+        return size + sum(len(turn) for turn in self.turns)
+
+
+class ConversationStore:
+    """
+    In-process conversations with idle TTL and LRU eviction under an approximate memory cap.
+
+    Contexts owned by someone else (a batch run sharing one retrieval cache across its queries) can be attached for
+    the duration of their run; they are visible to the agents but never expire or count towards the memory cap.
+    """
+
+    def __init__(self, ttl_seconds: float, max_bytes: int, max_pages: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self._conversations: "OrderedDict[str, ConversationContext]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._attached: Dict[str, ConversationContext] = {}
+
+    def get(self, conversation_id: str | None, create: bool = False) -> ConversationContext | None:
+        if conversation_id is None:
+            return None
+        if conversation_id in self._attached:
+            return self._attached[conversation_id]
+        self._expire()
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None and create:
+            conversation = ConversationContext(conversation_id, retrieval=RetrievalCache(max_pages=self.max_pages))
+            self._conversations[conversation_id] = conversation
+        if conversation is not None:
+            conversation.last_access = time.monotonic()
+            self._conversations.move_to_end(conversation_id)
+        return conversation
+
+    def attach(self, conversation: ConversationContext):
+        self._attached[conversation.conversation_id] = conversation
+
+    def detach(self, conversation_id: str):
+        self._attached.pop(conversation_id, None)
+
+    def finish_turn(self, conversation: ConversationContext, user_query: str):
+        """Record the turn and re-apply the memory cap with the conversation's new size."""
+        conversation.turns.append(user_query)
+        if conversation.conversation_id in self._attached:
+            return
+        self._sizes[conversation.conversation_id] = conversation.approximate_size()
+        while sum(self._sizes.values()) > self.max_bytes and len(self._conversations) > 1:
+            evicted_id, _ = self._conversations.popitem(last=False)
+            self._sizes.pop(evicted_id, None)
+            print(f"Evicted conversation {evicted_id} to stay under the conversation store memory cap.")
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl_seconds
+        while self._conversations:
+            conversation_id, conversation = next(iter(self._conversations.items()))
+            if conversation.last_access >= deadline:
+                break
+            self._conversations.popitem(last=False)
+            self._sizes.pop(conversation_id, None)
+
+    def stats(self) -> Dict:
+        self._expire()
+        return {
+            'conversations': len(self._conversations),
+            'attached': len(self._attached),
+            'approximate_bytes': sum(self._sizes.values()),
+        }
+
+
+def first_user_message(history) -> str | None:
+    """First user message of a Gradio chat history, in either the `messages` or the tuples format."""
+    for entry in history or []:
+        if isinstance(entry, dict):
+            if entry.get('role') == 'user':
+                return str(entry.get('content'))
+        elif isinstance(entry, (list, tuple)) and entry:
+            return str(entry[0])
+    return None
+
+
+def make_conversation_id(user_query: str, history=None, user_id: str | None = None) -> str | None:
+    """
+    Stable id for a conversation: the user's session plus the conversation's first question. Without a user id
+    there is nothing to keep two users apart, so no conversation state is used.
+    """
+    if not user_id:
+        return None
+    opening = first_user_message(history) or user_query
+    return hashlib.sha256(f"{user_id}\n{normalize_query(opening)}".encode("utf-8")).hexdigest()[:32]
+
+
+conversation_store = ConversationStore(
+    ttl_seconds=float(os.getenv("CONVERSATION_STORE_TTL_SECONDS", "3600")),
+    max_bytes=int(float(os.getenv("CONVERSATION_STORE_MAX_MB", "256")) * 2 ** 20),
+    max_pages=int(os.getenv("CONVERSATION_MAX_PAGES", "50")),
+)
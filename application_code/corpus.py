@@ -0,0 +1,47 @@
+"""Helpers for reading the locally ingested Confluence mirror."""
+
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterator
+
+INGESTION_FOLDER = Path(__file__).parent / "ingestion_docs"
+
+_FILE_NAME_PATTERN = re.compile(r"^(\d+)_\s*(.*)\.txt$")
+
+
+def parse_ingested_file_name(file_name: str) -> tuple[str, str] | None:
+    """Split an ingested `<page_id>_<title>.txt` file name into (page_id, title)."""
+    match = _FILE_NAME_PATTERN.match(file_name)
+    if not match:
+        return None
+    return match.group(1), match.group(2).strip()
+
+
+def iter_ingested_pages(folder: str | os.PathLike = INGESTION_FOLDER) -> Iterator[Dict]:
+    """
+    Yield every ingested page as a dict with page_id, title, text and path. `folder` may also be a Parquet export
+    written by ingestion_prep.py, which is read through memory maps.
+    """
+    if Path(folder).suffix == '.parquet' or any(Path(folder).glob("part-*.parquet")):
+        from ingestion_prep import iter_exported_pages
+
+        yield from iter_exported_pages(folder)
+        return
+
+    for file_name in sorted(os.listdir(folder)):
+        parsed = parse_ingested_file_name(file_name)
+        if parsed is None:
+            continue
+
+        page_id, title = parsed
+        path = Path(folder) / file_name
+        with open(path, mode='r', encoding='utf-8') as file:
+            text = file.read().strip()
+
+        yield {
+            'page_id': page_id,
+            'title': title,
+            'text': text,
+            'path': str(path),
+        }
@@ -0,0 +1,292 @@
+"""
+Local inverted index over the ingested Confluence mirror, answering agent 1's CQL queries without the MCP server.
+
+`ingestion.py` mirrors the space as `<page_id>_<title>.txt` files. This module indexes them into compact postings
+(one vocabulary, flat `int32` arrays of document ids and term frequencies addressed by per-term offsets, separately for
+page text and titles) and evaluates the subset of CQL agent 1 generates:
+
+    siteSearch ~ "..."      pages containing any of the terms, ranked by BM25 over title and text
+    text ~ "..."            pages containing all of the terms, ranked by BM25 over the text
+    title ~ "..."           pages whose title contains all of the terms, ranked by BM25 over titles
+    type = page             every page (the mirror only holds pages)
+    AND, OR, NOT and parentheses; scores of combined clauses add up
+
+Anything else (spaces, labels, dates, `ORDER BY`, wildcards, other content types) raises `UnsupportedCQLError`, and the
+caller sends that query to live Confluence instead. Results have the shape of the Confluence search API response that
+`agents_helper.parse_cql_search_result` expects, including highlighted excerpts and scores.
+
+Configuration (environment):
+    CQL_BACKEND         "confluence" (default) or "local", see agents_helper.search_confluence_with_cql_queries
+"""
+
+import functools
+import math
+import os
+import re
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from corpus import INGESTION_FOLDER, iter_ingested_pages
+from kb_local import tokenize
+
+# Confluence ignores these in text searches; without them "siteSearch" would match nearly every page.
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it", "of", "on", "or", "that",
+    "the", "to", "was", "what", "which", "with",
+}
+DEFAULT_LIMIT = 10
+
+_TOKEN_PATTERN = re.compile(
+    r"""\s*(?:(?P<paren>[()])|(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(?P<operator>!~|~|!=|=)"""
+    r"""|(?P<word>[A-Za-z_][\w.]*))"""
+)
+
+
+class UnsupportedCQLError(ValueError):
+    """The query uses CQL the local index cannot evaluate; it has to go to Confluence."""
+
+
+def search_terms(value: str) -> List[str]:
+    return [term for term in tokenize(value) if term not in STOP_WORDS]
+
+
+class FieldIndex:
+    """Postings of one field in CSR layout: the postings of term `t` are `doc_ids[offsets[t]:offsets[t + 1]]`."""
+
+    def __init__(self, documents: Sequence[Sequence[str]], vocabulary: Dict[str, int], k1: float = 1.2,
+                 b: float = 0.75):
+        self.k1 = k1
+        self.document_count = len(documents)
+        postings: List[List[Tuple[int, int]]] = [[] for _ in vocabulary]
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for document_id, tokens in enumerate(documents):
+            lengths[document_id] = len(tokens)
+            counts: Dict[int, int] = {}
+            for token in tokens:
+                term_id = vocabulary[token]
+                counts[term_id] = counts.get(term_id, 0) + 1
+            for term_id, count in counts.items():
+                postings[term_id].append((document_id, count))
+
+        self.offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(entries) for entries in postings])
+        flat = [entry for entries in postings for entry in entries]
+        self.doc_ids = np.array([document_id for document_id, _ in flat], dtype=np.int32)
+        self.term_freqs = np.array([count for _, count in flat], dtype=np.int32)
+        average_length = float(lengths.mean()) if len(documents) else 1.0
+        self.length_norm = 1 - b + b * lengths / max(average_length, 1.0)
+
+    def postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.doc_ids[start:end], self.term_freqs[start:end]
+
+    def bm25(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Ids of the documents containing the term and their BM25 contribution."""
+        doc_ids, term_freqs = self.postings(term_id)
+        document_frequency = len(doc_ids)
+        idf = math.log(1 + (self.document_count - document_frequency + 0.5) / (document_frequency + 0.5))
+        tf = term_freqs.astype(np.float32)
+        return doc_ids, idf * tf * (self.k1 + 1) / (tf + self.k1 * self.length_norm[doc_ids])
+
+
+class CQLIndex:
+    """Inverted index over the ingested pages plus an evaluator for the CQL subset described in the module doc."""
+
+    def __init__(self, pages: Sequence[Dict]):
+        self.pages = list(pages)
+        text_tokens = [tokenize(page['text']) for page in self.pages]
+        title_tokens = [tokenize(page['title']) for page in self.pages]
+        self.vocabulary: Dict[str, int] = {}
+        for tokens in text_tokens + title_tokens:
+            for token in tokens:
+                self.vocabulary.setdefault(token, len(self.vocabulary))
+        self.text = FieldIndex(text_tokens, self.vocabulary)
+        self.title = FieldIndex(title_tokens, self.vocabulary)
+        self.last_modified = [_file_timestamp(page.get('path')) for page in self.pages]
+
+    @classmethod
+    def from_folder(cls, folder: str | os.PathLike = INGESTION_FOLDER) -> "CQLIndex":
+        return cls(list(iter_ingested_pages(folder)))
+
+    def _field_scores(self, fields: Sequence[FieldIndex], terms: Sequence[str], match_all: bool):
+        size = len(self.pages)
+        scores = np.zeros(size, dtype=np.float32)
+        matched = np.ones(size, dtype=bool) if match_all else np.zeros(size, dtype=bool)
+        if not terms:
+            return np.zeros(size, dtype=bool), scores
+        for term in terms:
+            term_id = self.vocabulary.get(term)
+            in_any_field = np.zeros(size, dtype=bool)
+            if term_id is not None:
+                for field in fields:
+                    doc_ids, contribution = field.bm25(term_id)
+                    scores[doc_ids] += contribution
+                    in_any_field[doc_ids] = True
+            matched = matched & in_any_field if match_all else matched | in_any_field
+        return matched, np.where(matched, scores, 0)
+
+    def _evaluate_clause(self, field: str, operator: str, value: str):
+        if operator == '~' and any(character in value for character in '*?'):
+            raise UnsupportedCQLError(f"Wildcard search {value!r} is not supported locally")
+        if field == 'sitesearch' and operator == '~':
+            return self._field_scores([self.text, self.title], search_terms(value), match_all=False)
+        if field == 'text' and operator == '~':
+            return self._field_scores([self.text], search_terms(value), match_all=True)
+        if field == 'title' and operator == '~':
+            return self._field_scores([self.title], search_terms(value), match_all=True)
+        if field == 'type' and operator == '=' and value.lower() == 'page':
+            return np.ones(len(self.pages), dtype=bool), np.zeros(len(self.pages), dtype=np.float32)
+        raise UnsupportedCQLError(f"Clause {field} {operator} {value!r} is not supported locally")
+
+    def evaluate(self, cql: str) -> Tuple[np.ndarray, np.ndarray]:
+        """(matching pages mask, scores) for a CQL query."""
+        return _Evaluator(self, parse_tokens(cql)).run()
+
+    def search(self, cql: str, start: int = 0, limit: int = DEFAULT_LIMIT) -> Dict:
+        """Results of `cql` in the shape of Confluence's search API (`confluence.cql`)."""
+        matched, scores = self.evaluate(cql)
+        ranked = sorted(np.flatnonzero(matched), key=lambda index: (-scores[index], index))
+        terms = search_terms(" ".join(value for value in _quoted_values(cql)))
+        results = []
+        for index in ranked[start:start + limit]:
+            page = self.pages[index]
+            results.append({
+                'content': {'id': page['page_id'], 'type': 'page', 'title': page['title']},
+                'title': page['title'],
+                'excerpt': excerpt(page['text'], terms),
+                'url': f"/pages/viewpage.action?pageId={page['page_id']}",
+                'lastModified': self.last_modified[index],
+                'score': float(scores[index]),
+            })
+        return {'results': results, 'start': start, 'limit': limit, 'size': len(results), 'totalSize': len(ranked)}
+
+    def supports(self, cql: str) -> bool:
+        try:
+            self.evaluate(cql)
+        except UnsupportedCQLError:
+            return False
+        return True
+
+
+class _Evaluator:
+    """Recursive descent over `or_expr := and_expr (OR and_expr)*`, `and_expr := unary (AND unary)*`."""
+
+    def __init__(self, index: CQLIndex, tokens: List[Tuple[str, str]]):
+        self.index = index
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Tuple[str, str] | None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, kind: str | None = None) -> Tuple[str, str]:
+        token = self.peek()
+        if token is None or (kind is not None and token[0] != kind):
+            raise UnsupportedCQLError(f"Unexpected {'end of query' if token is None else token[1]!r}")
+        self.position += 1
+        return token
+
+    def is_keyword(self, keyword: str) -> bool:
+        token = self.peek()
+        return token is not None and token[0] == 'word' and token[1].upper() == keyword
+
+    def run(self):
+        result = self.or_expr()
+        if self.peek() is not None:
+            raise UnsupportedCQLError(f"Unsupported CQL from {self.peek()[1]!r}")
+        return result
+
+    def or_expr(self):
+        matched, scores = self.and_expr()
+        while self.is_keyword('OR'):
+            self.take()
+            other_matched, other_scores = self.and_expr()
+            matched, scores = matched | other_matched, scores + other_scores
+        return matched, scores
+
+    def and_expr(self):
+        matched, scores = self.unary()
+        while self.is_keyword('AND'):
+            self.take()
+            other_matched, other_scores = self.unary()
+            matched = matched & other_matched
+            scores = np.where(matched, scores + other_scores, 0)
+        return matched, scores
+
+    def unary(self):
+        if self.is_keyword('NOT'):
+            self.take()
+            matched, _ = self.unary()
+            return ~matched, np.zeros(len(matched), dtype=np.float32)
+        if self.peek() == ('paren', '('):
+            self.take()
+            result = self.or_expr()
+            if self.take('paren')[1] != ')':
+                raise UnsupportedCQLError("Unbalanced parentheses")
+            return result
+        field = self.take('word')[1]
+        operator = self.take('operator')[1]
+        kind, value = self.take()
+        if kind not in ('string', 'word'):
+            raise UnsupportedCQLError(f"Unexpected {value!r} after {field} {operator}")
+        return self.index._evaluate_clause(field.lower(), operator, _unquote(value) if kind == 'string' else value)
+
+
+@functools.lru_cache(maxsize=1024)
+def _tokens(cql: str) -> Tuple[Tuple[str, str], ...]:
+    tokens = []
+    position = 0
+    cql = cql.strip()
+    while position < len(cql):
+        match = _TOKEN_PATTERN.match(cql, position)
+        if match is None or match.end() == position:
+            raise UnsupportedCQLError(f"Cannot parse CQL at {cql[position:]!r}")
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tuple(tokens)
+
+
+def parse_tokens(cql: str) -> List[Tuple[str, str]]:
+    """Tokens of a CQL query as (kind, text) pairs, kinds being paren, string, operator and word."""
+    return list(_tokens(cql))
+
+
+def _unquote(value: str) -> str:
+    return re.sub(r"\\(.)", r"\1", value[1:-1])
+
+
+def _quoted_values(cql: str) -> List[str]:
+    try:
+        return [_unquote(text) for kind, text in _tokens(cql) if kind == 'string']
+    except UnsupportedCQLError:
+        return []
+
+
+def excerpt(text: str, terms: Sequence[str], width: int = 240) -> str:
+    """Snippet around the first matched term with Confluence's `@@@hl@@@` highlight markers."""
+    lowered = text.lower()
+    positions = [match.start() for term in terms for match in [re.search(rf"\b{re.escape(term)}\b", lowered)] if match]
+    start = max(0, min(positions) - width // 4) if positions else 0
+    snippet = " ".join(text[start:start + width].split())
+    for term in set(terms):
+        snippet = re.sub(rf"(?i)\b({re.escape(term)})\b", r"@@@hl@@@\1@@@endhl@@@", snippet)
+    return snippet
+
+
+def _file_timestamp(path: str | None) -> str:
+    modified = os.path.getmtime(path) if path and os.path.exists(path) else 0
+    return datetime.fromtimestamp(modified, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+@functools.cache
+def get_cql_index(folder: str | None = None) -> CQLIndex | None:
+    """Index of the ingested mirror, built once per process, or None when there is no mirror to index."""
+    folder = Path(folder) if folder else INGESTION_FOLDER
+    if not folder.is_dir():
+        return None
+    index = CQLIndex.from_folder(folder)
+    print(f"Indexed {len(index.pages)} ingested pages ({len(index.vocabulary)} terms) for local CQL search.")
+    return index
@@ -0,0 +1,223 @@
+"""
+Planner between agent 1's generated CQL and the searches that answer it (see
+agents_helper.search_confluence_with_cql_queries).
+
+Agent 1 generates several queries per question, often repeating a phrase or rewording the same terms, and each query
+used to be a separate search returning a full page of results. The planner
+    - normalizes every query (whitespace, keyword case, lowercased search terms) and drops duplicates, including
+      `siteSearch` phrases that only differ in word order, case or stop words,
+    - folds the single-clause `siteSearch ~ "..."` queries into OR-combined queries of up to CQL_PLANNER_MAX_CLAUSES
+      clauses,
+    - filters by content type in the CQL itself (`type = page`), so attachments are never returned instead of being
+      dropped by title afterwards,
+    - gives every planned query a page budget: the next page of results is only requested while a page comes back full
+      and its lowest score is still at least CQL_PAGING_SCORE_RATIO of the top score. A folded query never makes more
+      requests than the queries it replaces.
+
+Queries the planner cannot parse (see cql_index.parse_tokens) are sent as generated, with whitespace collapsed.
+
+Configuration (environment):
+    CQL_PLANNER                 "true" (default) to plan generated queries, "false" to send them as generated
+    CQL_PLANNER_MAX_CLAUSES     siteSearch clauses folded into one query (default 4)
+    CQL_PAGE_SIZE               results requested per page (default 10)
+    CQL_MAX_PAGES               pages fetched for one planned query at most (default 3)
+    CQL_PAGING_SCORE_RATIO      lowest score of a full page, relative to the top score, that fetches the next page
+                                (default 0.5)
+"""
+
+import os
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Sequence, Tuple
+
+from cql_index import UnsupportedCQLError, parse_tokens, search_terms, _unquote
+
+KEYWORDS = {"AND", "OR", "NOT", "IN", "ORDER", "BY", "ASC", "DESC"}
+TEXT_FIELDS = {"sitesearch", "text", "title"}
+TYPE_FILTER = "type = page"
+
+
+@dataclass
+class PlannedQuery:
+    cql: str
+    generated: List[str] = field(default_factory=list)  # The generated queries this one answers.
+    max_pages: int = 1
+
+
+@dataclass
+class CQLPlan:
+    queries: List[PlannedQuery]
+    generated: int
+    duplicates: int = 0
+
+    def report(self) -> Dict:
+        return {
+            'generated': self.generated,
+            'duplicates': self.duplicates,
+            'planned': len(self.queries),
+            'queries': [query.cql for query in self.queries],
+        }
+
+
+def planner_enabled() -> bool:
+    return os.getenv("CQL_PLANNER", "true").lower() == "true"
+
+
+def max_folded_clauses() -> int:
+    return max(1, int(os.getenv("CQL_PLANNER_MAX_CLAUSES", "4")))
+
+
+def page_size() -> int:
+    return max(1, int(os.getenv("CQL_PAGE_SIZE", "10")))
+
+
+def max_pages() -> int:
+    return max(1, int(os.getenv("CQL_MAX_PAGES", "3")))
+
+
+def paging_score_ratio() -> float:
+    return float(os.getenv("CQL_PAGING_SCORE_RATIO", "0.5"))
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _normalized_tokens(cql: str) -> List[Tuple[str, str]]:
+    """Tokens with keywords upper-cased, `siteSearch` spelled one way and search terms lower-cased and re-quoted."""
+    tokens = []
+    for kind, text in parse_tokens(cql):
+        if kind == 'word' and text.upper() in KEYWORDS:
+            text = text.upper()
+        elif kind == 'word' and text.lower() == 'sitesearch':
+            text = 'siteSearch'
+        elif kind == 'word' and len(tokens) >= 2 and tokens[-2] == ('word', 'type'):
+            text = text.lower()
+        elif kind == 'string' and len(tokens) >= 2 and tokens[-1] == ('operator', '~') \
+                and tokens[-2][0] == 'word' and tokens[-2][1].lower() in TEXT_FIELDS:
+            text = _quote(" ".join(_unquote(text).lower().split()))
+        tokens.append((kind, text))
+    return tokens
+
+
+def _join(tokens: Sequence[Tuple[str, str]]) -> str:
+    cql = " ".join(text for _, text in tokens)
+    return cql.replace("( ", "(").replace(" )", ")")
+
+
+def normalize_cql(cql: str) -> str:
+    try:
+        return _join(_normalized_tokens(cql))
+    except UnsupportedCQLError:
+        return " ".join(cql.split())
+
+
+def _site_search_phrase(tokens: List[Tuple[str, str]]) -> str | None:
+    """The phrase of a `siteSearch ~ "..."` query, with or without a page type filter; None for any other query."""
+    type_filter = [('word', 'AND'), ('word', 'type'), ('operator', '='), ('word', 'page')]
+    if tokens[-4:] == type_filter:
+        tokens = tokens[:-4]
+    if len(tokens) == 3 and tokens[0] == ('word', 'siteSearch') and tokens[1] == ('operator', '~') \
+            and tokens[2][0] == 'string':
+        return _unquote(tokens[2][1])
+    return None
+
+
+def _with_type_filter(tokens: List[Tuple[str, str]]) -> str:
+    cql = _join(tokens)
+    # Queries that already pick a content type, or sort (the filter would have to go before ORDER BY), stay as they are.
+    if any(kind == 'word' and text in ('type', 'ORDER') for kind, text in tokens):
+        return cql
+    return f"({cql}) AND {TYPE_FILTER}"
+
+
+def plan_cql_queries(cql_queries: Sequence[str]) -> CQLPlan:
+    """Deduplicate, fold and filter agent 1's queries into the queries actually sent."""
+    if not planner_enabled():
+        return CQLPlan([PlannedQuery(query, [query]) for query in cql_queries], len(cql_queries))
+
+    phrases: Dict[frozenset, Tuple[str, List[str]]] = {}
+    others: Dict[str, List[str]] = {}
+    for query in cql_queries:
+        try:
+            tokens = _normalized_tokens(query)
+        except UnsupportedCQLError:
+            others.setdefault(" ".join(query.split()), []).append(query)
+            continue
+        phrase = _site_search_phrase(tokens) if tokens else None
+        if phrase is not None and search_terms(phrase):
+            # siteSearch matches any of the terms, so their order, case and stop words do not change the results.
+            phrases.setdefault(frozenset(search_terms(phrase)), (phrase, []))[1].append(query)
+        elif tokens:
+            others.setdefault(_with_type_filter(tokens), []).append(query)
+
+    planned = []
+    grouped = list(phrases.values())
+    clauses = max_folded_clauses()
+    for position in range(0, len(grouped), clauses):
+        group = grouped[position:position + clauses]
+        folded = " OR ".join(f"siteSearch ~ {_quote(phrase)}" for phrase, _ in group)
+        cql = f"({folded}) AND {TYPE_FILTER}" if len(group) > 1 else f"{folded} AND {TYPE_FILTER}"
+        generated = [query for _, queries in group for query in queries]
+        planned.append(PlannedQuery(cql, generated, min(len(group), max_pages())))
+    for cql, generated in others.items():
+        planned.append(PlannedQuery(cql, generated, 1))
+
+    plan = CQLPlan(planned, len(cql_queries), len(cql_queries) - len(phrases) - len(others))
+    planner_stats.record_plan(plan)
+    return plan
+
+
+async def fetch_planned_query(
+    query: PlannedQuery, fetch_page: Callable[[int, int], Awaitable[List[Dict]]]
+) -> List[Dict]:
+    """
+    Results of a planned query, fetching `fetch_page(start, limit)` page by page within the query's page budget while
+    the pages come back full of high-scoring results.
+    """
+    limit, ratio = page_size(), paging_score_ratio()
+    results: List[Dict] = []
+    for page_number in range(query.max_pages):
+        page = await fetch_page(page_number * limit, limit)
+        planner_stats.record_page(next_page=page_number > 0)
+        results.extend(page)
+        if len(page) < limit or not results:
+            break
+        top_score = results[0]['match_score']
+        if top_score <= 0 or page[-1]['match_score'] < ratio * top_score:
+            break
+    return results
+
+
+class PlannerStats:
+    """Process-wide counts of the queries agent 1 generated, the queries planned from them and the pages fetched."""
+
+    def __init__(self):
+        self.plans = 0
+        self.generated = 0
+        self.duplicates = 0
+        self.planned = 0
+        self.pages = 0
+        self.next_pages = 0
+
+    def record_plan(self, plan: CQLPlan):
+        self.plans += 1
+        self.generated += plan.generated
+        self.duplicates += plan.duplicates
+        self.planned += len(plan.queries)
+
+    def record_page(self, next_page: bool):
+        self.pages += 1
+        self.next_pages += next_page
+
+    def stats(self) -> Dict:
+        return {
+            'plans': self.plans,
+            'generated_queries': self.generated,
+            'duplicate_queries': self.duplicates,
+            'planned_queries': self.planned,
+            'pages_fetched': self.pages,
+            'next_pages_fetched': self.next_pages,
+        }
+
+
+planner_stats = PlannerStats()
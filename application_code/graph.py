@@ -1,20 +1,18 @@
+import argparse
 import asyncio
+import functools
 import json
+import os
 import uuid
 from contextlib import asynccontextmanager
 
-from langfuse._client.client import Langfuse
-from langgraph.graph import StateGraph, START, END
-from agents import (
-    agent_1_generate_cql,
-    agent_2_search_vector_db,
-    agent_3_confluence_filter_pages,
-    agent_4_vector_db_filter_records,
-    agent_5_summarize_the_answer
-)
 from graph_state import RAGState
-from langfuse import get_client
 from agents_helper import CustomEncoder
+from blob_store import blob_stores
+from conversation_store import conversation_store, make_conversation_id
+from profiling import profile_request, span as profile_span
+from resilience import MCP, WEAVIATE, circuit_open
+from tracking import get_langfuse_client
 
 # Node constants
 NODE_1 = "CQL_GENERATION_AGENT"
@@ -27,63 +25,102 @@ NODE_5 = "ANSWER_GENERATION_AGENT"
 @asynccontextmanager
 async def async_resource_manager():
     print("Acquiring asynchronous resource...")
-    langfuse_client: Langfuse = get_client()
+    langfuse_client = get_langfuse_client()
     try:
         yield langfuse_client
     finally:
         print("Releasing asynchronous resource...")
         if langfuse_client:
+            # The client is a process-wide singleton shared by concurrent requests, so only flush here.
+            # Langfuse shuts it down through its own atexit hook when the process exits.
             langfuse_client.flush()
-            langfuse_client.shutdown()
 
 
 def route_to_start_nodes(state: RAGState):
     """
     Conditional entry point that determines which initial nodes to execute.
     Returns a list of nodes to start with parallel execution.
-    """
-    # You can add logic here to conditionally choose starting nodes based on state
-    # For now, returning both nodes for parallel execution
-    return [NODE_1, NODE_2]
-
-
-# Create the StateGraph
-builder = StateGraph(RAGState)
-
-# Add all nodes
-builder.add_node(NODE_1, agent_1_generate_cql)
-builder.add_node(NODE_2, agent_2_search_vector_db)
-builder.add_node(NODE_3, agent_3_confluence_filter_pages)
-builder.add_node(NODE_4, agent_4_vector_db_filter_records)
-builder.add_node(NODE_5, agent_5_summarize_the_answer, defer=True)
-
-# Conditional entry point for parallel execution
-builder.add_conditional_edges(
-    START,
-    route_to_start_nodes,
-    {
-        NODE_1: NODE_1,
-        NODE_2: NODE_2
-    }
-)
-
-# Sequential edges within each path
-builder.add_edge(NODE_1, NODE_3)  # CQL generation -> Confluence filtering
-builder.add_edge(NODE_2, NODE_4)  # Vector search -> Vector filtering
-
-# Both filtered results go to answer generation
-builder.add_edge(NODE_3, NODE_5)
-builder.add_edge(NODE_4, NODE_5)
-
-# Answer generation goes to end
-builder.add_edge(NODE_5, END)
-
-# Compile the workflow
-confluence_workflow = builder.compile()
 
-
-async def execute_user_query(user_query: str, history=None):
+    A branch whose dependency has an open circuit (see resilience.py) is skipped rather than left to time out: the
+    Confluence branch needs the MCP server, the vector branch Weaviate. With both down the answer node runs directly.
+    """
+    nodes = []
+    if not circuit_open(MCP):
+        nodes.append(NODE_1)
+    if not circuit_open(WEAVIATE):
+        nodes.append(NODE_2)
+    if not nodes:
+        print("MCP server and Weaviate circuits are open, answering without retrieval.")
+    return nodes or [NODE_5]
+
+
+@functools.cache
+def get_confluence_workflow():
+    """
+    Build and compile the StateGraph on first use. langgraph and the agents (langchain, prompts, MCP and Weaviate
+    helpers) are imported here rather than at module import, so entry points start quickly.
+    """
+    from langgraph.graph import StateGraph, START, END
+    from agents import (
+        agent_1_generate_cql,
+        agent_2_search_vector_db,
+        agent_3_confluence_filter_pages,
+        agent_4_vector_db_filter_records,
+        agent_5_summarize_the_answer
+    )
+
+    # Create the StateGraph
+    builder = StateGraph(RAGState)
+
+    # Add all nodes
+    builder.add_node(NODE_1, agent_1_generate_cql)
+    builder.add_node(NODE_2, agent_2_search_vector_db)
+    builder.add_node(NODE_3, agent_3_confluence_filter_pages)
+    builder.add_node(NODE_4, agent_4_vector_db_filter_records)
+    builder.add_node(NODE_5, agent_5_summarize_the_answer, defer=True)
+
+    # Conditional entry point for parallel execution
+    builder.add_conditional_edges(
+        START,
+        route_to_start_nodes,
+        {
+            NODE_1: NODE_1,
+            NODE_2: NODE_2,
+            NODE_5: NODE_5
+        }
+    )
+
+    # Sequential edges within each path
+    builder.add_edge(NODE_1, NODE_3)  # CQL generation -> Confluence filtering
+    builder.add_edge(NODE_2, NODE_4)  # Vector search -> Vector filtering
+
+    # Both filtered results go to answer generation
+    builder.add_edge(NODE_3, NODE_5)
+    builder.add_edge(NODE_4, NODE_5)
+
+    # Answer generation goes to end
+    builder.add_edge(NODE_5, END)
+
+    # Compile the workflow
+    return builder.compile()
+
+
+def preload():
+    """Import and compile everything a first request needs, without creating any network clients."""
+    get_confluence_workflow()
+
+
+async def execute_user_query(user_query: str, history=None, user_id: str | None = None,
+                             conversation_id: str | None = None, profile: bool | None = None):
+    """
+    Stream the graph's updates for one chat turn. Turns of the same conversation (an explicit `conversation_id`, or
+    the user's session plus the conversation's first question) share retrieved pages, CQL results and vector hits.
+    With `profile` (default PROFILE_REQUESTS) the turn's timeline is written as a trace file, see profiling.py.
+    """
     print(f"Graph getting invoked with history {history} \n\n")
+    conversation = conversation_store.get(
+        conversation_id or make_conversation_id(user_query, history, user_id), create=True
+    )
 
     async with async_resource_manager() as res:
         with res.start_as_current_span(name="Confluence workflow", input=user_query) as span:
@@ -93,6 +130,7 @@ async def execute_user_query(user_query: str, history=None):
             print(f"Starting graph with sessionId {session_id} and user query {user_query}.")
             state = RAGState(
                 session_id=session_id,
+                conversation_id=conversation.conversation_id if conversation else None,
                 user_query=user_query,
                 confluence_response={},  # Empty list instead of None
                 filtered_pages=[],  # Empty list instead of None
@@ -104,21 +142,36 @@ async def execute_user_query(user_query: str, history=None):
 
             # Uncomment this code to run directly....
             """
-            response = await confluence_workflow.ainvoke(input=state)
+            response = await get_confluence_workflow().ainvoke(input=state)
             print(f"Answer to the user query is {response}.")
             """
 
-            async for chunk in confluence_workflow.astream(input=state, stream_mode="updates"):
-                print(f"Got update from the state {chunk}.")
-                span.update(output=chunk)
-                yield json.dumps(chunk, indent=2, cls=CustomEncoder)
+            # Page contents stay in the run's blob store; the state and the streamed updates only reference them.
+            with blob_stores.scope(session_id), profile_request(session_id, enabled=profile) as request_profile:
+                config = {'callbacks': [request_profile.callback_handler()]} if request_profile else None
+                async for chunk in get_confluence_workflow().astream(input=state, config=config,
+                                                                     stream_mode="updates"):
+                    print(f"Got update from the state {chunk}.")
+                    span.update(output=chunk)
+                    with profile_span("encode update", 'json'):
+                        encoded = json.dumps(chunk, indent=2, cls=CustomEncoder)
+                    yield encoded
+
+            if conversation is not None:
+                conversation_store.finish_turn(conversation, user_query)
 
 
 if __name__ == '__main__':
-    async def main():
-        test_query = "What is Maple trust bank?"
+    parser = argparse.ArgumentParser(description="Run one query through the graph.")
+    parser.add_argument("query", nargs="?", default="What is Maple trust bank?")
+    parser.add_argument("--profile", action="store_true", help="write the request's trace, see profiling.py")
+    parser.add_argument("--sample", action="store_true", help="also sample the event loop's stacks while profiling")
+    args = parser.parse_args()
+    if args.sample:
+        os.environ["PROFILE_SAMPLING"] = "true"
 
-        async for chunk in execute_user_query(test_query):
+    async def main():
+        async for chunk in execute_user_query(args.query, profile=args.profile or None):
             pass  # Or print(chunk) if you want to see results
 
     asyncio.run(main())
@@ -2,11 +2,31 @@ from typing import TypedDict, Dict, List, Any, Annotated
 
 
 def dict_or_merge(old: Dict, new: Dict) -> Dict:
-    return {k: old.get(k) or new.get(k) for k in set(old) | set(new)}
+    # Entries already in `old` win unless empty. Only `new` is walked, and `old` is returned as is when there is nothing
+    # to add, so merging a small update into a large map does not rebuild it.
+    if not new:
+        return old
+    if not old:
+        return new
+    merged = dict(old)
+    for key, value in new.items():
+        if not merged.get(key):
+            merged[key] = value
+    return merged
+
+
+def add_usage(old: Dict | None, new: Dict | None) -> Dict:
+    # Token usage of an agent, summed over every update that reports it.
+    if not new:
+        return old or {}
+    if not old:
+        return new
+    return {key: old.get(key, 0) + new.get(key, 0) for key in {**old, **new}}
 
 
 class RAGState(TypedDict):
     session_id: str
+    conversation_id: str | None
     user_query: str
     confluence_response: Dict | None
     filtered_pages: List[str] | None
@@ -14,3 +34,16 @@ class RAGState(TypedDict):
     answer: str | None
     cql_queries: List[str] | None
     page_map: Annotated[Dict, dict_or_merge]
+    # Per-agent token usage, streamed with each node's update (batch.py sums it).
+    agent_1_generate_cql_token_usage: Annotated[Dict, add_usage]
+    agent_3_confluence_filter_pages_token_usage: Annotated[Dict, add_usage]
+    agent_4_vector_db_filter_records_token_usage: Annotated[Dict, add_usage]
+    agent_5_summarize_the_answer_token_usage: Annotated[Dict, add_usage]
+    # Input tokens of agent 3's candidate prompts before and after the compact encoding (prompt_encoding.py).
+    agent_3_prompt_encoding: Dict | None
+    # Worker triage and escalation counts of agent 3's cascade (cascade.py), when it is enabled.
+    agent_3_cascade: Dict | None
+    # Near-duplicate candidate clusters agent 3 dropped (near_duplicates.py), None when the filter is off.
+    agent_3_near_duplicates: Dict | None
+    # Queries agent 1 generated and the ones the CQL planner sent instead (cql_planner.py).
+    agent_1_cql_plan: Dict | None
@@ -0,0 +1,159 @@
+"""
+Hedged LLM requests to cut tail latency.
+
+When a call has not returned after the configured percentile of recently observed latency for the same model and
+prompt, a duplicate request is fired; whichever finishes first wins and the other one is cancelled. Hedges are capped
+to a share of recent calls and skipped while the model's rate limiter is already queueing, so hedging never adds load
+to a saturated provider. Extra tokens spent on losing requests are accounted for, so the latency/cost trade-off is
+visible in `hedge_stats.stats()`.
+
+Configuration (environment):
+    LLM_HEDGING                 "true" to enable hedging (default "false")
+    LLM_HEDGING_PERCENTILE      latency percentile after which a hedge is sent (default 95)
+    LLM_HEDGING_MIN_SAMPLES     observations needed per model/prompt before hedging starts (default 20)
+    LLM_HEDGING_MAX_RATIO       maximum share of recent calls that may be hedged (default 0.1)
+"""
+
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict
+
+from metrics import percentile, summarize_latencies
+
+WINDOW = 500
+
+
+@dataclass
+class HedgePolicy:
+    enabled: bool = False
+    percentile: float = 95
+    min_samples: int = 20
+    max_ratio: float = 0.1
+
+    @classmethod
+    def from_env(cls) -> "HedgePolicy":
+        return cls(
+            enabled=os.getenv("LLM_HEDGING", "false").lower() == "true",
+            percentile=float(os.getenv("LLM_HEDGING_PERCENTILE", "95")),
+            min_samples=int(os.getenv("LLM_HEDGING_MIN_SAMPLES", "20")),
+            max_ratio=float(os.getenv("LLM_HEDGING_MAX_RATIO", "0.1")),
+        )
+
+
+class HedgeStats:
+    """Recent latency per model/prompt plus process-wide hedging counters."""
+
+    def __init__(self, window: int = WINDOW):
+        self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self.recent_hedges: deque = deque(maxlen=window)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.extra_tokens: Dict[str, float] = defaultdict(float)
+
+    def hedge_delay(self, key: str, policy: HedgePolicy) -> float | None:
+        samples = self.latencies[key]
+        if len(samples) < policy.min_samples:
+            return None
+        return percentile(samples, policy.percentile)
+
+    def hedge_budget_left(self, policy: HedgePolicy) -> bool:
+        if not self.recent_hedges:
+            return True
+        return sum(self.recent_hedges) / len(self.recent_hedges) < policy.max_ratio
+
+    def record_call(self, key: str, latency: float, hedged: bool, hedge_won: bool):
+        self.calls += 1
+        self.latencies[key].append(latency)
+        self.recent_hedges.append(hedged)
+        if hedged:
+            self.hedges += 1
+        if hedge_won:
+            self.hedge_wins += 1
+
+    def record_extra_tokens(self, token_usage: Dict[str, float]):
+        for name, value in token_usage.items():
+            self.extra_tokens[name] += value or 0
+
+    def stats(self) -> Dict:
+        return {
+            'calls': self.calls,
+            'hedges': self.hedges,
+            'hedge_rate': self.hedges / self.calls if self.calls else 0.0,
+            'hedge_wins': self.hedge_wins,
+            'extra_token_usage': dict(self.extra_tokens),
+            'latency': {key: summarize_latencies(samples) for key, samples in self.latencies.items()},
+        }
+
+
+hedge_stats = HedgeStats()
+
+
+def _attempt_latency(outcome: Dict, elapsed: float) -> float:
+    # Time spent queued in the client-side rate limiter is not provider latency.
+    return max(0.0, elapsed - outcome.get('queue_wait_seconds', 0.0))
+
+
+async def _timed(attempt: Callable[[], Awaitable[Dict]]) -> tuple[Dict, float]:
+    started = time.perf_counter()
+    outcome = await attempt()
+    return outcome, time.perf_counter() - started
+
+
+async def hedged_call(
+    key: str,
+    attempt: Callable[[], Awaitable[Dict[str, Any]]],
+    can_hedge: Callable[[], bool] | None = None,
+    policy: HedgePolicy | None = None,
+) -> Dict[str, Any]:
+    """
+    Run `attempt` (which returns a `run_langchain_expression`-style dict with 'result' and 'token_usage'), firing a
+    duplicate when it is slower than usual. The winner's dict is returned with an extra 'hedge' entry.
+    """
+    policy = policy or HedgePolicy.from_env()
+    primary = asyncio.create_task(_timed(attempt))
+    delay = hedge_stats.hedge_delay(key, policy) if policy.enabled else None
+
+    hedge = None
+    try:
+        if delay is not None:
+            await asyncio.wait({primary}, timeout=delay)
+            if (not primary.done() and hedge_stats.hedge_budget_left(policy)
+                    and (can_hedge is None or can_hedge())):
+                print(f"LLM call {key} slower than p{policy.percentile:g} ({delay:.2f}s), sending a hedged request.")
+                hedge = asyncio.create_task(_timed(attempt))
+
+        racing = {primary} if hedge is None else {primary, hedge}
+        winner = None
+        while racing:
+            done, racing = await asyncio.wait(racing, return_when=asyncio.FIRST_COMPLETED)
+            # Prefer a successful attempt; only fail once every attempt has failed.
+            winner = next((task for task in done if task.exception() is None), None) or winner or done.pop()
+            if winner.exception() is None:
+                break
+
+        outcome, elapsed = winner.result()
+        loser = None if hedge is None else (hedge if winner is primary else primary)
+        hedge_stats.record_call(key, _attempt_latency(outcome, elapsed), hedged=hedge is not None,
+                                hedge_won=hedge is not None and winner is hedge)
+
+        extra_tokens = {}
+        if loser is not None:
+            if loser.done() and not loser.cancelled() and loser.exception() is None:
+                extra_tokens = loser.result()[0]['token_usage']
+            else:
+                # A cancelled duplicate was still billed for its prompt; count it as the winner's input tokens.
+                extra_tokens = {'input_tokens': outcome['token_usage'].get('input_tokens', 0)}
+            hedge_stats.record_extra_tokens(extra_tokens)
+
+        return {
+            **outcome,
+            'hedge': {'hedged': hedge is not None, 'hedge_won': winner is hedge, 'extra_token_usage': extra_tokens},
+        }
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
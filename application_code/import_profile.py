@@ -0,0 +1,97 @@
+"""
+Import-time profile of the application's entry points.
+
+Imports each module in a fresh interpreter with `python -X importtime` and reports the wall time until the import
+returned plus the slowest imports by cumulative time, so regressions in startup time (a heavy dependency or a client
+created at import) are easy to spot. With `--preload` the time to compile the graph (`graph.preload()`) is reported
+as well, i.e. what the first request would otherwise pay.
+
+Usage:
+    python3 -m import_profile
+    python3 -m import_profile graph server --top 20 --preload
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, Sequence
+
+DEFAULT_MODULES = ["graph", "server", "agents", "mcp_server", "ingestion"]
+
+_TIMED_IMPORT = (
+    "import time, importlib; started = time.perf_counter(); importlib.import_module({module!r}); "
+    "imported = time.perf_counter(); import sys; sys.stderr.write('__preload__\\n'); sys.stderr.flush(); {preload}"
+    "print('__profile__', imported - started, time.perf_counter() - imported)"
+)
+
+
+def profile_module(module: str, preload: bool = False) -> Dict:
+    """Import `module` in a child interpreter and parse its `-X importtime` output."""
+    code = _TIMED_IMPORT.format(
+        module=module,
+        preload="importlib.import_module('graph').preload(); " if preload else "",
+    )
+    env = {**os.environ, "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "import-profile")}
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=Path(__file__).parent, env=env, capture_output=True, text=True,
+    )
+
+    imports = []
+    for line in completed.stderr.splitlines():
+        if line == "__preload__":
+            break  # Imports triggered by the preload are not part of the module's own import time.
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = line.replace("import time:", "|").split("|")
+        imports.append({
+            'module': name.strip(),
+            'self_ms': int(self_us) / 1000,
+            'cumulative_ms': int(cumulative_us) / 1000,
+        })
+
+    import_seconds, preload_seconds = None, None
+    for line in completed.stdout.splitlines():
+        if line.startswith("__profile__"):
+            _, import_seconds, preload_seconds = line.split()
+    return {
+        'module': module,
+        'ok': completed.returncode == 0,
+        'error': completed.stderr.strip().splitlines()[-1] if completed.returncode else None,
+        'import_seconds': float(import_seconds) if import_seconds else None,
+        'preload_seconds': float(preload_seconds) if preload and preload_seconds else None,
+        'imports': imports,
+    }
+
+
+def print_profile(profile: Dict, top: int):
+    if not profile['ok']:
+        print(f"{profile['module']}: import failed ({profile['error']})")
+        return
+    line = f"{profile['module']}: ready in {profile['import_seconds']:.3f}s"
+    if profile['preload_seconds'] is not None:
+        line += f", graph.preload() {profile['preload_seconds']:.3f}s"
+    print(line)
+    slowest = sorted(profile['imports'], key=lambda entry: entry['cumulative_ms'], reverse=True)
+    for entry in slowest[:top]:
+        print(f"    {entry['module']:<48} {entry['cumulative_ms']:>9.1f} ms")
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Report import time of the application's entry points.")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list per module.")
+    parser.add_argument("--preload", action="store_true", help="Also time graph.preload() after the import.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None):
+    args = parse_args(argv)
+    for module in args.modules:
+        print_profile(profile_module(module, args.preload), args.top)
+
+
+if __name__ == '__main__':
+    main()
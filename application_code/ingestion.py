@@ -1,20 +1,35 @@
+import argparse
 import asyncio
+import functools
+import json
+from collections import Counter
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable
 
-import html2text
-from atlassian import Confluence
 import os
 from dotenv import load_dotenv
 import re
 import unicodedata
 
+from async_utils import BoundedExecutor, IntervalLimiter
+from page_store import convert_page_async, format_page, get_page_store
+from resilience import CONFLUENCE, call_dependency
+
 load_dotenv()
 
 INGESTION_FOLDER = "ingestion_docs"
-confluence = Confluence(
-    url=os.getenv("CONFLUENCE_URL"),
-    username=os.getenv("CONFLUENCE_ACCOUNT"),
-    password=os.getenv("CONFLUENCE_TOKEN"),
-    cloud=True)
+CHECKPOINT_PATH = Path(__file__).parent / "cache" / "crawl_checkpoint.jsonl"
+
+
+@functools.cache
+def get_confluence():
+    # atlassian-python-api is imported and the client created on first use, not at import.
+    from atlassian import Confluence
+    return Confluence(
+        url=os.getenv("CONFLUENCE_URL"),
+        username=os.getenv("CONFLUENCE_ACCOUNT"),
+        password=os.getenv("CONFLUENCE_TOKEN"),
+        cloud=True)
 
 
 def clean_page_content(content: str) -> str:
@@ -62,45 +77,296 @@ def clean_page_content(content: str) -> str:
     return content
 
 
-async def get_page_by_id(page_id: str, title: str = None) -> str:
-    response = confluence.get_page_by_id(
-        page_id, expand="body.storage,version,history"
-    )
+async def get_page_by_id(page_id: str, title: str = None, request=None, timeout: float | None = None) -> str:
+    """
+    Download and convert one page, storing it in the page store. `request` makes the Confluence call (the crawler's
+    rate-limited one); by default it goes straight through Confluence's circuit breaker.
+    """
+    if request is None:
+        response = await call_dependency(CONFLUENCE, lambda: asyncio.to_thread(
+            get_confluence().get_page_by_id, page_id, expand="body.storage,version,history"
+        ), timeout)
+    else:
+        response = await request("get_page_by_id", page_id, expand="body.storage,version,history", timeout=timeout)
+
+    version, extra_info, markdown_text = await convert_page_async(response)
+    # The MCP server serves pages from the store instead of downloading them again.
+    store = get_page_store()
+    if store is not None:
+        store.put(page_id, version, extra_info, markdown_text)
+
+    return format_page(extra_info, markdown_text, title)
+
+
+class CrawlCheckpoint:
+    """
+    Append-only log of a crawl's progress: the version (and space) of every page written and every space whose pages
+    were all written. A crawl restarted after a crash replays it, skips finished spaces and, within the others, every
+    page whose version has not changed since it was written. Space listings are cheap next to page bodies, so
+    unfinished spaces are listed again from the start rather than resumed mid-listing.
+
+    Finished spaces only mark the resume point of an unfinished crawl: once a crawl completes, its spaces are cleared
+    (`crawl_finished`) and the next crawl lists them again, still skipping the pages whose version it has already
+    written.
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = Path(path)
+        self.pages: Dict[str, int] = {}
+        self.page_spaces: Dict[str, str] = {}
+        self.spaces_done: set = set()
+        truncated = False
+        if self.path.exists():
+            with open(self.path, mode='r', encoding='utf-8') as file:
+                for line in file:
+                    truncated = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # The last line may have been cut short by the crash.
+                    if 'page' in entry:
+                        self.pages[entry['page']] = entry['version']
+                        if entry.get('space') is not None:
+                            self.page_spaces[entry['page']] = entry['space']
+                    elif 'space' in entry:
+                        self.spaces_done.add(entry['space'])
+        self._file = open(self.path, mode='a', encoding='utf-8')
+        if truncated:
+            # An entry appended to the line the crash cut short would be lost with it.
+            self._file.write("\n")
+
+    def is_current(self, page_id: str, version: int | None) -> bool:
+        return version is not None and self.pages.get(page_id) == version
+
+    def _append(self, entry: Dict):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def _rewrite(self):
+        """Replace the log with one entry per page and finished space, dropping the cleared ones."""
+        self._file.close()
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        with open(temporary, mode='w', encoding='utf-8') as file:
+            for page_id, version in self.pages.items():
+                file.write(json.dumps({'page': page_id, 'version': version, 'space': self.page_spaces.get(page_id)})
+                           + "\n")
+            for space_key in sorted(self.spaces_done):
+                file.write(json.dumps({'space': space_key}) + "\n")
+        os.replace(temporary, self.path)
+        self._file = open(self.path, mode='a', encoding='utf-8')
+
+    def page_done(self, page_id: str, version: int, space_key: str | None = None):
+        self.pages[page_id] = version
+        if space_key is not None:
+            self.page_spaces[page_id] = space_key
+        self._append({'page': page_id, 'version': version, 'space': space_key})
+
+    def space_done(self, space_key: str):
+        self.spaces_done.add(space_key)
+        self._append({'space': space_key})
+
+    def crawl_finished(self, space_keys: Iterable[str]):
+        """Clear the finished marks of a completed crawl's spaces; their page versions are kept."""
+        self.spaces_done.difference_update(space_keys)
+        self._rewrite()
+
+    def forget_spaces(self, space_keys: Iterable[str]):
+        """Drop everything recorded for these spaces, so they are crawled again from scratch."""
+        space_keys = set(space_keys)
+        self.spaces_done -= space_keys
+        for page_id in [page_id for page_id, space_key in self.page_spaces.items() if space_key in space_keys]:
+            del self.pages[page_id], self.page_spaces[page_id]
+        self._rewrite()
+
+    def close(self):
+        self._file.close()
+
+
+class ConfluenceCrawler:
+    """
+    Mirror Confluence spaces into `ingestion_docs` (and the page store).
+
+    Spaces and their pages are enumerated by following each listing response's `_links.next` cursor. Up to
+    `space_concurrency` spaces are listed at once and their pages merged into one stream, whose bodies are downloaded
+    `concurrency` at a time. Every Confluence request, listing or body, waits on one shared `rate_per_second` limit and
+    goes through Confluence's circuit breaker, timeout and retries (see resilience.py). Pages are written as they
+    arrive and recorded in the `CrawlCheckpoint`; a page that fails is logged, left out of the checkpoint and retried by
+    the next crawl. A crawl that completes without failures clears its spaces' finished marks, so the next one lists
+    them again and picks up edited pages.
+    """
+
+    def __init__(
+        self,
+        checkpoint: CrawlCheckpoint,
+        concurrency: int = 8,
+        rate_per_second: float = 10.0,
+        space_concurrency: int = 4,
+        page_size: int = 100,
+        page_timeout: float | None = None,
+    ):
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.space_concurrency = space_concurrency
+        self.page_size = page_size
+        self.page_timeout = page_timeout
+        self.limiter = IntervalLimiter(rate_per_second)
+        self.stats = Counter()
+        # Pages listed but not yet written (or failed) per space, and the spaces whose listing has finished.
+        self._outstanding = Counter()
+        self._crawled_spaces = set()
+        self._listed_spaces = set()
+        self._failed_spaces = set()
+
+    @classmethod
+    def from_env(cls, checkpoint: CrawlCheckpoint) -> "ConfluenceCrawler":
+        timeout = os.getenv("INGESTION_PAGE_TIMEOUT_SECONDS")
+        return cls(
+            checkpoint,
+            concurrency=int(os.getenv("INGESTION_CONCURRENCY", "8")),
+            rate_per_second=float(os.getenv("INGESTION_REQUESTS_PER_SECOND", "10")),
+            space_concurrency=int(os.getenv("INGESTION_SPACE_CONCURRENCY", "4")),
+            page_size=int(os.getenv("INGESTION_PAGE_SIZE", "100")),
+            page_timeout=float(timeout) if timeout else None,
+        )
+
+    async def _request(self, method: str, *args, timeout: float | None = None, **kwargs):
+        await self.limiter.wait()
+        return await call_dependency(
+            CONFLUENCE, lambda: asyncio.to_thread(getattr(get_confluence(), method), *args, **kwargs), timeout
+        )
+
+    async def _paginate(self, method: str, *args, **kwargs) -> AsyncIterator[Dict]:
+        """Results of a paginated listing, following each response's `_links.next` until the last page."""
+        response = await self._request(method, *args, **kwargs)
+        while True:
+            results = response.get('results', [])
+            for result in results:
+                yield result
+            next_link = response.get('_links', {}).get('next')
+            if not next_link or not results:
+                return
+            # The link is relative to the API base (with /wiki on cloud), which is the client's url.
+            response = await self._request("get", next_link.lstrip('/'))
+
+    async def list_spaces(self) -> AsyncIterator[str]:
+        async for space in self._paginate("get_all_spaces", start=0, limit=self.page_size):
+            yield space['key']
+
+    async def _list_space(self, space_key: str, pages: asyncio.Queue):
+        self._crawled_spaces.add(space_key)
+        if space_key in self.checkpoint.spaces_done:
+            print(f"Space {space_key} already crawled, skipping.")
+            return
+        print(f"Space key {space_key}")
+        async for page in self._paginate(
+            "get_all_pages_from_space_raw", space_key, start=0, limit=self.page_size, status="current",
+            expand="version"
+        ):
+            self.stats['listed'] += 1
+            if self.checkpoint.is_current(page['id'], page.get('version', {}).get('number')):
+                self.stats['unchanged'] += 1
+                continue
+            self._outstanding[space_key] += 1
+            await pages.put((space_key, page))
+        self._listed_spaces.add(space_key)
+        self._finish_space(space_key)
+
+    def _finish_space(self, space_key: str):
+        if (space_key in self._listed_spaces and not self._outstanding[space_key]
+                and space_key not in self._failed_spaces):
+            self.checkpoint.space_done(space_key)
+
+    async def _list(self, spaces: Iterable[str] | AsyncIterable[str], pages: asyncio.Queue):
+        try:
+            listing = BoundedExecutor(concurrency=self.space_concurrency, return_exceptions=True)
+            async for _, outcome in listing.stream(lambda space_key: self._list_space(space_key, pages), spaces):
+                if isinstance(outcome, BaseException):
+                    self.stats['spaces_failed'] += 1
+                    print(f"Listing a space failed: {outcome!r}")
+        finally:
+            await pages.put(None)
+
+    async def _listed_pages(self, pages: asyncio.Queue) -> AsyncIterator[tuple[str, Dict]]:
+        while (entry := await pages.get()) is not None:
+            yield entry
+
+    async def _download(self, entry: tuple[str, Dict]) -> tuple[str, Dict, str | BaseException]:
+        space_key, page = entry
+        try:
+            return space_key, page, await get_page_by_id(page['id'], page['title'], self._request, self.page_timeout)
+        except Exception as e:
+            return space_key, page, e
+
+    def _write(self, space_key: str, page: Dict, page_content: str | BaseException):
+        self._outstanding[space_key] -= 1
+        if isinstance(page_content, BaseException):
+            self.stats['failed'] += 1
+            self._failed_spaces.add(space_key)
+            print(f"Downloading page {page['id']} of space {space_key} failed: {page_content!r}")
+            return
+        write_page(page['id'], page['title'], page_content)
+        self.checkpoint.page_done(page['id'], page.get('version', {}).get('number'), space_key)
+        self.stats['written'] += 1
+        self._finish_space(space_key)
+
+    async def crawl(self, spaces: Iterable[str] | None = None) -> Counter:
+        """Mirror `spaces`, or every space of the instance; returns the listed, unchanged, written and failed counts."""
+        # Bounded, so listings stay only a little ahead of the downloads.
+        pages: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        lister = asyncio.create_task(self._list(spaces if spaces is not None else self.list_spaces(), pages))
+        # Not rate limited here: _request already waits on the limiter for every listing and body request.
+        bodies = BoundedExecutor(concurrency=self.concurrency, progress="Crawling Confluence")
+        try:
+            async for _, (space_key, page, page_content) in bodies.stream(self._download, self._listed_pages(pages)):
+                self._write(space_key, page, page_content)
+            await lister
+        finally:
+            lister.cancel()
+        if not self.stats['failed'] and not self.stats['spaces_failed']:
+            self.checkpoint.crawl_finished(self._crawled_spaces)
+        print(f"Crawl finished: {dict(self.stats)}")
+        return self.stats
 
-    html_content = response["body"]["storage"]["value"]
-    markdown_text = html2text.html2text(html_content)
 
-    creator = response.get("history", {}).get("createdBy", {}).get("displayName", "Unknown")
-    editor = response.get("version", {}).get("by", {}).get("displayName", "Unknown")
+def write_page(page_id: str, title: str, page_content: str):
+    folder = Path(__file__).parent / INGESTION_FOLDER
+    folder.mkdir(exist_ok=True)
+    file_name = clean_page_content(f"{page_id}_{title}.txt")
+    with open(folder / file_name, 'w') as rb:
+        rb.write(clean_page_content(page_content))
 
-    extra_info = f"\n\n Page Created by: {creator}\n Page Last edited by: {editor}\n"
 
-    if title:
-        return f"Title of the page is {title} \n {extra_info} and markdown of the page is \n\n {markdown_text}"
-    return extra_info + markdown_text
+async def crawl(spaces: Iterable[str] | None = None, restart: bool = False) -> Counter:
+    """
+    Mirror the given spaces, or all of them, resuming from the checkpoint unless `restart`, which forgets the given
+    spaces' progress (or the whole checkpoint, without spaces).
+    """
+    spaces = list(spaces) if spaces is not None else None
+    if restart and spaces is None:
+        CHECKPOINT_PATH.unlink(missing_ok=True)
+    CHECKPOINT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    checkpoint = CrawlCheckpoint(CHECKPOINT_PATH)
+    if restart and spaces is not None:
+        checkpoint.forget_spaces(spaces)
+    try:
+        return await ConfluenceCrawler.from_env(checkpoint).crawl(spaces)
+    finally:
+        checkpoint.close()
 
 
-def get_all_spaces():
-    spaces = confluence.get_all_spaces()
-    for space in spaces['results']:
-        print(f"Space key {space['key']}")
-        get_all_pages_in_space(space['key'])
+async def get_all_spaces():
+    await crawl()
 
 
 async def get_all_pages_in_space(space='SD'):
-    pages = confluence.get_all_pages_from_space(space=space)
-    print(f"Total no of pages {len(pages)}")
-    for page in pages:
-        print(page)
-        title = page['title']
-        page_id = page['id']
-        page_content = await get_page_by_id(page_id, title)
-        file_name = clean_page_content(f"{page_id}_{title}.txt")
-        base_dir = os.path.dirname(__file__)
-        with open(f"{base_dir}/{INGESTION_FOLDER}/{file_name}", 'w') as rb:
-            rb.write(clean_page_content(page_content))
+    await crawl([space])
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mirror Confluence spaces into ingestion_docs.")
+    parser.add_argument("--space", action="append", help="space key to crawl (repeatable, default: every space)")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore the checkpoint of an earlier crawl (only the given spaces' part, with --space)")
+    args = parser.parse_args()
     print("Starting Ingestion.")
-    asyncio.run(get_all_pages_in_space(space='~63e828e8f1475ad42c5e16ef'))
+    asyncio.run(crawl(args.space, restart=args.restart))
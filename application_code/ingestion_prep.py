@@ -1,40 +1,278 @@
+"""
+Export of the ingested mirror (`ingestion_docs`) to a local Parquet dataset.
+
+The dataset is a folder of part files, `output_docs/pages/part-00000.parquet`, `part-00001.parquet`, ..., with one row
+per page version: page_id, title, text, content_hash (blake2b of the text), version (from the crawl checkpoint, when
+known), source (the mirror's file name) and canonical_id. Pages are streamed from the mirror one file at a time into
+row groups bounded by row count and bytes, so memory stays flat whatever the corpus size. An export only writes a new
+part with the pages whose hash or canonical page differs from their latest exported row; unchanged pages are skipped
+and a run with no changes writes nothing. A later part supersedes earlier rows of the same page; `--compact` rewrites
+the dataset as one part holding the latest row of every page.
+
+Near-duplicate pages (see near_duplicates.py) are collapsed to the longest page of their cluster: a first pass over the
+mirror computes MinHash signatures only, and every page's row records the canonical page it belongs to (its own id
+for canonical pages).
+
+Readers map the part files instead of reading them: `open_export` returns the latest row per page, and
+`corpus.iter_ingested_pages` accepts the export folder anywhere it accepts the mirror (`python3 -m kb_local build
+--corpus output_docs/pages`, `python3 -m benchmark --corpus output_docs/pages`).
+
+Pushing to the Hugging Face Hub is optional (`--push-to-hub`) and the only step that needs `datasets`.
+"""
+
+import argparse
+import hashlib
 import os
-import csv
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from corpus import INGESTION_FOLDER
+from near_duplicates import DEFAULT_THRESHOLD, canonical_map
+
+EXPORT_FOLDER = Path(__file__).parent / "output_docs" / "pages"
+DEFAULT_ROW_GROUP_ROWS = 1000
+DEFAULT_ROW_GROUP_BYTES = 64 * 1024 * 1024
+HUB_DATASET = "ksh01/vector-bootcamp-confluence-dataset"
+
+SCHEMA = pa.schema([
+    ('page_id', pa.string()),
+    ('title', pa.string()),
+    ('text', pa.large_string()),
+    ('content_hash', pa.string()),
+    ('version', pa.int64()),
+    ('source', pa.string()),
+    ('canonical_id', pa.string()),
+])
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def part_paths(path: str | os.PathLike = EXPORT_FOLDER) -> List[Path]:
+    path = Path(path)
+    if path.suffix == '.parquet':
+        return [path]
+    return sorted(path.glob("part-*.parquet")) if path.is_dir() else []
+
+
+def is_export(path: str | os.PathLike) -> bool:
+    return bool(part_paths(path))
+
+
+def crawl_versions() -> Dict[str, int]:
+    """Version of every page the crawler wrote, from its checkpoint."""
+    from ingestion import CHECKPOINT_PATH, CrawlCheckpoint
+
+    if not CHECKPOINT_PATH.exists():
+        return {}
+    checkpoint = CrawlCheckpoint(CHECKPOINT_PATH)
+    checkpoint.close()
+    return checkpoint.pages
+
+
+def open_export(path: str | os.PathLike = EXPORT_FOLDER, columns: List[str] | None = None,
+                include_collapsed: bool = True) -> pa.Table:
+    """
+    The latest row of every exported page, read through memory maps of the part files. Without `include_collapsed`
+    only canonical pages are returned.
+    """
+    parts = part_paths(path)
+    if not parts:
+        return SCHEMA.empty_table().select(columns) if columns else SCHEMA.empty_table()
+    read_columns = None if columns is None else list(dict.fromkeys(['page_id', 'canonical_id', *columns]))
+    table = pa.concat_tables([pq.read_table(part, columns=read_columns, memory_map=True) for part in parts])
+    if len(parts) > 1:
+        # Later parts win: keep the last row of each page.
+        latest: Dict[str, int] = {}
+        for row, page_id in enumerate(table.column('page_id').to_pylist()):
+            latest[page_id] = row
+        table = table.take(sorted(latest.values()))
+    if not include_collapsed:
+        table = table.filter(pc.equal(table.column('page_id'), table.column('canonical_id')))
+    return table.select(columns) if columns else table
+
+
+def iter_exported_pages(path: str | os.PathLike = EXPORT_FOLDER) -> Iterator[Dict]:
+    """Yield exported canonical pages like `corpus.iter_ingested_pages` yields mirrored ones."""
+    table = open_export(path, include_collapsed=False)
+    for batch in table.to_batches():
+        for row in batch.to_pylist():
+            yield {
+                'page_id': row['page_id'],
+                'title': row['title'],
+                'text': row['text'],
+                'path': str(INGESTION_FOLDER / row['source']),
+                'version': row['version'],
+                'content_hash': row['content_hash'],
+            }
+
+
+class _PartWriter:
+    """Buffers rows into row groups of at most `max_rows` rows or about `max_bytes` of text; opens the part lazily."""
+
+    def __init__(self, path: Path, max_rows: int, max_bytes: int):
+        self.path = path
+        self.temporary_path = path.with_suffix('.parquet.tmp')
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows: List[Dict] = []
+        self.row_bytes = 0
+        self.row_groups = 0
+        self.written = 0
+        self._writer: pq.ParquetWriter | None = None
+
+    def add(self, row: Dict):
+        self.rows.append(row)
+        self.row_bytes += len(row['text'])
+        if len(self.rows) >= self.max_rows or self.row_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self._writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._writer = pq.ParquetWriter(self.temporary_path, SCHEMA, compression='zstd')
+        self._writer.write_table(pa.Table.from_pylist(self.rows, schema=SCHEMA), row_group_size=len(self.rows))
+        self.row_groups += 1
+        self.written += len(self.rows)
+        self.rows, self.row_bytes = [], 0
+
+    def close(self):
+        """Finish the part; it only becomes visible to readers once complete."""
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(self.temporary_path, self.path)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self.temporary_path.unlink(missing_ok=True)
+
+
+def export_pages(
+    pages: Iterable[Dict],
+    path: str | os.PathLike = EXPORT_FOLDER,
+    versions: Dict[str, int] | None = None,
+    canonical_ids: Dict[str, str] | None = None,
+    row_group_rows: int = DEFAULT_ROW_GROUP_ROWS,
+    row_group_bytes: int = DEFAULT_ROW_GROUP_BYTES,
+) -> Dict:
+    """
+    Append the pages whose content or canonical page (`canonical_ids`, for collapsed near-duplicates) changed since
+    their latest exported row as a new part of the export at `path`.
+    """
+    path = Path(path)
+    versions = versions or {}
+    canonical_ids = canonical_ids or {}
+    exported = open_export(path, columns=['page_id', 'content_hash', 'canonical_id'])
+    exported_rows = dict(zip(
+        exported.column('page_id').to_pylist(),
+        zip(exported.column('content_hash').to_pylist(), exported.column('canonical_id').to_pylist()),
+    ))
+    del exported
+
+    writer = _PartWriter(path / f"part-{len(part_paths(path)):05d}.parquet", row_group_rows, row_group_bytes)
+    seen = unchanged = collapsed = 0
+    try:
+        for page in pages:
+            seen += 1
+            page_hash = content_hash(page['text'])
+            canonical_id = canonical_ids.get(page['page_id'], page['page_id'])
+            collapsed += canonical_id != page['page_id']
+            if exported_rows.get(page['page_id']) == (page_hash, canonical_id):
+                unchanged += 1
+                continue
+            exported_rows[page['page_id']] = (page_hash, canonical_id)  # A page mirrored twice is exported once.
+            writer.add({
+                'page_id': page['page_id'],
+                'title': page['title'],
+                'text': page['text'],
+                'content_hash': page_hash,
+                'version': page.get('version', versions.get(page['page_id'])),
+                'source': Path(page['path']).name,
+                'canonical_id': canonical_id,
+            })
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return {
+        'pages': seen,
+        'unchanged': unchanged,
+        'collapsed': collapsed,
+        'written': writer.written,
+        'row_groups': writer.row_groups,
+        'part': str(writer.path) if writer.written else None,
+    }
+
+
+def compact(path: str | os.PathLike = EXPORT_FOLDER, row_group_rows: int = DEFAULT_ROW_GROUP_ROWS) -> int:
+    """Rewrite the export as a single part holding the latest row of every page; returns the number of rows."""
+    parts = part_paths(path)
+    if len(parts) <= 1:
+        return len(open_export(path))
+    table = open_export(path)
+    compacted = Path(path) / "compacted.parquet.tmp"
+    pq.write_table(table, compacted, row_group_size=row_group_rows, compression='zstd')
+    for part in parts:
+        part.unlink()
+    os.replace(compacted, parts[0])
+    return len(table)
 
-# Input and output folders
-input_folder = Path(__file__).parent / "ingestion_docs"
-output_folder = input_folder.parent / "output_docs"
-output_csv_filename = 'output.csv'
 
-# Ensure output directory exists
-os.makedirs(output_folder, exist_ok=True)
+def push_to_hub(path: str | os.PathLike, repo_id: str):
+    from datasets import Dataset
 
-# Path to output CSV file
-output_csv_path = os.path.join(output_folder, output_csv_filename)
+    Dataset(open_export(path)).push_to_hub(repo_id)
 
-# Gather all .txt files in the input folder
-txt_files = [f for f in os.listdir(input_folder) if f.endswith('.txt')]
 
-# Write to CSV
-with open(output_csv_path, mode='w', newline='', encoding='utf-8') as csv_file:
-    writer = csv.writer(csv_file)
-    writer.writerow(['title', 'text'])  # Header
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export the ingested mirror to a local Parquet dataset.")
+    parser.add_argument("--input", default=str(INGESTION_FOLDER), help="mirror folder of <page_id>_<title>.txt files")
+    parser.add_argument("--output", default=str(EXPORT_FOLDER), help="export folder of part-*.parquet files")
+    parser.add_argument("--row-group-rows", type=int, default=DEFAULT_ROW_GROUP_ROWS)
+    parser.add_argument("--row-group-mb", type=int, default=DEFAULT_ROW_GROUP_BYTES // (1024 * 1024))
+    parser.add_argument("--near-duplicate-threshold", type=float,
+                        default=float(os.getenv("NEAR_DUPLICATE_THRESHOLD", str(DEFAULT_THRESHOLD))),
+                        help="similarity from which pages are collapsed to a canonical page (1.1 disables collapsing)")
+    parser.add_argument("--compact", action="store_true", help="rewrite the export as one part after exporting")
+    parser.add_argument("--push-to-hub", nargs="?", const=HUB_DATASET, metavar="REPO_ID",
+                        help=f"also push the export to the Hugging Face Hub (default repo {HUB_DATASET})")
+    return parser.parse_args(argv)
 
-    for filename in txt_files:
-        filepath = os.path.join(input_folder, filename)
-        with open(filepath, mode='r', encoding='utf-8') as file:
-            text = file.read().strip()
-            title = os.path.splitext(filename)[0]
-            writer.writerow([title, text])
 
-print(f"CSV file created at: {output_csv_path} with {len(txt_files)} .txt files.")
+def main(argv=None):
+    from corpus import iter_ingested_pages
 
-from datasets import load_dataset, DatasetDict
-from huggingface_hub import HfApi
+    args = parse_args(argv)
+    canonical_ids = {}
+    if args.near_duplicate_threshold <= 1:
+        clusters = canonical_map(
+            ((page['page_id'], page['text']) for page in iter_ingested_pages(args.input)), args.near_duplicate_threshold
+        )
+        canonical_ids = {duplicate: keep for keep, duplicates in clusters.items() for duplicate in duplicates}
+        for keep, duplicates in clusters.items():
+            print(f"Collapsing near-duplicates {duplicates} into page {keep}.")
+    stats = export_pages(
+        iter_ingested_pages(args.input), args.output, crawl_versions(), canonical_ids,
+        row_group_rows=args.row_group_rows, row_group_bytes=args.row_group_mb * 1024 * 1024,
+    )
+    print(f"Exported {stats['written']} of {stats['pages']} pages ({stats['unchanged']} unchanged, "
+          f"{stats['collapsed']} collapsed near-duplicates) in {stats['row_groups']} row groups to "
+          f"{stats['part'] or args.output}.")
+    if args.compact:
+        print(f"Compacted {args.output} to {compact(args.output, args.row_group_rows)} pages.")
+    if args.push_to_hub:
+        push_to_hub(args.output, args.push_to_hub)
+        print(f"Pushed {args.output} to {args.push_to_hub}.")
 
-# Step 1: Load your CSV as Hugging Face Dataset
-dataset = load_dataset('csv', data_files=output_csv_path)
 
-# Step 2: Push to Hugging Face
-dataset.push_to_hub("ksh01/vector-bootcamp-confluence-dataset")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""
+Local exact vector index, an in-process alternative to the Weaviate knowledge base.
+
+The corpus is small enough to keep in memory, so instead of a network round trip per query the pages' embeddings are
+stored in a matrix on disk (float32, or int8 with one scale per row) that is memory-mapped at load time. A search is an
+exact cosine top-k over the whole matrix with NumPy, fused with a BM25 keyword score the way Weaviate's hybrid query
+fuses them (relative score fusion with weight `alpha` on the vector side). Results have the same shape as
+`AsyncWeaviateKnowledgeBase.search_knowledgebase`, so agent 2 does not care which backend answered.
+
+The index is built once from the ingested pages and reloaded without re-embedding; only the query is embedded at search
+time (or not at all when agent 2 passes a precomputed vector). Pages must be embedded with the same model as queries.
+
+Configuration (environment):
+    VECTOR_BACKEND                  "weaviate" (default) or "local", see agents_helper.get_weaviate_client
+    LOCAL_VECTOR_INDEX_PATH         index folder (default cache/vector_index)
+    LOCAL_VECTOR_HYBRID_ALPHA       weight of the vector score against the keyword score (default 0.75)
+
+Usage:
+    python3 -m kb_local build --dtype int8
+    python3 -m kb_local search "What credit cards does Maple Trust Bank offer?"
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+DEFAULT_INDEX_FOLDER = Path(__file__).parent / "cache" / "vector_index"
+DEFAULT_EMBEDDING_MODEL = "@cf/baai/bge-m3"
+# Rows of an int8 matrix dequantized at a time when scoring; bounds the float32 copy a query makes.
+SCORE_CHUNK_ROWS = 4096
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+Embed = Callable[[List[str]], List[List[float]]]
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_PATTERN.findall(text.lower())
+
+
+def get_embedder(model_name: str = DEFAULT_EMBEDDING_MODEL) -> Embed:
+    """Batch embedding function using the same endpoint and model as the Weaviate knowledge base."""
+    import openai
+
+    client = openai.OpenAI(
+        api_key=os.getenv("EMBEDDING_API_KEY"),
+        base_url=os.getenv("EMBEDDING_BASE_URL"),
+        max_retries=5,
+    )
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        response = client.embeddings.create(input=texts, model=model_name)
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+    return embed
+
+
+class KeywordScorer:
+    """BM25 over the documents with postings kept as (document ids, term frequencies) arrays per term."""
+
+    def __init__(self, texts: Sequence[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.document_count = len(texts)
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        postings: Dict[str, tuple[List[int], List[int]]] = {}
+        for document_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths[document_id] = sum(counts.values())
+            for term, count in counts.items():
+                ids, frequencies = postings.setdefault(term, ([], []))
+                ids.append(document_id)
+                frequencies.append(count)
+        self.length_norm = 1 - b + b * lengths / max(float(lengths.mean()) if len(texts) else 1.0, 1.0)
+        self.postings = {
+            term: (np.array(ids, dtype=np.int32), np.array(frequencies, dtype=np.float32))
+            for term, (ids, frequencies) in postings.items()
+        }
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.document_count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            ids, frequencies = self.postings[term]
+            idf = math.log(1 + (self.document_count - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * frequencies * (self.k1 + 1) / (frequencies + self.k1 * self.length_norm[ids])
+        return scores
+
+
+class LocalVectorIndex:
+    """
+    Exact cosine search over a memory-mapped embedding matrix plus BM25 over the documents.
+
+    On disk: `vectors.npy` (unit-length rows, float32 or int8), `scales.npy` (int8 only), `documents.jsonl` with the
+    title, section and text of every row, and `meta.json` with the model, dtype and dimension.
+    """
+
+    def __init__(self, vectors: np.ndarray, documents: List[Dict], scales: np.ndarray | None = None,
+                 model_name: str = DEFAULT_EMBEDDING_MODEL):
+        self.vectors = vectors
+        self.scales = scales
+        self.documents = documents
+        self.model_name = model_name
+        self.keywords = KeywordScorer([f"{document['title']}\n{document['text']}" for document in documents])
+
+    @classmethod
+    def build(cls, documents: List[Dict], vectors: Sequence[Sequence[float]], dtype: str = "float32",
+              model_name: str = DEFAULT_EMBEDDING_MODEL) -> "LocalVectorIndex":
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        if dtype == "float32":
+            return cls(matrix, documents, model_name=model_name)
+        if dtype != "int8":
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+        return cls(quantized, documents, scales=scales.astype(np.float32), model_name=model_name)
+
+    def save(self, path: str | os.PathLike):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "vectors.npy", self.vectors)
+        if self.scales is not None:
+            np.save(path / "scales.npy", self.scales)
+        with open(path / "documents.jsonl", mode='w', encoding='utf-8') as file:
+            for document in self.documents:
+                file.write(json.dumps(document) + "\n")
+        meta = {
+            'model_name': self.model_name,
+            'dtype': str(self.vectors.dtype),
+            'dimension': int(self.vectors.shape[1]),
+            'documents': len(self.documents),
+        }
+        with open(path / "meta.json", mode='w', encoding='utf-8') as file:
+            json.dump(meta, file, indent=2)
+
+    @classmethod
+    def load(cls, path: str | os.PathLike) -> "LocalVectorIndex":
+        path = Path(path)
+        with open(path / "meta.json", mode='r', encoding='utf-8') as file:
+            meta = json.load(file)
+        with open(path / "documents.jsonl", mode='r', encoding='utf-8') as file:
+            documents = [json.loads(line) for line in file if line.strip()]
+        vectors = np.load(path / "vectors.npy", mmap_mode='r')
+        scales = np.load(path / "scales.npy") if (path / "scales.npy").exists() else None
+        return cls(vectors, documents, scales=scales, model_name=meta['model_name'])
+
+    def vector_scores(self, queries: np.ndarray) -> np.ndarray:
+        """Cosine similarity of every query (one per row) against every document."""
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        if self.scales is None:
+            return queries @ self.vectors.T
+        # int8 rows are widened one chunk at a time, so a query never copies the whole mapped matrix.
+        scores = np.empty((len(queries), len(self.vectors)), dtype=np.float32)
+        for start in range(0, len(self.vectors), SCORE_CHUNK_ROWS):
+            end = min(start + SCORE_CHUNK_ROWS, len(self.vectors))
+            rows = np.asarray(self.vectors[start:end], dtype=np.float32)
+            scores[:, start:end] = (queries @ rows.T) * self.scales[start:end]
+        return scores
+
+    def search(self, queries: Sequence[str], vectors: Sequence[Sequence[float]], limit: int = 5,
+               alpha: float = 0.75) -> List[List[tuple[int, float]]]:
+        """Hybrid top-`limit` (document index, score) per query, best first."""
+        vector_scores = self.vector_scores(np.asarray(vectors, dtype=np.float32))
+        limit = min(limit, len(self.documents))
+        results = []
+        for query, semantic in zip(queries, vector_scores):
+            fused = alpha * _relative_scores(semantic) + (1 - alpha) * _relative_scores(self.keywords.scores(query))
+            top = np.argpartition(-fused, limit - 1)[:limit] if limit else np.array([], dtype=np.int64)
+            top = top[np.argsort(-fused[top])]
+            results.append([(int(index), float(fused[index])) for index in top])
+        return results
+
+
+def _relative_scores(scores: np.ndarray) -> np.ndarray:
+    """Min-max normalize scores to [0, 1], as Weaviate's relative score fusion does."""
+    low, high = float(scores.min()), float(scores.max())
+    if high - low < 1e-12:
+        return np.zeros_like(scores) if high <= 0 else np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+class LocalKnowledgeBase:
+    """Same interface as `AsyncWeaviateKnowledgeBase`, answered from a `LocalVectorIndex`."""
+
+    def __init__(self, index: LocalVectorIndex, num_results: int = 5, alpha: float = 0.75, embed: Embed | None = None,
+                 snippet_chars: int | None = 1000):
+        self.index = index
+        self.num_results = num_results
+        self.alpha = alpha
+        self.snippet_chars = snippet_chars
+        self._embed = embed
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if self._embed is None:
+            self._embed = get_embedder(self.index.model_name)
+        return self._embed(texts)
+
+    async def search_knowledgebase(self, keyword: str, vector: List[float] | None = None):
+        if vector is None:
+            vector = (await asyncio.to_thread(self.embed, [keyword]))[0]
+        [hits] = self.index.search([keyword], [vector], limit=self.num_results, alpha=self.alpha)
+        return [self._result(document_index) for document_index, _ in hits]
+
+    async def search_knowledgebase_multi(self, queries: List[str], vectors: List[List[float] | None] | None = None):
+        """All query variants in one matrix product, fused as the Weaviate knowledge base fuses them."""
+        from kb_weaviate import fuse_search_results
+
+        vectors = list(vectors) if vectors is not None else [None] * len(queries)
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = await self.vectorize_batch([queries[index] for index in missing])
+            for index, vector in zip(missing, computed):
+                vectors[index] = vector
+        result_lists = [
+            [self._result(document_index) for document_index, _ in hits]
+            for hits in self.index.search(queries, vectors, limit=self.num_results, alpha=self.alpha)
+        ]
+        return fuse_search_results(result_lists, self.num_results, queries, self.snippet_chars)
+
+    def _result(self, document_index: int):
+        from kb_weaviate import _SearchResult
+
+        document = self.index.documents[document_index]
+        return _SearchResult.model_validate({
+            "_source": {"title": document['title'], "section": document.get('section')},
+            "highlight": {"text": [document['text']]},
+        })
+
+    async def vectorize_batch(self, texts: List[str], batch_size: int = 64) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            vectors.extend(await asyncio.to_thread(self.embed, texts[start:start + batch_size]))
+        return vectors
+
+
+@functools.cache
+def get_local_index(path: str | None = None) -> LocalVectorIndex:
+    """The index at `path` (or LOCAL_VECTOR_INDEX_PATH), loaded once per process."""
+    return LocalVectorIndex.load(path or os.getenv("LOCAL_VECTOR_INDEX_PATH", str(DEFAULT_INDEX_FOLDER)))
+
+
+def build_index(pages: Sequence[Dict], embed: Embed, dtype: str = "float32", batch_size: int = 64,
+                model_name: str = DEFAULT_EMBEDDING_MODEL) -> LocalVectorIndex:
+    """Embed the ingested pages (as yielded by `corpus.iter_ingested_pages`) into a new index."""
+    # Titles keep the `<page_id>_<title>` form of the Weaviate collection, which agent 2 parses the page id from.
+    documents = [
+        {'title': Path(page['path']).stem, 'section': None, 'text': page['text']}
+        for page in pages
+    ]
+    vectors = []
+    for start in range(0, len(documents), batch_size):
+        batch = documents[start:start + batch_size]
+        vectors.extend(embed([f"{document['title']}\n{document['text']}" for document in batch]))
+    return LocalVectorIndex.build(documents, vectors, dtype=dtype, model_name=model_name)
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build or query the local vector index.")
+    parser.add_argument("--path", default=os.getenv("LOCAL_VECTOR_INDEX_PATH", str(DEFAULT_INDEX_FOLDER)))
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Embed the ingested pages and write the index.")
+    build.add_argument("--dtype", choices=["float32", "int8"], default="float32")
+    build.add_argument("--batch-size", type=int, default=64)
+    build.add_argument("--model", default=DEFAULT_EMBEDDING_MODEL)
+    build.add_argument("--corpus", help="mirror folder or Parquet export to index (default ingestion_docs)")
+    search = commands.add_parser("search", help="Run a hybrid search against the index.")
+    search.add_argument("query")
+    search.add_argument("--limit", type=int, default=5)
+    search.add_argument("--alpha", type=float, default=float(os.getenv("LOCAL_VECTOR_HYBRID_ALPHA", "0.75")))
+    return parser.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None):
+    args = parse_args(argv)
+    if args.command == "build":
+        from corpus import INGESTION_FOLDER, iter_ingested_pages
+
+        pages = list(iter_ingested_pages(args.corpus or INGESTION_FOLDER))
+        index = build_index(pages, get_embedder(args.model), args.dtype, args.batch_size, args.model)
+        index.save(args.path)
+        print(f"Indexed {len(pages)} pages ({args.dtype}) into {args.path}")
+        return
+
+    index = LocalVectorIndex.load(args.path)
+    [vector] = get_embedder(index.model_name)([args.query])
+    started = time.perf_counter()
+    [hits] = index.search([args.query], [vector], limit=args.limit, alpha=args.alpha)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    for document_index, score in hits:
+        print(f"{score:.3f}  {index.documents[document_index]['title']}")
+    print(f"Searched {len(index.documents)} documents in {elapsed_ms:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
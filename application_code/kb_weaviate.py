@@ -3,8 +3,8 @@
 import asyncio
 import logging
 import os
+import re
 
-import backoff
 import openai
 import pydantic
 import weaviate
@@ -12,6 +12,7 @@ from weaviate import WeaviateAsyncClient
 from weaviate.config import AdditionalConfig
 
 from async_utils import rate_limited
+from resilience import WEAVIATE, call_dependency
 
 
 class _Source(pydantic.BaseModel):
@@ -39,6 +40,56 @@ class _SearchResult(pydantic.BaseModel):
 
 SearchResults = list[_SearchResult]
 
+# Properties the agents read; the collection's other properties and vectors are not sent back.
+RETURN_PROPERTIES = ["title", "section", "text"]
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[str]:
+    """Fuse several ranked lists of keys into one, scoring each key by sum(1 / (k + rank))."""
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda key: scores[key], reverse=True)
+
+
+def make_snippet(text: str, terms: list[str], max_chars: int | None) -> str:
+    """Window of `text` around the first of `terms` it mentions, or the whole text when short enough."""
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms if term and lowered.find(term) >= 0]
+    start = max(0, min(positions) - max_chars // 4) if positions else 0
+    start = min(start, len(text) - max_chars)
+    return text[start : start + max_chars]
+
+
+def fuse_search_results(
+    result_lists: list[SearchResults],
+    limit: int,
+    queries: list[str] | None = None,
+    snippet_chars: int | None = None,
+) -> SearchResults:
+    """Fuse the results of several query variants with RRF, one result per title, texts cut to snippets."""
+    by_title: dict[str, _SearchResult] = {}
+    rankings = []
+    for results in result_lists:
+        rankings.append([result.source.title for result in results])
+        for result in results:
+            by_title.setdefault(result.source.title, result)
+
+    terms = sorted(
+        {term for query in queries or [] for term in re.findall(r"[a-z0-9]+", query.lower()) if len(term) > 3},
+        key=len,
+        reverse=True,
+    )
+    fused = []
+    for title in reciprocal_rank_fusion(rankings)[:limit]:
+        result = by_title[title]
+        snippet = make_snippet(result.highlight.text[0], terms, snippet_chars)
+        fused.append(result.model_copy(update={"highlight": _Highlight(text=[snippet])}))
+    return fused
+
 
 class AsyncWeaviateKnowledgeBase:
     """Configurable search tools for Weaviate knowledge base."""
@@ -52,10 +103,12 @@ class AsyncWeaviateKnowledgeBase:
         embedding_model_name: str = "@cf/baai/bge-m3",
         embedding_api_key: str | None = None,
         embedding_base_url: str | None = None,
+        snippet_chars: int | None = 1000,
     ) -> None:
         self.async_client = async_client
         self.collection_name = collection_name
         self.num_results = num_results
+        self.snippet_chars = snippet_chars
         
         self.logger = logging.getLogger(__name__)
         self.semaphore = asyncio.Semaphore(max_concurrency)
@@ -70,14 +123,18 @@ class AsyncWeaviateKnowledgeBase:
             max_retries=5,
         )
 
-    @backoff.on_exception(backoff.expo, exception=asyncio.CancelledError)  # type: ignore
-    async def search_knowledgebase(self, keyword: str) -> SearchResults:
+    async def search_knowledgebase(
+        self, keyword: str, vector: list[float] | None = None
+    ) -> SearchResults:
         """Search knowledge base.
 
         Parameters
         ----------
         keyword : str
             The search keyword to query the knowledge base.
+        vector : list[float], optional, default=None
+            Precomputed embedding of `keyword` (see `vectorize_batch`). Computed on
+            demand when not provided.
 
         Returns
         -------
@@ -87,22 +144,27 @@ class AsyncWeaviateKnowledgeBase:
 
         Raises
         ------
-        Exception
-            If Weaviate is not ready to accept requests (HTTP 503).
+        resilience.DependencyUnavailableError
+            If Weaviate is not ready to accept requests (HTTP 503) or unreachable
+            after the retries, or its circuit is open.
 
         """
-        async with self.async_client:
-            if not await self.async_client.is_ready():
-                raise Exception("Weaviate is not ready to accept requests (HTTP 503).")
-
-            collection = self.async_client.collections.get(self.collection_name)
-            vector = self._vectorize(keyword)
-            response = await rate_limited(
-                lambda: collection.query.hybrid(
-                    keyword, vector=vector, limit=self.num_results
-                ),
-                semaphore=self.semaphore,
-            )
+        if vector is None:
+            # The embedding client is synchronous; calling it on the loop would stall every concurrent request.
+            vector = await call_dependency(WEAVIATE, lambda: asyncio.to_thread(self._vectorize, keyword))
+
+        async def query():
+            async with self.async_client:
+                await self._check_ready()
+                collection = self.async_client.collections.get(self.collection_name)
+                return await rate_limited(
+                    lambda: collection.query.hybrid(
+                        keyword, vector=vector, limit=self.num_results
+                    ),
+                    semaphore=self.semaphore,
+                )
+
+        response = await call_dependency(WEAVIATE, query)
 
         self.logger.info(f"Query: {keyword}; Returned matches: {len(response.objects)}")
 
@@ -121,6 +183,94 @@ class AsyncWeaviateKnowledgeBase:
 
         return [_SearchResult.model_validate(_hit) for _hit in hits]
 
+    async def search_knowledgebase_multi(
+        self,
+        queries: list[str],
+        vectors: list[list[float] | None] | None = None,
+    ) -> SearchResults:
+        """Search knowledge base with several variants of a query at once.
+
+        The variants run concurrently (bounded by `max_concurrency`) and their
+        results are fused with reciprocal rank fusion and deduplicated by title.
+        Only `RETURN_PROPERTIES` are fetched. Weaviate has no server-side
+        highlighting, so each result's text is cut to a snippet of
+        `snippet_chars` around the query terms before it is returned.
+
+        Parameters
+        ----------
+        queries : list[str]
+            Query variants, e.g. the question and its keywords.
+        vectors : list[list[float] | None], optional, default=None
+            Precomputed embeddings per variant. Missing ones are computed in a
+            single batched embedding request.
+
+        Returns
+        -------
+        SearchResults
+            At most `num_results` fused results, best first.
+
+        Raises
+        ------
+        resilience.DependencyUnavailableError
+            If Weaviate is not ready to accept requests (HTTP 503) or unreachable
+            after the retries, or its circuit is open.
+
+        """
+        vectors = list(vectors) if vectors is not None else [None] * len(queries)
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = await self.vectorize_batch([queries[index] for index in missing])
+            for index, vector in zip(missing, computed):
+                vectors[index] = vector
+
+        async def query():
+            async with self.async_client:
+                await self._check_ready()
+                collection = self.async_client.collections.get(self.collection_name)
+                return await asyncio.gather(
+                    *(
+                        rate_limited(
+                            lambda query=query, vector=vector: collection.query.hybrid(
+                                query,
+                                vector=vector,
+                                limit=self.num_results,
+                                return_properties=RETURN_PROPERTIES,
+                            ),
+                            semaphore=self.semaphore,
+                        )
+                        for query, vector in zip(queries, vectors)
+                    )
+                )
+
+        responses = await call_dependency(WEAVIATE, query)
+
+        result_lists = []
+        for query, response in zip(queries, responses):
+            self.logger.info(f"Query: {query}; Returned matches: {len(response.objects)}")
+            result_lists.append(
+                [
+                    _SearchResult.model_validate(
+                        {
+                            "_source": {
+                                "title": obj.properties.get("title", ""),
+                                "section": obj.properties.get("section", None),
+                            },
+                            "highlight": {"text": [obj.properties.get("text", "")]},
+                        }
+                    )
+                    for obj in response.objects
+                ]
+            )
+
+        return fuse_search_results(
+            result_lists, self.num_results, queries, self.snippet_chars
+        )
+
+    async def _check_ready(self) -> None:
+        if not await self.async_client.is_ready():
+            # A connection-level error, so the call is retried and counts against Weaviate's circuit.
+            raise ConnectionError("Weaviate is not ready to accept requests (HTTP 503).")
+
     def _vectorize(self, text: str) -> list[float]:
         """Vectorize text using the embedding client.
 
@@ -139,6 +289,46 @@ class AsyncWeaviateKnowledgeBase:
         )
         return response.data[0].embedding
 
+    async def vectorize_batch(
+        self, texts: list[str], batch_size: int = 64
+    ) -> list[list[float]]:
+        """Vectorize many texts with one embedding request per `batch_size` texts.
+
+        Parameters
+        ----------
+        texts : list[str]
+            The texts to be vectorized.
+        batch_size : int, optional, default=64
+            Maximum number of texts sent in a single embedding request.
+
+        Returns
+        -------
+        list[list[float]]
+            One vector per input text, in input order.
+
+        Raises
+        ------
+        resilience.DependencyUnavailableError
+            If the embedding endpoint stays unreachable after the retries, or
+            Weaviate's circuit is open.
+        """
+        vectors: list[list[float]] = []
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start : start + batch_size]
+            # Embeddings feed the Weaviate queries, so they share its circuit breaker, timeout and retries.
+            response = await call_dependency(
+                WEAVIATE,
+                lambda batch=batch: asyncio.to_thread(
+                    self._embed_client.embeddings.create,
+                    input=batch,
+                    model=self.embedding_model_name,
+                ),
+            )
+            vectors.extend(
+                item.embedding for item in sorted(response.data, key=lambda d: d.index)
+            )
+        return vectors
+
 
 def get_weaviate_async_client(
     http_host: str | None = None,
@@ -1,6 +1,6 @@
+import functools
 import os
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
 
 load_dotenv()
 
@@ -12,7 +12,28 @@ AGENT_LLM_NAMES = {
     "planner": GEMINI_PRO,  # more expensive, better at reasoning and planning
 }
 
-LLM = ChatOpenAI(model_name=AGENT_LLM_NAMES['worker'], openai_api_base=os.getenv("OPENAI_BASE_URL"))
+# Client-side throttling per model, see rate_limiter.py. Tune these to the quota of the provider project in use.
+AGENT_LLM_RATE_LIMITS = {
+    GEMINI_FLASH: {
+        'requests_per_second': float(os.getenv("GEMINI_FLASH_REQUESTS_PER_SECOND", "15")),
+        'tokens_per_minute': float(os.getenv("GEMINI_FLASH_TOKENS_PER_MINUTE", "1000000")),
+    },
+    GEMINI_PRO: {
+        'requests_per_second': float(os.getenv("GEMINI_PRO_REQUESTS_PER_SECOND", "2")),
+        'tokens_per_minute': float(os.getenv("GEMINI_PRO_TOKENS_PER_MINUTE", "2000000")),
+    },
+}
+
+
+# The chat clients (and langchain_openai itself) are created on first use, so importing this module stays cheap.
+@functools.cache
+def get_llm():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model_name=AGENT_LLM_NAMES['worker'], openai_api_base=os.getenv("OPENAI_BASE_URL"))
+
 
-DEEP_RESEARCH_LLM = ChatOpenAI(model_name=AGENT_LLM_NAMES['planner'], openai_api_base=os.getenv("OPENAI_BASE_URL"))
+@functools.cache
+def get_deep_research_llm():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model_name=AGENT_LLM_NAMES['planner'], openai_api_base=os.getenv("OPENAI_BASE_URL"))
 
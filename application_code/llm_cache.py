@@ -0,0 +1,120 @@
+"""
+Persistent cache for deterministic LLM outputs.
+
+Entries live in a small SQLite file keyed by a hash of the normalized input, the prompt template and the model name,
+so editing the prompt or switching models never serves stale results. Entries expire after a TTL and the least
+recently used ones are evicted once the cache grows beyond `max_entries`. The file is opened in WAL mode with a busy
+timeout, since every server worker process shares it; callers treat `sqlite3.Error` as a miss (or a skipped write).
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_CACHE_FOLDER = Path(__file__).parent / "cache"
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation so trivially different questions share a key."""
+    return re.sub(r"\s+", " ", query or "").strip().lower().rstrip("?!. ")
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_cache_key(query: str, prompt_template: str, model_name: str) -> str:
+    return hash_text(json.dumps({
+        'query': normalize_query(query),
+        'prompt': hash_text(prompt_template),
+        'model': model_name,
+    }, sort_keys=True))
+
+
+class PersistentLLMCache:
+    """SQLite-backed key/value cache with TTL and size-bounded LRU eviction."""
+
+    def __init__(self, path: str | os.PathLike, ttl_seconds: float, max_entries: int, busy_timeout: float = 5.0):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Workers wait up to `busy_timeout` for each other's writes, and readers never block on a writer in WAL mode.
+        self._connection = sqlite3.connect(self.path, timeout=busy_timeout, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._connection.commit()
+
+    def get_sync(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._connection.commit()
+                return None
+            self._connection.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            return row[0]
+
+    def set_sync(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl_seconds, now),
+            )
+            self._connection.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+            self._connection.execute(
+                "DELETE FROM entries WHERE key IN ("
+                "SELECT key FROM entries ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._connection.commit()
+
+    async def get(self, key: str) -> str | None:
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def set(self, key: str, value: str):
+        await asyncio.to_thread(self.set_sync, key, value)
+
+
+_cql_cache: PersistentLLMCache | None = None
+
+
+def get_cql_cache() -> PersistentLLMCache | None:
+    """
+    Process-wide cache for agent 1's structured CQL output, or None when CQL_CACHE_ENABLED is false or the cache file
+    cannot be opened.
+    """
+    global _cql_cache
+    if os.getenv("CQL_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    if _cql_cache is None:
+        try:
+            _cql_cache = PersistentLLMCache(
+                path=os.getenv("CQL_CACHE_PATH", str(DEFAULT_CACHE_FOLDER / "cql_cache.sqlite3")),
+                ttl_seconds=float(os.getenv("CQL_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+                max_entries=int(os.getenv("CQL_CACHE_MAX_ENTRIES", "10000")),
+                busy_timeout=float(os.getenv("CQL_CACHE_BUSY_TIMEOUT_SECONDS", "5")),
+            )
+        except (sqlite3.Error, OSError) as e:
+            print(f"CQL cache unavailable, generating CQL without it: {e!r}")
+            return None
+    return _cql_cache
@@ -0,0 +1,313 @@
+"""
+Asyncio load generator for `graph.execute_user_query`.
+
+Drives the streaming entry point from a single event loop, either open-loop at a target QPS or closed-loop at a
+fixed concurrency, using queries from a replayable log. For every load step it reports time-to-first-chunk,
+total latency percentiles, error rate and achieved throughput, and flags the step at which the system saturated.
+
+Query log format: one query per line, either plain text or JSON such as
+`{"query": "What is Maple trust bank?", "offset": 1.25}` where `offset` is the original arrival time in seconds.
+
+Usage:
+    python3 -m load_test --qps 0.5 1 2 4 --duration 60 --queries queries.jsonl
+    python3 -m load_test --concurrency 1 2 4 8 --duration 60 --ramp-up 10
+    python3 -m load_test --replay queries.jsonl --speed 2
+    python3 -m load_test --concurrency 1 4 16 --duration 20 --offline
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+from metrics import summarize_latencies
+
+SATURATION_ERROR_RATE = 0.05
+SATURATION_THROUGHPUT_RATIO = 0.9
+SATURATION_LATENCY_GROWTH = 2.0
+
+
+@dataclass
+class LoggedQuery:
+    query: str
+    offset: float | None = None
+
+
+@dataclass
+class RequestOutcome:
+    query: str
+    scheduled_at: float
+    started_at: float
+    first_chunk_at: float | None = None
+    finished_at: float | None = None
+    chunks: int = 0
+    error: str | None = None
+
+    @property
+    def time_to_first_chunk(self) -> float | None:
+        return None if self.first_chunk_at is None else self.first_chunk_at - self.scheduled_at
+
+    @property
+    def latency(self) -> float | None:
+        return None if self.finished_at is None else self.finished_at - self.scheduled_at
+
+
+@dataclass
+class StepReport:
+    mode: str
+    target: float
+    duration: float
+    sent: int
+    completed: int
+    errors: int
+    error_rate: float
+    offered_rps: float
+    achieved_rps: float
+    time_to_first_chunk: Dict[str, float]
+    latency: Dict[str, float]
+    error_samples: List[str] = field(default_factory=list)
+    saturated: bool = False
+
+
+def load_query_log(path: str | os.PathLike) -> List[LoggedQuery]:
+    queries = []
+    with open(path, mode='r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                queries.append(LoggedQuery(query=entry['query'], offset=entry.get('offset')))
+            else:
+                queries.append(LoggedQuery(query=line))
+    return queries
+
+
+async def run_request(query: str, scheduled_at: float, execute) -> RequestOutcome:
+    """Consume one streamed answer, recording when the first and last chunks arrive."""
+    outcome = RequestOutcome(query=query, scheduled_at=scheduled_at, started_at=time.perf_counter())
+    try:
+        async for _ in execute(query):
+            if outcome.first_chunk_at is None:
+                outcome.first_chunk_at = time.perf_counter()
+            outcome.chunks += 1
+        outcome.finished_at = time.perf_counter()
+    except Exception as e:
+        outcome.error = f"{type(e).__name__}: {e}"
+    return outcome
+
+
+def _arrival_time(arrivals: float, qps: float, ramp_up: float) -> float:
+    """
+    Seconds after the step start at which the `arrivals`-th request is due, when the rate grows linearly from 0 to
+    `qps` over `ramp_up` seconds and then stays flat.
+    """
+    ramp_arrivals = qps * ramp_up / 2
+    if arrivals < ramp_arrivals:
+        return (2 * ramp_up * arrivals / qps) ** 0.5
+    return ramp_up + (arrivals - ramp_arrivals) / qps
+
+
+async def open_loop_step(queries: Sequence[LoggedQuery], qps: float, duration: float, ramp_up: float,
+                         poisson: bool, execute) -> List[RequestOutcome]:
+    """Send requests at `qps` (linearly ramped over `ramp_up` seconds) regardless of how fast they finish."""
+    rng = random.Random(0)
+    tasks = []
+    started = time.perf_counter()
+    arrivals = 0.0
+    index = 0
+    while (offset := _arrival_time(arrivals, qps, ramp_up)) < duration:
+        scheduled_at = started + offset
+        await asyncio.sleep(max(0.0, scheduled_at - time.perf_counter()))
+        query = queries[index % len(queries)].query
+        tasks.append(asyncio.create_task(run_request(query, scheduled_at, execute)))
+        index += 1
+        arrivals += rng.expovariate(1.0) if poisson else 1.0
+    return list(await asyncio.gather(*tasks))
+
+
+async def closed_loop_step(queries: Sequence[LoggedQuery], concurrency: int, duration: float, ramp_up: float,
+                           execute) -> List[RequestOutcome]:
+    """Keep `concurrency` users busy for `duration` seconds, starting them gradually over `ramp_up` seconds."""
+    outcomes = []
+    counter = iter(range(sys.maxsize))
+    started = time.perf_counter()
+
+    async def user(user_index: int):
+        await asyncio.sleep(ramp_up * user_index / concurrency)
+        while time.perf_counter() - started < duration:
+            query = queries[next(counter) % len(queries)].query
+            outcomes.append(await run_request(query, time.perf_counter(), execute))
+
+    await asyncio.gather(*(user(user_index) for user_index in range(concurrency)))
+    return outcomes
+
+
+async def replay(queries: Sequence[LoggedQuery], speed: float, execute) -> List[RequestOutcome]:
+    """Re-issue a logged session at its original arrival offsets, `speed` times faster."""
+    started = time.perf_counter()
+    tasks = []
+    for index, entry in enumerate(queries):
+        offset = entry.offset if entry.offset is not None else float(index)
+        scheduled_at = started + offset / speed
+        await asyncio.sleep(max(0.0, scheduled_at - time.perf_counter()))
+        tasks.append(asyncio.create_task(run_request(entry.query, scheduled_at, execute)))
+    return list(await asyncio.gather(*tasks))
+
+
+def summarize_step(mode: str, target: float, outcomes: Sequence[RequestOutcome]) -> StepReport:
+    successes = [outcome for outcome in outcomes if outcome.error is None]
+    errors = [outcome.error for outcome in outcomes if outcome.error is not None]
+    first_scheduled = min((outcome.scheduled_at for outcome in outcomes), default=0.0)
+    last_scheduled = max((outcome.scheduled_at for outcome in outcomes), default=0.0)
+    last_finished = max((outcome.finished_at or outcome.scheduled_at for outcome in outcomes), default=0.0)
+    duration = max(last_finished - first_scheduled, 1e-9)
+    send_window = max(last_scheduled - first_scheduled, 1e-9)
+    latency = summarize_latencies(outcome.latency for outcome in successes)
+    # The tail of a step is spent draining requests that were already in flight; leave one median latency of it out
+    # so short steps are not reported as saturated.
+    busy_window = max(duration - latency['p50'], send_window)
+
+    return StepReport(
+        mode=mode,
+        target=target,
+        duration=duration,
+        sent=len(outcomes),
+        completed=len(successes),
+        errors=len(errors),
+        error_rate=len(errors) / len(outcomes) if outcomes else 0.0,
+        offered_rps=(len(outcomes) - 1) / send_window if mode != 'concurrency' and len(outcomes) > 1 else 0.0,
+        achieved_rps=len(successes) / busy_window,
+        time_to_first_chunk=summarize_latencies(
+            outcome.time_to_first_chunk for outcome in successes if outcome.time_to_first_chunk is not None
+        ),
+        latency=latency,
+        error_samples=errors[:3],
+    )
+
+
+def mark_saturation(steps: Sequence[StepReport]) -> StepReport | None:
+    """
+    Flag the first step where the system stopped keeping up: too many errors, throughput falling short of the
+    offered open-loop rate (or not growing with closed-loop concurrency), or p95 latency doubling over the
+    lightest step.
+    """
+    if not steps:
+        return None
+
+    baseline_p95 = steps[0].latency.get('p95') or 0.0
+    previous = None
+    for step in steps:
+        if step.mode == 'qps':
+            falling_behind = step.achieved_rps < SATURATION_THROUGHPUT_RATIO * step.offered_rps
+        else:
+            falling_behind = previous is not None and step.achieved_rps < previous.achieved_rps * 1.05
+        step.saturated = (
+                step.error_rate > SATURATION_ERROR_RATE
+                or falling_behind
+                or (baseline_p95 > 0 and step.latency['p95'] > SATURATION_LATENCY_GROWTH * baseline_p95)
+        )
+        if step.saturated:
+            return step
+        previous = step
+    return None
+
+
+def print_step(step: StepReport):
+    ttfc, latency = step.time_to_first_chunk, step.latency
+    print(f"[{step.mode}={step.target:g}] sent={step.sent} ok={step.completed} errors={step.error_rate:.1%} "
+          f"{f'offered={step.offered_rps:.2f}rps ' if step.offered_rps else ''}achieved={step.achieved_rps:.2f}rps "
+          f"ttfc p50={ttfc['p50']:.2f}s p95={ttfc['p95']:.2f}s "
+          f"latency p50={latency['p50']:.2f}s p95={latency['p95']:.2f}s p99={latency['p99']:.2f}s"
+          f"{' SATURATED' if step.saturated else ''}")
+    for error in step.error_samples:
+        print(f"    error: {error}")
+
+
+async def run_load_test(args: argparse.Namespace) -> Dict:
+    from graph import execute_user_query
+
+    queries = load_query_log(args.queries) if args.queries else [
+        LoggedQuery(query="What is Maple trust bank?")
+    ]
+
+    steps = []
+    if args.replay:
+        outcomes = await replay(load_query_log(args.replay), args.speed, execute_user_query)
+        steps.append(summarize_step('replay', args.speed, outcomes))
+    elif args.qps:
+        for qps in args.qps:
+            outcomes = await open_loop_step(queries, qps, args.duration, args.ramp_up, args.poisson,
+                                            execute_user_query)
+            steps.append(summarize_step('qps', qps, outcomes))
+    else:
+        for concurrency in args.concurrency:
+            outcomes = await closed_loop_step(queries, concurrency, args.duration, args.ramp_up,
+                                              execute_user_query)
+            steps.append(summarize_step('concurrency', concurrency, outcomes))
+
+    saturation = mark_saturation(steps) if not args.replay else None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'offline': args.offline,
+        'duration_per_step': args.duration,
+        'ramp_up': args.ramp_up,
+        'steps': [asdict(step) for step in steps],
+        'saturation_point': None if saturation is None else {'mode': saturation.mode, 'target': saturation.target},
+    }
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test execute_user_query from a single event loop.")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--qps", type=float, nargs="+", help="Open-loop arrival rates, one step each.")
+    load.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4],
+                      help="Closed-loop concurrent users, one step each.")
+    load.add_argument("--replay", help="Query log with offsets to replay at its original pace.")
+    parser.add_argument("--queries", help="Query log to cycle through for --qps/--concurrency steps.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per step.")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Seconds to ramp each step up to its target.")
+    parser.add_argument("--poisson", action="store_true", help="Poisson instead of evenly spaced arrivals.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed-up factor.")
+    parser.add_argument("--offline", action="store_true", help="Use the benchmark's local service stand-ins.")
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the workflow's own prints.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None):
+    args = parse_args(argv)
+
+    services = contextlib.nullcontext()
+    if args.offline:
+        from benchmark import offline_services
+        from corpus import iter_ingested_pages
+        services = offline_services(list(iter_ingested_pages()), jitter=0.2, tail_probability=0.02)
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    with services, output:
+        report = asyncio.run(run_load_test(args))
+
+    for step in report['steps']:
+        print_step(StepReport(**step))
+    saturation = report['saturation_point']
+    print(f"Saturation point: {saturation['mode']}={saturation['target']:g}" if saturation
+          else "Saturation point: not reached")
+
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, mode='w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Event loop lag monitor for the async request path.
+
+Synchronous work on the event loop (a blocking client call, a large `json.dumps`, formatting a big state dict for a
+print) stalls every request the worker is serving. The monitor has two parts:
+    - a heartbeat task that sleeps LOOP_LAG_INTERVAL_MS at a time and records how late it wakes up; the samples of the
+      last LOOP_LAG_WINDOW_SECONDS give the lag percentiles,
+    - a watchdog thread that notices when the heartbeat is more than LOOP_LAG_THRESHOLD_MS late while the loop is still
+      blocked, and captures the loop thread's stack at that moment, which is the stack of the code holding the loop.
+Each stall is printed once, with its stack, when the watchdog catches it; the last LOOP_STALL_HISTORY stalls are kept
+with their stacks and final duration for `/healthz`. The server exposes the lag percentiles and stall count on
+`/metrics` in the Prometheus text format; every worker process reports its own loop.
+
+Configuration (environment):
+    LOOP_MONITOR                "true" (default) to monitor the server workers' loops
+    LOOP_LAG_INTERVAL_MS        heartbeat interval (default 50)
+    LOOP_LAG_THRESHOLD_MS       lag from which the loop counts as blocked and its stack is captured (default 100)
+    LOOP_LAG_WINDOW_SECONDS     window of the lag percentiles (default 60)
+    LOOP_STALL_HISTORY          stalls kept with their stacks (default 20)
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List
+
+from metrics import DEFAULT_PERCENTILES, summarize_latencies
+
+MAX_STACK_FRAMES = 30
+
+
+@dataclass
+class Stall:
+    detected_at: float
+    task: str | None
+    stack: List[str] = field(default_factory=list)
+    lag: float | None = None  # Set once the loop is free again.
+
+    def to_dict(self) -> Dict:
+        return {
+            'detected_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.detected_at)),
+            'lag_ms': round(self.lag * 1000, 1) if self.lag is not None else None,
+            'task': self.task,
+            'stack': self.stack,
+        }
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.05, threshold: float = 0.1, window: float = 60.0, history: int = 20):
+        self.interval = interval
+        self.threshold = threshold
+        self.window = window
+        self.samples: Deque[float] = deque(maxlen=max(1, int(window / interval)))
+        self.stalls: Deque[Stall] = deque(maxlen=history)
+        self.sample_count = 0
+        self.lag_sum = 0.0
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self._lock = threading.Lock()
+        self._expected_wakeup: float | None = None
+        self._current_stall: Stall | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_env(cls) -> "LoopLagMonitor":
+        return cls(
+            interval=float(os.getenv("LOOP_LAG_INTERVAL_MS", "50")) / 1000,
+            threshold=float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000,
+            window=float(os.getenv("LOOP_LAG_WINDOW_SECONDS", "60")),
+            history=int(os.getenv("LOOP_STALL_HISTORY", "20")),
+        )
+
+    def start(self):
+        """Start monitoring the running loop; call from a coroutine on that loop."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._task = self._loop.create_task(self._heartbeat(), name="loop-lag-heartbeat")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._watchdog is not None:
+            await asyncio.to_thread(self._watchdog.join)
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            self._expected_wakeup = expected
+            await asyncio.sleep(self.interval)
+            self._record(max(0.0, time.monotonic() - expected))
+
+    def _record(self, lag: float):
+        with self._lock:
+            self.samples.append(lag)
+            self.sample_count += 1
+            self.lag_sum += lag
+            self.max_lag = max(self.max_lag, lag)
+            self.stall_count += lag >= self.threshold
+            stall, self._current_stall = self._current_stall, None
+        if stall is not None:
+            stall.lag = lag
+
+    def _watch(self):
+        # Polling at half the threshold catches every stall that lasts at least 1.5 thresholds.
+        while not self._stopped.wait(self.threshold / 2):
+            expected = self._expected_wakeup
+            if expected is None or self._current_stall is not None:
+                continue
+            late = time.monotonic() - expected
+            if late < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame)[-MAX_STACK_FRAMES:]
+            del frame
+            try:
+                task = asyncio.current_task(self._loop)
+            except RuntimeError:
+                task = None
+            stall = Stall(time.time(), task.get_name() if task is not None else None, stack)
+            with self._lock:
+                if self._expected_wakeup != expected:
+                    continue  # The loop got free while the stack was being captured.
+                self._current_stall = stall
+                self.stalls.append(stall)
+            print(f"Event loop blocked for more than {late * 1000:.0f} ms"
+                  f"{f' in task {stall.task}' if stall.task else ''}, at:\n{''.join(stack)}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            window = summarize_latencies(self.samples)
+            stalls = [stall.to_dict() for stall in self.stalls]
+            return {
+                'interval_ms': self.interval * 1000,
+                'threshold_ms': self.threshold * 1000,
+                'lag_ms': {key: round(value * 1000, 2) if key != 'count' else value for key, value in window.items()},
+                'max_lag_ms': round(self.max_lag * 1000, 2),
+                'stalls': self.stall_count,
+                'recent_stalls': stalls,
+            }
+
+    def prometheus_metrics(self) -> str:
+        """Lag percentiles over the window (a Prometheus summary) and stall counts, in the text exposition format."""
+        with self._lock:
+            window = summarize_latencies(self.samples)
+            lines = [
+                f"# HELP event_loop_lag_seconds Event loop lag, quantiles over the last {self.window:g} s.",
+                "# TYPE event_loop_lag_seconds summary",
+                *(f'event_loop_lag_seconds{{quantile="{pct / 100:g}"}} {window[f"p{pct:g}"]:.6f}'
+                  for pct in DEFAULT_PERCENTILES),
+                f"event_loop_lag_seconds_sum {self.lag_sum:.6f}",
+                f"event_loop_lag_seconds_count {self.sample_count}",
+                "# HELP event_loop_lag_max_seconds Largest event loop lag since the worker started.",
+                "# TYPE event_loop_lag_max_seconds gauge",
+                f"event_loop_lag_max_seconds {self.max_lag:.6f}",
+                f"# HELP event_loop_stalls_total Heartbeats late by at least {self.threshold * 1000:g} ms.",
+                "# TYPE event_loop_stalls_total counter",
+                f"event_loop_stalls_total {self.stall_count}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def loop_monitor_enabled() -> bool:
+    return os.getenv("LOOP_MONITOR", "true").lower() == "true"
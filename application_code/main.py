@@ -1,9 +1,9 @@
 import asyncio
-from llm import LLM
+from llm import get_llm
 
 
 async def test_connection_with_llm():
-    resp = await LLM.ainvoke(input="ping")
+    resp = await get_llm().ainvoke(input="ping")
     print(f"Response from LLM is: {resp.content}")
 
 
@@ -1,23 +1,41 @@
+import asyncio
+import functools
 from typing import Dict
 
 from mcp.server.fastmcp import FastMCP
-from atlassian import Confluence
-import html2text
 import os
+import time
 from dotenv import load_dotenv
+
+from page_store import convert_page_async, format_page, get_page_store, page_store_ttl
+from resilience import CONFLUENCE, DependencyUnavailableError, call_dependency, dependency_policy
+
 load_dotenv()
 
 mcp = FastMCP(name="Confluence MCP Server")
 
-confluence = Confluence(
-    url=os.getenv("CONFLUENCE_URL"),
-    username=os.getenv("CONFLUENCE_ACCOUNT"),
-    password=os.getenv("CONFLUENCE_TOKEN"),
-    cloud=True)
+
+@functools.cache
+def get_confluence():
+    # atlassian-python-api is imported and the client created on first use, not at import.
+    from atlassian import Confluence
+    return Confluence(
+        url=os.getenv("CONFLUENCE_URL"),
+        username=os.getenv("CONFLUENCE_ACCOUNT"),
+        password=os.getenv("CONFLUENCE_TOKEN"),
+        cloud=True,
+        timeout=dependency_policy(CONFLUENCE).timeout)
+
+
+async def call_confluence(method: str, *args, **kwargs):
+    """One Confluence API call, off the event loop and under Confluence's circuit breaker (see resilience.py)."""
+    return await call_dependency(
+        CONFLUENCE, lambda: asyncio.to_thread(getattr(get_confluence(), method), *args, **kwargs)
+    )
 
 
 @mcp.tool()
-def search_confluence_based_on_cql_query(cql: str) -> Dict:
+async def search_confluence_based_on_cql_query(cql: str, start: int = 0, limit: int = 10) -> Dict:
     """
     Search Confluence pages using Confluence Query Language (CQL) for advanced content discovery.
 
@@ -47,6 +65,9 @@ def search_confluence_based_on_cql_query(cql: str) -> Dict:
                   Note: The 'siteSearch' operator mentioned in the original description
                   is just one of many available CQL operators. This tool accepts any
                   valid CQL syntax for maximum flexibility.
+        start (int, optional): Index of the first result to return, for fetching the next page
+                              of results. Defaults to 0.
+        limit (int, optional): Number of results to return, between 1 and 50. Defaults to 10.
 
     Returns:
         Dict: A comprehensive dictionary containing search results with the following structure:
@@ -70,11 +91,11 @@ def search_confluence_based_on_cql_query(cql: str) -> Dict:
               - Identify relevant pages for further processing
               - Build content inventories and reports
     """
-    return confluence.cql(cql, start=0, limit=10)
+    return await call_confluence("cql", cql, start=max(0, start), limit=max(1, min(limit, 50)))
 
 
 @mcp.tool()
-def get_page_by_id(page_id: str, title: str = None) -> str:
+async def get_page_by_id(page_id: str, title: str = None) -> str:
     """
     Retrieve a Confluence page's content by ID and convert it to Markdown format.
 
@@ -108,27 +129,36 @@ def get_page_by_id(page_id: str, title: str = None) -> str:
 
     Example:
         # Basic usage
-        content = get_page_by_id("123456789")
+        content = await get_page_by_id("123456789")
 
         # With custom title
-        content = get_page_by_id("123456789", title="Project Requirements")
+        content = await get_page_by_id("123456789", title="Project Requirements")
     """
-    response = confluence.get_page_by_id(
-        page_id, expand="body.storage,version,history"
-    )
-
-    html_content = response["body"]["storage"]["value"]
-    markdown_text = html2text.html2text(html_content)
-
-    creator = response.get("history", {}).get("createdBy", {}).get("displayName", "Unknown")
-    editor = response.get("version", {}).get("by", {}).get("displayName", "Unknown")
-
-    extra_info = f"\n\n Page Created by: {creator}\n Page Last edited by: {editor}\n"
-
-    if title:
-        return f"Title of the page is {title} \n {extra_info} and markdown of the page is \n\n {markdown_text}"
-    return extra_info + markdown_text
-
+    store = get_page_store()
+    stored = store.get(page_id) if store is not None else None
+    if stored is not None and time.time() - stored.stored_at > page_store_ttl():
+        # Past the TTL, one light version lookup decides whether the stored copy can still be served.
+        try:
+            current = await call_confluence("get_page_by_id", page_id, expand="version")
+        except DependencyUnavailableError as e:
+            # A possibly stale page is more useful than none while Confluence is unreachable.
+            print(f"Serving stored page {page_id} without a version check, {e}.")
+            current = {"version": {"number": stored.version}}
+        current_version = current.get("version", {}).get("number")
+        if current_version == stored.version:
+            store.touch(page_id)
+        else:
+            stored = None
+
+    if stored is None:
+        response = await call_confluence("get_page_by_id", page_id, expand="body.storage,version,history")
+        version, extra_info, markdown_text = await convert_page_async(response)
+        if store is not None:
+            store.put(page_id, version, extra_info, markdown_text)
+    else:
+        extra_info, markdown_text = stored.header, stored.markdown
+
+    return format_page(extra_info, markdown_text, title)
 
 if __name__ == "__main__":
     # Initialize and run the server
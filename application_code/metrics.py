@@ -0,0 +1,41 @@
+"""Small helpers for summarising latency samples."""
+
+import math
+from typing import Dict, Iterable, Sequence
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(samples: Sequence[float], pct: float) -> float:
+    """Return the pct-th percentile of samples using linear interpolation.
+
+    :param samples: Observed values, in any order.
+    :param pct: Percentile between 0 and 100.
+    :return: The interpolated percentile, or 0.0 when there are no samples.
+    """
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * (pct / 100)
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    if lower == upper:
+        return ordered[int(rank)]
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize_latencies(
+    samples: Iterable[float],
+    percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+) -> Dict[str, float]:
+    """Summarise latency samples (seconds) as count, mean, max and percentiles."""
+    values = list(samples)
+    summary = {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else 0.0,
+        'max': max(values) if values else 0.0,
+    }
+    for pct in percentiles:
+        summary[f"p{pct:g}"] = percentile(values, pct)
+    return summary
@@ -0,0 +1,316 @@
+"""
+Near-duplicate detection with MinHash signatures over word shingles.
+
+Two texts are near-duplicates when the Jaccard similarity of their sets of `SHINGLE_WORDS`-word shingles is at least
+the threshold. Each text is reduced to a `NUM_PERMUTATIONS`-value MinHash signature, whose share of equal values
+estimates that similarity; locality-sensitive hashing over bands of the signature proposes candidate pairs, so texts
+are never compared all against all. Near-duplicates are grouped into clusters (connected components) with one
+canonical member each.
+
+Used at two points:
+    ingestion   `ingestion_prep` records the canonical page of each cluster (its longest page) on every exported row;
+                readers of the export only see canonical pages.
+    query time  agent 3 drops Confluence candidates that the export collapsed or whose title and excerpt duplicate a
+                better-ranked candidate, before any page is downloaded (only candidates whose excerpt has at least
+                MIN_EXCERPT_SHINGLES shingles are compared by text; a short or empty excerpt says too little); agent 5 drops downloaded pages and vector hits
+                that duplicate one another before the summarization prompt is built. The clusters dropped are reported
+                in the state (`agent_3_near_duplicates`) and, summed up, in `/healthz`.
+
+Configuration (environment):
+    NEAR_DUPLICATE_FILTER       "false" to keep near-duplicate candidates and pages at query time (default "true")
+    NEAR_DUPLICATE_THRESHOLD    estimated Jaccard similarity from which two texts are near-duplicates (default 0.8)
+"""
+
+import argparse
+import functools
+import os
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, Hashable, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+NUM_PERMUTATIONS = 128
+SHINGLE_WORDS = 5
+DEFAULT_THRESHOLD = 0.8
+# CQL excerpts are short and often empty; distinct pages with the same title and a few shared words are not duplicates.
+MIN_EXCERPT_SHINGLES = 8
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def shingles(text: str, size: int = SHINGLE_WORDS) -> set:
+    """Hashes of the text's `size`-word shingles; a text shorter than that is one shingle."""
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {zlib.crc32(" ".join(words).encode('utf-8'))} if words else set()
+    return {zlib.crc32(" ".join(words[start:start + size]).encode('utf-8')) for start in range(len(words) - size + 1)}
+
+
+def lsh_bands(threshold: float, num_permutations: int = NUM_PERMUTATIONS) -> Tuple[int, int]:
+    """(bands, rows) splitting the signature so that pairs around `threshold` similarity become candidates."""
+    best = None
+    for rows in range(1, num_permutations + 1):
+        if num_permutations % rows:
+            continue
+        bands = num_permutations // rows
+        # Similarity at which a pair has a 50% chance of sharing a band; aim a little below the threshold.
+        midpoint = (1 / bands) ** (1 / rows)
+        distance = abs(midpoint - (threshold - 0.05))
+        if best is None or distance < best[0]:
+            best = (distance, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    def __init__(self, num_permutations: int = NUM_PERMUTATIONS, seed: int = 1):
+        generator = np.random.default_rng(seed)
+        self.num_permutations = num_permutations
+        self.a = generator.integers(1, _MERSENNE_PRIME, size=num_permutations, dtype=np.uint64)
+        self.b = generator.integers(0, _MERSENNE_PRIME, size=num_permutations, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.fromiter(shingles(text), dtype=np.uint64) % np.uint64(_MERSENNE_PRIME)
+        if not len(hashes):
+            return np.full(self.num_permutations, _MERSENNE_PRIME, dtype=np.uint32)
+        # (a * x + b) mod p for every permutation and shingle; both factors stay below 2^31, so no overflow.
+        permuted = (hashes[:, None] * self.a[None, :] + self.b[None, :]) % np.uint64(_MERSENNE_PRIME)
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+@functools.cache
+def get_hasher() -> MinHasher:
+    return MinHasher()
+
+
+def similarity(first: np.ndarray, second: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the texts behind two signatures."""
+    return float(np.mean(first == second))
+
+
+class NearDuplicateIndex:
+    """Signatures of texts by key, with LSH buckets to find each text's near-duplicates."""
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, hasher: MinHasher | None = None):
+        self.threshold = threshold
+        self.hasher = hasher or get_hasher()
+        self.bands, self.rows = lsh_bands(threshold, self.hasher.num_permutations)
+        self.signatures: Dict[Hashable, np.ndarray] = {}
+        self.order: Dict[Hashable, int] = {}
+        self.buckets: List[Dict[bytes, List[Hashable]]] = [defaultdict(list) for _ in range(self.bands)]
+
+    def add(self, key: Hashable, text: str) -> List[Hashable]:
+        """Add a text and return the keys of the texts already added that it nearly duplicates, in insertion order."""
+        signature = self.hasher.signature(text)
+        matches = set()
+        for band, buckets in enumerate(self.buckets):
+            bucket = buckets[signature[band * self.rows:(band + 1) * self.rows].tobytes()]
+            for other in bucket:
+                if other not in matches and similarity(signature, self.signatures[other]) >= self.threshold:
+                    matches.add(other)
+            bucket.append(key)
+        self.signatures[key] = signature
+        self.order[key] = len(self.order)
+        return sorted(matches, key=self.order.__getitem__)
+
+
+def find_clusters(texts: Iterable[Tuple[Hashable, str]], threshold: float = DEFAULT_THRESHOLD) -> List[List[Hashable]]:
+    """Clusters (two or more keys, in input order) of near-duplicate texts."""
+    index = NearDuplicateIndex(threshold)
+    parent: Dict[Hashable, Hashable] = {}
+
+    def root(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    for key, text in texts:
+        parent[key] = key
+        for other in index.add(key, text):
+            parent[root(other)] = root(key)
+
+    clusters = defaultdict(list)
+    for key in parent:
+        clusters[root(key)].append(key)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def canonical_map(texts: Iterable[Tuple[Hashable, str]], threshold: float = DEFAULT_THRESHOLD) -> Dict[Hashable, List]:
+    """
+    The canonical key of every cluster (its longest text, the first one on a tie) mapped to the other keys of the
+    cluster. Only signatures are kept in memory, so `texts` can stream a whole corpus.
+    """
+    lengths = {}
+
+    def measured():
+        for key, text in texts:
+            lengths[key] = len(text)
+            yield key, text
+
+    canonical = {}
+    for members in find_clusters(measured(), threshold):
+        keep = max(members, key=lambda key: lengths[key])  # max keeps the first of equally long texts
+        canonical[keep] = [key for key in members if key != keep]
+    return canonical
+
+
+def dedupe_ranked(items: Sequence[Tuple[Hashable, str]], threshold: float = DEFAULT_THRESHOLD) -> Tuple[List, List]:
+    """
+    Keys of `items` (best first) to keep, each the best-ranked of its near-duplicates, and the clusters found, as
+    lists starting with the key kept.
+    """
+    index = NearDuplicateIndex(threshold)
+    kept, clusters = [], {}
+    owner = {}  # key -> the kept key it was dropped for (or itself)
+    for key, text in items:
+        matches = index.add(key, text)
+        if not matches:
+            owner[key] = key
+            kept.append(key)
+            continue
+        owner[key] = owner[matches[0]]
+        clusters.setdefault(owner[key], [owner[key]]).append(key)
+    return kept, list(clusters.values())
+
+
+class NearDuplicateStats:
+    """Process-wide counts of what the query-time filter dropped."""
+
+    def __init__(self):
+        self.filtered = 0
+        self.dropped = 0
+        self.clusters = 0
+
+    def record(self, clusters: List[List]):
+        self.filtered += 1
+        self.clusters += len(clusters)
+        self.dropped += sum(len(cluster) - 1 for cluster in clusters)
+
+    def stats(self) -> Dict:
+        return {'filtered': self.filtered, 'clusters': self.clusters, 'dropped': self.dropped}
+
+
+near_duplicate_stats = NearDuplicateStats()
+
+
+def query_time_threshold() -> float | None:
+    """Threshold of the query-time filter, or None when it is disabled."""
+    if os.getenv("NEAR_DUPLICATE_FILTER", "true").lower() != "true":
+        return None
+    return float(os.getenv("NEAR_DUPLICATE_THRESHOLD", str(DEFAULT_THRESHOLD)))
+
+
+@functools.cache
+def collapsed_pages() -> Dict[str, str]:
+    """Page id -> canonical page id for every page the local export collapsed, loaded once per process."""
+    try:
+        from ingestion_prep import EXPORT_FOLDER, is_export, open_export
+    except ImportError:  # pyarrow not installed
+        return {}
+    if not is_export(EXPORT_FOLDER):
+        return {}
+    table = open_export(EXPORT_FOLDER, columns=['page_id', 'canonical_id'])
+    return {
+        page_id: canonical_id
+        for page_id, canonical_id in zip(table.column('page_id').to_pylist(), table.column('canonical_id').to_pylist())
+        if canonical_id != page_id
+    }
+
+
+def filter_candidates(candidates: Dict[str, Dict], threshold: float) -> Tuple[Dict[str, Dict], Dict]:
+    """
+    Drop CQL candidates (page id -> page, best first) that the export collapsed into a page also among the candidates,
+    or whose title and excerpt nearly duplicate a better-ranked candidate's; candidates with a short excerpt are only
+    dropped through the export. Returns the kept candidates and a report.
+    """
+    collapsed = collapsed_pages()
+    clusters = defaultdict(list)
+    remaining = []
+    for page_id in candidates:
+        canonical = collapsed.get(page_id)
+        if canonical is not None and canonical in candidates:
+            clusters[canonical].append(page_id)
+        else:
+            remaining.append(page_id)
+
+    comparable = [
+        page_id for page_id in remaining
+        if len(shingles(str(candidates[page_id].get('matched_content') or ""))) >= MIN_EXCERPT_SHINGLES
+    ]
+    _, text_clusters = dedupe_ranked(
+        [(page_id, f"{candidates[page_id].get('title', '')} {candidates[page_id].get('matched_content', '')}")
+         for page_id in comparable],
+        threshold,
+    )
+    dropped = {page_id for cluster in text_clusters for page_id in cluster[1:]}
+    kept = [page_id for page_id in remaining if page_id not in dropped]
+    report_clusters = [[canonical, *duplicates] for canonical, duplicates in clusters.items()] + text_clusters
+    near_duplicate_stats.record(report_clusters)
+    report = {
+        'threshold': threshold,
+        'candidates': len(candidates),
+        'dropped': len(candidates) - len(kept),
+        'clusters': [
+            [{'page_id': page_id, 'title': candidates[page_id].get('title')} for page_id in cluster]
+            for cluster in report_clusters
+        ],
+    }
+    return {page_id: candidates[page_id] for page_id in kept}, report
+
+
+def filter_prompt_pages(page_map: Dict[str, Dict], vector_pages: List[Dict],
+                        threshold: float) -> Tuple[Dict[str, Dict], List[Dict], List[List[str]]]:
+    """
+    Drop downloaded pages and vector hits (dicts with page_content) that nearly duplicate one another, preferring
+    downloaded pages and then the better-ranked hit; a vector hit for a page that was downloaded is dropped outright.
+    Returns the kept pages and hits and the titles of the clusters found.
+    """
+    pages = {('page', page_id): page for page_id, page in page_map.items()}
+    pages.update({('vector', index): page for index, page in enumerate(vector_pages)})
+    kept, clusters = dedupe_ranked(
+        [(key, str(page.get('page_content') or "")) for key, page in pages.items()
+         if key[0] == 'page' or page.get('page_id') not in page_map],
+        threshold,
+    )
+    clusters += [
+        [('page', page['page_id']), key] for key, page in pages.items()
+        if key[0] == 'vector' and page.get('page_id') in page_map
+    ]
+    near_duplicate_stats.record(clusters)
+    kept = set(kept)
+    return (
+        {page_id: page for page_id, page in page_map.items() if ('page', page_id) in kept},
+        [page for index, page in enumerate(vector_pages) if ('vector', index) in kept],
+        [[pages[key].get('title') for key in cluster] for cluster in clusters],
+    )
+
+
+def main(argv=None):
+    from corpus import INGESTION_FOLDER, iter_ingested_pages
+
+    parser = argparse.ArgumentParser(description="Report clusters of near-duplicate pages in the ingested corpus.")
+    parser.add_argument("--corpus", default=str(INGESTION_FOLDER), help="mirror folder or Parquet export")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    titles = {}
+
+    def texts():
+        for page in iter_ingested_pages(args.corpus):
+            titles[page['page_id']] = page['title']
+            yield page['page_id'], page['text']
+
+    canonical = canonical_map(texts(), args.threshold)
+    for keep, duplicates in canonical.items():
+        print(f"{keep} {titles[keep]}")
+        for duplicate in duplicates:
+            print(f"    {duplicate} {titles[duplicate]}")
+    print(f"{len(canonical)} clusters, {sum(map(len, canonical.values()))} of {len(titles)} pages are near-duplicates "
+          f"at threshold {args.threshold}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+Packed, append-only store of converted Confluence pages, read through mmap.
+
+Two files make up the store:
+    pages.dat   the header (creator and editor lines) and markdown of every stored page version, back to back as UTF-8
+    pages.idx   one fixed-width record per stored version: page id, offset and lengths into pages.dat, Confluence
+                version number and the time it was stored or last confirmed current
+
+Writers append the data before the index record, so a reader never sees a record pointing past the data it can map.
+The last record of a page wins; older versions stay in pages.dat until the store is rebuilt. Readers map both files and
+pick up records appended by another process (ingestion running next to the MCP server) on the next lookup.
+
+`ingestion.py` writes every page it mirrors into the store, and `mcp_server.get_page_by_id` serves stored pages
+without downloading and converting them again: within the TTL a stored page is served as is, after it one light
+version lookup decides whether the stored copy is still current.
+
+Configuration (environment):
+    PAGE_STORE_ENABLED          serve pages from the store in the MCP server (default true)
+    PAGE_STORE_PATH             store folder (default cache/page_store)
+    PAGE_STORE_TTL_SECONDS      age after which a stored page's version is checked against Confluence (default 300)
+"""
+
+import functools
+import mmap
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends from several processes are not serialized.
+    fcntl = None
+
+DEFAULT_STORE_FOLDER = Path(__file__).parent / "cache" / "page_store"
+
+# page id, data offset, header length, markdown length, version, 4 pad bytes, stored at (epoch seconds)
+_RECORD = struct.Struct("<QQIIIxxxxd")
+_STORED_AT_OFFSET = _RECORD.size - 8
+
+
+@dataclass
+class StoredPage:
+    page_id: str
+    version: int
+    stored_at: float
+    header: str
+    markdown: str
+
+
+def _page_header(response: Dict) -> str:
+    creator = response.get("history", {}).get("createdBy", {}).get("displayName", "Unknown")
+    editor = response.get("version", {}).get("by", {}).get("displayName", "Unknown")
+    return f"\n\n Page Created by: {creator}\n Page Last edited by: {editor}\n"
+
+
+async def convert_page_async(response: Dict) -> Tuple[int, str, str]:
+    """
+    (version, header, markdown) of a Confluence page fetched with `expand="body.storage,version,history"`. The
+    conversion runs off the event loop, in a process pool for large pages.
+    """
+    from storage_format import convert_storage_format_async
+
+    converted = await convert_storage_format_async(response["body"]["storage"]["value"])
+    return int(response.get("version", {}).get("number", 0)), _page_header(response), converted.markdown
+
+
+def format_page(header: str, markdown_text: str, title: str | None = None) -> str:
+    """Page text as the `get_page_by_id` tool returns it."""
+    if title:
+        return f"Title of the page is {title} \n {header} and markdown of the page is \n\n {markdown_text}"
+    return header + markdown_text
+
+
+class PageStore:
+    def __init__(self, path: str | os.PathLike):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.data_path = self.path / "pages.dat"
+        self.index_path = self.path / "pages.idx"
+        for file_path in (self.data_path, self.index_path):
+            file_path.touch(exist_ok=True)
+
+        self._lock = threading.Lock()
+        # page id -> (record number, offset, header length, markdown length, version, stored at)
+        self._index: Dict[int, Tuple[int, int, int, int, int, float]] = {}
+        self._index_bytes_read = 0
+        self._data_map: mmap.mmap | None = None
+        self._data_file = open(self.data_path, mode='rb')
+
+    def _refresh(self):
+        """Read index records appended since the last lookup, by this or another process."""
+        size = self.index_path.stat().st_size
+        size -= size % _RECORD.size  # A record still being written by another process is read next time.
+        if size <= self._index_bytes_read:
+            return
+        with open(self.index_path, mode='rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as index_map:
+                for position in range(self._index_bytes_read, size, _RECORD.size):
+                    page_id, offset, header_length, markdown_length, version, stored_at = _RECORD.unpack_from(
+                        index_map, position
+                    )
+                    record_number = position // _RECORD.size
+                    self._index[page_id] = (record_number, offset, header_length, markdown_length, version, stored_at)
+        self._index_bytes_read = size
+
+    def _data(self, end: int) -> memoryview:
+        """The data file mapped at least up to `end`, remapped when it has grown past the current mapping."""
+        if self._data_map is None or len(self._data_map) < end:
+            if self._data_map is not None:
+                self._data_map.close()
+            self._data_map = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._data_map)
+
+    def get(self, page_id: str) -> StoredPage | None:
+        if not page_id.isdigit():
+            return None
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(int(page_id))
+            if entry is None:
+                return None
+            _, offset, header_length, markdown_length, version, stored_at = entry
+            end = offset + header_length + markdown_length
+            data = self._data(end)
+            # Slices of the mapping are views; the only copy is the final decode.
+            header = str(data[offset:offset + header_length], 'utf-8')
+            markdown_text = str(data[offset + header_length:end], 'utf-8')
+            data.release()
+        return StoredPage(page_id, version, stored_at, header, markdown_text)
+
+    def put(self, page_id: str, version: int, header: str, markdown_text: str) -> StoredPage | None:
+        """Append a page version; pages without a numeric id are not stored."""
+        if not page_id.isdigit():
+            return None
+        header_bytes, markdown_bytes = header.encode('utf-8'), markdown_text.encode('utf-8')
+        stored_at = time.time()
+        with self._lock, open(self.data_path, mode='ab') as data_file, open(self.index_path, mode='ab') as index_file:
+            if fcntl is not None:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                offset = data_file.seek(0, os.SEEK_END)
+                data_file.write(header_bytes + markdown_bytes)
+                data_file.flush()
+                os.fsync(data_file.fileno())
+                index_file.write(_RECORD.pack(
+                    int(page_id), offset, len(header_bytes), len(markdown_bytes), version, stored_at
+                ))
+                index_file.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(index_file, fcntl.LOCK_UN)
+        return StoredPage(page_id, version, stored_at, header, markdown_text)
+
+    def touch(self, page_id: str):
+        """Mark a stored page as confirmed current now, rewriting its record's timestamp in place."""
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(int(page_id)) if page_id.isdigit() else None
+            if entry is None:
+                return
+            stored_at = time.time()
+            with open(self.index_path, mode='r+b') as index_file:
+                index_file.seek(entry[0] * _RECORD.size + _STORED_AT_OFFSET)
+                index_file.write(struct.pack("<d", stored_at))
+            self._index[int(page_id)] = entry[:5] + (stored_at,)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def close(self):
+        with self._lock:
+            if self._data_map is not None:
+                self._data_map.close()
+                self._data_map = None
+            self._data_file.close()
+
+
+@functools.cache
+def get_page_store() -> PageStore | None:
+    """The process's store, or None when PAGE_STORE_ENABLED is false."""
+    if os.getenv("PAGE_STORE_ENABLED", "true").lower() != "true":
+        return None
+    return PageStore(os.getenv("PAGE_STORE_PATH", str(DEFAULT_STORE_FOLDER)))
+
+
+def page_store_ttl() -> float:
+    return float(os.getenv("PAGE_STORE_TTL_SECONDS", "300"))
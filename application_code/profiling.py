@@ -0,0 +1,281 @@
+"""
+Opt-in profiling of single requests through the graph, written as a Chrome trace (Trace Event Format JSON) that opens in
+Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+A profiled request records
+    - every graph node, LLM call and tool run, from LangChain callbacks, as async slices,
+    - every awaited dependency call (each Weaviate, MCP or Confluence attempt, see resilience.call_dependency), LLM rate
+      limit waits, storage-format conversions and the JSON encoding of streamed updates, as slices on the track of the
+      asyncio task that awaited them; concurrent tasks get their own tracks, named after the task,
+    - optionally, the event loop thread's stacks sampled every PROFILE_SAMPLE_INTERVAL_MS and merged into a flame chart
+      on a "loop samples" track, which shows what CPU-bound sections (conversion, JSON, prompt building) spent time on.
+The loop thread is shared by every request of the process, so the samples, and gaps between one task's slices, also
+cover other requests that ran at the same time.
+
+Profiling is off unless asked for: `execute_user_query(..., profile=True)`, PROFILE_REQUESTS=true, or
+`python3 -m graph --profile [--sample]`. Outside a profiled request `span` costs one context variable lookup.
+
+Configuration (environment):
+    PROFILE_REQUESTS                profile every request (default false)
+    PROFILE_SAMPLING                also sample the loop thread's stacks (default false)
+    PROFILE_SAMPLE_INTERVAL_MS      sampling interval (default 5)
+    PROFILE_OUTPUT_DIR              folder of the trace files (default cache/profiles)
+"""
+
+import asyncio
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+DEFAULT_OUTPUT_FOLDER = Path(__file__).parent / "cache" / "profiles"
+SAMPLES_TRACK = 0
+
+_current_profile: ContextVar["RequestProfile | None"] = ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """Trace events of one request; timestamps are microseconds since the request started."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.pid = os.getpid()
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.events: List[Dict] = []
+        self._tracks: Dict[object, int] = {}
+        # The sampler thread adds events next to the loop thread.
+        self._lock = threading.Lock()
+        self._add({'ph': 'M', 'name': 'process_name', 'pid': self.pid, 'args': {'name': name}})
+
+    def _add(self, event: Dict):
+        with self._lock:
+            self.events.append(event)
+
+    def _timestamp(self, at: float) -> float:
+        return round((at - self.started) * 1e6, 1)
+
+    def name_track(self, track: int, name: str):
+        self._add({'ph': 'M', 'name': 'thread_name', 'pid': self.pid, 'tid': track, 'args': {'name': name}})
+
+    def track(self) -> int:
+        """Track of the running asyncio task (or thread, outside one), created on first use."""
+        try:
+            owner = asyncio.current_task()
+        except RuntimeError:
+            owner = None
+        key = owner if owner is not None else threading.get_ident()
+        track = self._tracks.get(key)
+        if track is None:
+            track = self._tracks[key] = len(self._tracks) + 1
+            self.name_track(track, owner.get_name() if owner is not None else threading.current_thread().name)
+        return track
+
+    def complete(self, name: str, category: str, start: float, end: float, track: int, args: Dict | None = None):
+        event = {
+            'ph': 'X', 'name': name, 'cat': category, 'pid': self.pid, 'tid': track,
+            'ts': self._timestamp(start), 'dur': round((end - start) * 1e6, 1),
+        }
+        if args:
+            event['args'] = args
+        self._add(event)
+
+    def begin_async(self, name: str, category: str, run_id, args: Dict | None = None):
+        self._add({
+            'ph': 'b', 'name': name, 'cat': category, 'id': str(run_id), 'pid': self.pid,
+            'ts': self._timestamp(time.perf_counter()), 'args': args or {},
+        })
+
+    def end_async(self, name: str, category: str, run_id, args: Dict | None = None):
+        self._add({
+            'ph': 'e', 'name': name, 'cat': category, 'id': str(run_id), 'pid': self.pid,
+            'ts': self._timestamp(time.perf_counter()), 'args': args or {},
+        })
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        track, start = self.track(), time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = type(e).__name__
+            raise
+        finally:
+            self.complete(name, category, start, time.perf_counter(), track, args)
+
+    def callback_handler(self):
+        return _callback_handler_class()(self)
+
+    def write(self, folder: str | os.PathLike) -> Path:
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))}-{self.name}.json"
+        with self._lock:
+            events = list(self.events)
+        with open(path, mode='w', encoding='utf-8') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+        return path
+
+
+@functools.cache
+def _callback_handler_class():
+    # langchain_core is only imported once a request is profiled.
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class ProfileCallbackHandler(BaseCallbackHandler):
+        """Graph nodes, LLM calls and tool runs of a profiled request as async slices."""
+
+        run_inline = True
+
+        def __init__(self, profile: RequestProfile):
+            self.profile = profile
+            self._runs: Dict[object, Tuple[str, str]] = {}
+
+        def _begin(self, run_id, name: str, category: str):
+            self._runs[run_id] = (name, category)
+            self.profile.begin_async(name, category, run_id)
+
+        def _end(self, run_id, error: BaseException | None = None):
+            if run_id in self._runs:
+                name, category = self._runs.pop(run_id)
+                self.profile.end_async(name, category, run_id, {'error': type(error).__name__} if error else None)
+
+        def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+            node = (metadata or {}).get('langgraph_node')
+            if node and not node.startswith('__') and kwargs.get('name') == node:
+                self._begin(run_id, node, 'node')
+
+        def on_chain_end(self, outputs, *, run_id, **kwargs):
+            self._end(run_id)
+
+        def on_chain_error(self, error, *, run_id, **kwargs):
+            self._end(run_id, error)
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+            model = (metadata or {}).get('ls_model_name') or (serialized or {}).get('name') or 'chat model'
+            self._begin(run_id, f"llm {model}", 'llm')
+
+        def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+            model = (metadata or {}).get('ls_model_name') or (serialized or {}).get('name') or 'llm'
+            self._begin(run_id, f"llm {model}", 'llm')
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            self._end(run_id)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._end(run_id, error)
+
+        def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+            self._begin(run_id, f"tool {(serialized or {}).get('name') or kwargs.get('name') or 'tool'}", 'tool')
+
+        def on_tool_end(self, output, *, run_id, **kwargs):
+            self._end(run_id)
+
+        def on_tool_error(self, error, *, run_id, **kwargs):
+            self._end(run_id, error)
+
+    return ProfileCallbackHandler
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples one thread's stack every `interval` seconds. Consecutive samples that share a prefix of frames are merged
+    into one slice per frame, so the samples read as a flame chart.
+    """
+
+    def __init__(self, profile: RequestProfile, thread_id: int, interval: float):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.profile = profile
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self._open: List[Tuple[str, float]] = []
+        self._stopped = threading.Event()
+
+    def _merge(self, stack: List[str], now: float):
+        common = 0
+        while common < min(len(stack), len(self._open)) and self._open[common][0] == stack[common]:
+            common += 1
+        for label, start in reversed(self._open[common:]):
+            self.profile.complete(label, 'sample', start, now, SAMPLES_TRACK)
+        self._open = self._open[:common] + [(label, now) for label in stack[common:]]
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            self.samples += 1
+            self._merge(stack[::-1], time.perf_counter())
+        self._merge([], time.perf_counter())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def current_profile() -> RequestProfile | None:
+    return _current_profile.get()
+
+
+def span(name: str, category: str = 'io', **args):
+    """Context manager timing a section of the current profiled request; does nothing outside one."""
+    profile = _current_profile.get()
+    return profile.span(name, category, **args) if profile is not None else nullcontext()
+
+
+def record_wait(name: str, seconds: float, category: str = 'wait'):
+    """Record a wait that ended just now and took `seconds` (a queue wait measured elsewhere)."""
+    profile = _current_profile.get()
+    if profile is not None and seconds > 0:
+        now = time.perf_counter()
+        profile.complete(name, category, now - seconds, now, profile.track())
+
+
+def profiling_enabled() -> bool:
+    return os.getenv("PROFILE_REQUESTS", "false").lower() == "true"
+
+
+@contextmanager
+def profile_request(name: str, enabled: bool | None = None, sampling: bool | None = None) \
+        -> Iterator[RequestProfile | None]:
+    """
+    Profile the request run inside the block and write its trace to PROFILE_OUTPUT_DIR when the block exits. Yields
+    None, and records nothing, unless profiling is enabled.
+    """
+    if not (profiling_enabled() if enabled is None else enabled):
+        yield None
+        return
+    if sampling is None:
+        sampling = os.getenv("PROFILE_SAMPLING", "false").lower() == "true"
+
+    profile = RequestProfile(name)
+    token = _current_profile.set(profile)
+    sampler = None
+    if sampling:
+        profile.name_track(SAMPLES_TRACK, "loop samples")
+        interval = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000
+        sampler = StackSampler(profile, threading.get_ident(), interval)
+        sampler.start()
+    try:
+        yield profile
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        _current_profile.reset(token)
+        path = profile.write(os.getenv("PROFILE_OUTPUT_DIR", str(DEFAULT_OUTPUT_FOLDER)))
+        print(f"Wrote the profile of {name} ({len(profile.events)} events"
+              f"{f', {sampler.samples} stack samples' if sampler else ''}) to {path}.")
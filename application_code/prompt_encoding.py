@@ -0,0 +1,88 @@
+"""
+Compact, token-efficient encoding of the Confluence candidates sent to the page-filtering LLM.
+
+Candidates are rendered as a table keyed by short local ids (`p1`, `p2`, ...) instead of the Python repr of the
+search results: highlight markers and HTML entities are stripped from excerpts, and URLs and timestamps, which the
+model never needs for a relevance decision, are dropped. Downloaded page contents are rendered as sections keyed by
+the same local ids. `LocalIds` maps the ids the model answers with back to Confluence page ids.
+"""
+
+import functools
+import html
+import re
+from typing import Dict, Iterable, List
+
+HIGHLIGHT_PATTERN = re.compile(r"@@@(?:end)?hl@@@")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def strip_highlights(text: str) -> str:
+    """Remove Confluence search highlight markers and HTML entities, and collapse whitespace."""
+    return WHITESPACE_PATTERN.sub(" ", html.unescape(HIGHLIGHT_PATTERN.sub("", text or ""))).strip()
+
+
+class LocalIds:
+    """Bidirectional mapping between short local ids and Confluence page ids."""
+
+    def __init__(self, page_ids: Iterable[str]):
+        self.to_page_id: Dict[str, str] = {}
+        self.to_local_id: Dict[str, str] = {}
+        for page_id in page_ids:
+            self.add(page_id)
+
+    def add(self, page_id: str) -> str:
+        if page_id not in self.to_local_id:
+            local_id = f"p{len(self.to_local_id) + 1}"
+            self.to_local_id[page_id] = local_id
+            self.to_page_id[local_id] = page_id
+        return self.to_local_id[page_id]
+
+    def resolve(self, page_or_local_id: str) -> str:
+        """Confluence page id for a local id; ids the model copied verbatim pass through unchanged."""
+        return self.to_page_id.get(str(page_or_local_id).strip(), str(page_or_local_id).strip())
+
+
+def encode_confluence_pages(pages: List[Dict], local_ids: LocalIds) -> str:
+    """Render search candidates as a `id | title | score | excerpt` table."""
+    rows = ["id | title | score | excerpt"]
+    for page in pages:
+        local_id = local_ids.add(page['page_id'])
+        title = strip_highlights(page.get('title', '')).replace("|", "/")
+        excerpt = strip_highlights(page.get('matched_content', '')).replace("|", "/")
+        rows.append(f"{local_id} | {title} | {page.get('match_score', 0):.1f} | {excerpt}")
+    return "\n".join(rows)
+
+
+def encode_tool_outputs(content_map: Dict[str, Dict], local_ids: LocalIds) -> str:
+    """Render downloaded pages as one section per page, keyed by local id."""
+    sections = []
+    for page_id, page in content_map.items():
+        local_id = local_ids.add(page_id)
+        sections.append(f"### {local_id} | {page.get('title', '')}\n{page.get('page_content', '')}")
+    return "\n\n".join(sections)
+
+
+def decode_filtered_pages(entries, local_ids: LocalIds, confluence_response: Dict[str, Dict]) -> List[Dict]:
+    """Turn the model's `[{"id": "p1"}, ...]` answer back into the original search result objects."""
+    if not isinstance(entries, list):
+        return entries
+
+    pages = []
+    for entry in entries:
+        page_id = local_ids.resolve(entry.get('id') or entry.get('page_id'))
+        pages.append(confluence_response.get(page_id) or {'page_id': page_id, 'title': entry.get('title', '')})
+    return pages
+
+
+@functools.cache
+def _encoding():
+    import tiktoken
+    return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str) -> int:
+    """Token count with the o200k tokenizer, or a chars/4 estimate when tiktoken is unavailable."""
+    try:
+        return len(_encoding().encode(text, disallowed_special=()))
+    except Exception:
+        return len(text) // 4
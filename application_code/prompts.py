@@ -25,6 +25,21 @@ class AgentCqlPrompt(BaseModel):
     )
 
 
+class PageRelevanceDecision(BaseModel):
+    id: str = Field(description="The local id of the candidate page, exactly as given in the table (e.g. p3).")
+    relevant: bool = Field(description="Whether the page helps answer the user query.")
+    confidence: float = Field(
+        description="Confidence in the relevance decision between 0 and 1. Use a low value whenever the title and "
+                    "excerpt are not enough to decide and the full page would have to be read."
+    )
+
+
+class PageRelevanceDecisions(BaseModel):
+    decisions: List[PageRelevanceDecision] = Field(
+        description="One relevance decision for every candidate page in the table."
+    )
+
+
 CQL_GENERATION_PROMPT = PromptTemplate.from_template(
     """
 You are a highly intelligent assistant specialized in generating **Confluence CQL (Confluence Query Language)** queries.
@@ -109,52 +124,52 @@ Now generate the most relevant and diverse CQL queries based on the input, ensur
 main entity context."""
 )
 
+# Static instructions come first and the per-request inputs last, so provider-side prompt caching can reuse the prefix.
 CONFLUENCE_PAGE_SYSTEM_MESSAGE = PromptTemplate.from_template(
     """
 You are an intelligent Confluence page relevance analyzer. Your task is to filter a list of Confluence pages 
 to identify which ones are relevant to a user's query.
-  
-## INPUT DATA
-  
-**User Query:** {user_query}
 
-**Confluence Pages:** {confluence_pages_list}
+The input data (user query, candidate pages and tool outputs) is given at the end of this message.
 
-**Tool Outputs:** {tool_outputs}
+**Candidate Pages** are a table with one page per row: `id | title | score | excerpt`. The `id` is a short local 
+identifier such as `p3`; always refer to pages by this id.
+
+**Tool Outputs** contain the full markdown of pages you already requested, one `### <id> | <title>` section per page.
 
 **Available Tools:** You have access to a tool called `get_page_by_id` that can retrieve the full markdown content 
-of any page using its page_id.
+of any page. Pass the page's local id (for example `p3`) as `page_id`.
 
 ## YOUR TASK
 
-For each page in the confluence_pages_list, you need to determine if it's relevant to the user query by analyzing:
+For each candidate page, you need to determine if it's relevant to the user query by analyzing:
 
 1. **Page Title**: Does the title relate to the user's query?
-2. **Matched Content**: Does the excerpt/matched content segment address the user's question?
-3. **Match Score**: Use this as a reference point (higher scores generally indicate better matches, but don't rely solely on this)
+2. **Excerpt**: Does the matched excerpt address the user's question?
+3. **Score**: Use this as a reference point (higher scores generally indicate better matches, but don't rely solely on this)
 
 ## DECISION CRITERIA
 
 **ALWAYS INCLUDE** a page if:
 - The title directly relates to the user's query
-- The matched content contains relevant information for answering the query
+- The excerpt contains relevant information for answering the query
 - The content appears to address any aspect of the user's question
 
 **USE THE TOOL** if:
-- You have ANY doubt about relevance based on title and matched content alone
-- The matched content is too brief or unclear to make a confident decision
-- The title seems relevant but the matched content doesn't provide enough context
+- You have ANY doubt about relevance based on title and excerpt alone
+- The excerpt is too brief or unclear to make a confident decision
+- The title seems relevant but the excerpt doesn't provide enough context
 - You suspect the full page might contain relevant information not captured in the excerpt
 
 **EXCLUDE** a page only if:
-- Both the title and matched content are clearly unrelated to the query
+- Both the title and excerpt are clearly unrelated to the query
 - You're absolutely certain it won't help answer the user's question
 
 ## TOOL USAGE
 
 When you need more information about a page, use the available tool:
 ```
-get_page_by_id(page_id="the_page_id", title="optional_title")
+get_page_by_id(page_id="p3", title="optional_title")
 ```
 
 This will return the full markdown content of the page, allowing you to make a more informed decision.
@@ -168,30 +183,24 @@ If you need to fetch additional page content to make informed decisions, make th
 After receiving the tool outputs, you will then provide the filtered pages list.
 
 ### OPTION 2: Filtered Pages List
-If you can make confident relevance decisions based on the available information (titles, matched content, scores, and any previous tool outputs), respond with the filtered pages JSON list.
+If you can make confident relevance decisions based on the available information (titles, excerpts, scores, and 
+any previous tool outputs), respond with the filtered pages JSON list.
 
 **RESPONSE FORMAT FOR FILTERED PAGES:**
 
-Return ONLY a JSON list of the relevant page objects in exactly the same format as received. Do not modify any 
-fields, values, or structure of the page objects.
+Return ONLY a JSON list with the local id of every relevant page:
 
 ```json
 [
-    {{
-        "page_id": "original_page_id",
-        "title": "original_title", 
-        "matched_content": "original_matched_content",
-        "page_url": "original_page_url",
-        "lastModified": "original_lastModified",
-        "match_score": original_match_score
-    }}
+    {{"id": "p1"}},
+    {{"id": "p4"}}
 ]
 ```
 
 ## IMPORTANT GUIDELINES
 
 1. **No Empty Responses**: You must ALWAYS respond with either tool calls OR the filtered pages list
-2. **Preserve Original Data**: Return page objects exactly as received - do not modify any field values
+2. **Use Local Ids**: Refer to pages only by the ids given in the candidate table
 3. **Err on the Side of Inclusion**: If uncertain, include the page rather than exclude it
 4. **Use Tools Liberally**: When in doubt, fetch the full page content to make informed decisions
 5. **Be Thorough**: Consider indirect relevance - a page might be relevant even if not obviously so
@@ -200,7 +209,7 @@ fields, values, or structure of the page objects.
 ## DECISION PROCESS
 
 For each page:
-1. Quick assessment based on title, matched content, and any available tool outputs
+1. Quick assessment based on title, excerpt, and any available tool outputs
 2. If you need more information → make tool calls to get full content
 3. If you have sufficient information → provide the filtered pages list
 4. If relevant or potentially relevant → include in final list
@@ -215,7 +224,46 @@ You MUST choose one of these actions:
 **DO NOT**: Return empty responses, explanations without results, or defer the decision.
 
 Remember: Your goal is to ensure no potentially relevant pages are missed while filtering out clearly irrelevant 
-ones. When in doubt, include the page. Always provide a concrete response - either tool calls or filtered results."""
+ones. When in doubt, include the page. Always provide a concrete response - either tool calls or filtered results.
+
+## INPUT DATA
+
+**User Query:** {user_query}
+
+**Candidate Pages:**
+{confluence_pages_list}
+
+**Tool Outputs:**
+{tool_outputs}
+"""
+)
+
+# Worker-model triage used by the agent 3 cascade (see cascade.py); static instructions first, inputs last.
+CONFLUENCE_PAGE_TRIAGE_PROMPT = PromptTemplate.from_template(
+    """
+You are a fast Confluence page relevance triager. For every candidate page decide whether it helps answer the 
+user's query, using only its title, search score and excerpt.
+
+The candidate pages are a table with one page per row: `id | title | score | excerpt`.
+
+For each candidate return:
+- `id`: the local id from the table (e.g. `p3`)
+- `relevant`: true if the page helps answer the query, false otherwise
+- `confidence`: between 0 and 1
+
+Be honest about confidence. Give a high confidence (0.9 or more) only when the title and excerpt make the decision 
+obvious. Give a low confidence when the page might be relevant but the excerpt is too short or unclear, or when 
+you would need to read the full page to be sure; those pages will be reviewed by a stronger model.
+
+Return a decision for every candidate in the table.
+
+## INPUT DATA
+
+**User Query:** {user_query}
+
+**Candidate Pages:**
+{confluence_pages_list}
+"""
 )
 
 SUMMARIZATION_PROMPT = PromptTemplate.from_template("""
@@ -0,0 +1,200 @@
+"""
+Client-side rate limiting for the shared LLM clients.
+
+Every model in `llm.AGENT_LLM_RATE_LIMITS` gets one `ModelRateLimiter`, shared by all sessions in the process. It
+combines two token buckets (requests per second and tokens per minute) with a priority queue, so calls for sessions
+that are already in progress (answer generation, page filtering) are granted before new CQL generation when the
+provider budget is tight. Time spent waiting in the queue is recorded per model and priority.
+
+Limits apply per process; when running several server workers divide the provider quota between them.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List
+
+from llm import AGENT_LLM_RATE_LIMITS
+from metrics import summarize_latencies
+
+# Lower value is served first.
+PRIORITY_ANSWER = 0
+PRIORITY_IN_PROGRESS = 1
+PRIORITY_NEW_SESSION = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_ANSWER: "answer",
+    PRIORITY_IN_PROGRESS: "in_progress",
+    PRIORITY_NEW_SESSION: "new_session",
+}
+
+SLOW_QUEUE_WAIT_SECONDS = 1.0
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available (0 if they are available now)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount: float):
+        # May go negative when a call turned out to be larger than estimated; later callers repay the debt.
+        self.tokens -= amount
+
+
+class ModelRateLimiter:
+    """Requests-per-second and tokens-per-minute limiter with priority scheduling for one model."""
+
+    def __init__(self, model_name: str, requests_per_second: float, tokens_per_minute: float,
+                 burst_seconds: float = 1.0):
+        self.model_name = model_name
+        self.requests = TokenBucket(max(1.0, requests_per_second * burst_seconds), requests_per_second)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+
+        self._waiters: list = []
+        self._sequence = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+        self._waits: Dict[int, deque] = {priority: deque(maxlen=1000) for priority in PRIORITY_NAMES}
+
+    async def acquire(self, priority: int, estimated_tokens: int) -> float:
+        """Wait for a request slot and `estimated_tokens` of budget. Returns the seconds spent queued."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        enqueued = time.monotonic()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), estimated_tokens, future))
+        self._dispatch()
+
+        await future  # A cancelled waiter cancels its future; _dispatch skips it.
+        waited = time.monotonic() - enqueued
+        self._waits.setdefault(priority, deque(maxlen=1000)).append(waited)
+        return waited
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the token budget once the provider has reported the real usage of a call."""
+        self.tokens.consume(actual_tokens - estimated_tokens)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._waiters:
+            priority, _, estimated_tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+
+            now = time.monotonic()
+            delay = max(self.requests.wait_time(1, now), self.tokens.wait_time(estimated_tokens, now))
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+
+            heapq.heappop(self._waiters)
+            self.requests.consume(1)
+            self.tokens.consume(estimated_tokens)
+            future.set_result(None)
+
+    def queued(self) -> int:
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self.queued(),
+            'available_tokens': self.tokens.tokens,
+            'queue_wait': {
+                PRIORITY_NAMES.get(priority, str(priority)): summarize_latencies(waits)
+                for priority, waits in self._waits.items() if waits
+            },
+        }
+
+
+_limiters: Dict[str, ModelRateLimiter] = {}
+# Queue waits of the calls made inside `record_waits`, for callers that report them per request.
+_recorded_waits: ContextVar[List[float] | None] = ContextVar("recorded_rate_limit_waits", default=None)
+
+
+def get_rate_limiter(model_name: str) -> ModelRateLimiter | None:
+    """Process-wide limiter for `model_name`, or None when no limits are configured for it."""
+    if model_name not in _limiters and model_name in AGENT_LLM_RATE_LIMITS:
+        _limiters[model_name] = ModelRateLimiter(model_name, **AGENT_LLM_RATE_LIMITS[model_name])
+    return _limiters.get(model_name)
+
+
+@asynccontextmanager
+async def llm_rate_limit(model_name: str, priority: int, estimated_tokens: int):
+    """
+    Hold a rate-limit grant for one LLM call. Yields a dict; put the real token count under 'actual_tokens'
+    so the limiter can settle the difference with the estimate.
+    """
+    limiter = get_rate_limiter(model_name)
+    grant = {'queue_wait_seconds': 0.0, 'actual_tokens': None}
+    if limiter is None:
+        yield grant
+        return
+
+    grant['queue_wait_seconds'] = await limiter.acquire(priority, estimated_tokens)
+    recorded = _recorded_waits.get()
+    if recorded is not None:
+        recorded.append(grant['queue_wait_seconds'])
+    if grant['queue_wait_seconds'] >= SLOW_QUEUE_WAIT_SECONDS:
+        print(f"LLM call to {model_name} [{PRIORITY_NAMES.get(priority)}] waited "
+              f"{grant['queue_wait_seconds']:.2f}s for the rate limiter.")
+    try:
+        yield grant
+    finally:
+        if grant['actual_tokens'] is not None:
+            limiter.record_usage(estimated_tokens, grant['actual_tokens'])
+
+
+def is_saturated(model_name: str) -> bool:
+    """True while calls to `model_name` are queueing for the rate limiter."""
+    limiter = _limiters.get(model_name)
+    return limiter is not None and limiter.queued() > 0
+
+
+def stats() -> Dict:
+    return {model_name: limiter.stats() for model_name, limiter in _limiters.items()}
+
+
+@contextmanager
+def record_waits() -> Iterator[List[float]]:
+    """Collect the queue wait of every LLM call made inside the block, including in tasks it starts."""
+    waits: List[float] = []
+    token = _recorded_waits.set(waits)
+    try:
+        yield waits
+    finally:
+        _recorded_waits.reset(token)
+
+
+@contextmanager
+def limits_disabled():
+    """Run the block without client-side limits, e.g. against local stand-ins that have no provider quota."""
+    global AGENT_LLM_RATE_LIMITS
+    original_limits, original_limiters = AGENT_LLM_RATE_LIMITS, dict(_limiters)
+    AGENT_LLM_RATE_LIMITS = {}
+    _limiters.clear()
+    try:
+        yield
+    finally:
+        AGENT_LLM_RATE_LIMITS = original_limits
+        _limiters.clear()
+        _limiters.update(original_limiters)
@@ -0,0 +1,245 @@
+"""
+Circuit breakers, timeouts and retries for the services a request depends on: Weaviate, the MCP server and
+Confluence (called by the MCP server and ingestion).
+
+Every call to one of them goes through `call_dependency`, which
+    - fails at once with `CircuitOpenError` while the dependency's circuit is open,
+    - bounds each attempt with a hard timeout,
+    - retries transport errors (connection failures, timeouts, 5xx and 429 responses) with full-jitter exponential
+      backoff, a bounded number of times; other errors (bad queries, 4xx responses, bugs) are raised straight away,
+    - never retries or counts a cancellation, which belongs to the caller.
+
+A circuit opens after `failure_threshold` consecutive calls failed with transport errors and stays open for
+`reset_seconds`. The next call after that is let through as a probe: if it succeeds the circuit closes, if it fails it
+opens again. While a circuit is open the graph skips the branch that needs the dependency instead of queueing requests
+behind it (see `graph.route_to_start_nodes`). Circuits are per process; `/healthz` reports their state.
+
+Configuration (environment), per dependency with the prefix WEAVIATE_, MCP_ or CONFLUENCE_:
+    <PREFIX>TIMEOUT_SECONDS             hard timeout of one attempt (default 10 Weaviate, 60 MCP, 15 Confluence)
+    <PREFIX>RETRY_ATTEMPTS              attempts per call, including the first (default 3)
+    <PREFIX>CIRCUIT_FAILURE_THRESHOLD   consecutive failures that open the circuit (default 5)
+    <PREFIX>CIRCUIT_RESET_SECONDS       time an open circuit waits before letting a probe through (default 30)
+"""
+
+import asyncio
+import functools
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, TypeVar
+
+from async_utils import RetryPolicy
+from profiling import span
+
+T = TypeVar("T")
+
+WEAVIATE = "weaviate"
+MCP = "mcp"
+CONFLUENCE = "confluence"
+
+# A page download through MCP covers the MCP server's own Confluence attempts, so MCP gets the longest timeout.
+DEFAULT_TIMEOUT_SECONDS = {WEAVIATE: 10.0, MCP: 60.0, CONFLUENCE: 15.0}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DependencyUnavailableError(Exception):
+    """A dependency could not be reached: its circuit is open or it kept failing with transport errors."""
+
+    def __init__(self, dependency: str, message: str):
+        super().__init__(f"{dependency}: {message}")
+        self.dependency = dependency
+
+
+class CircuitOpenError(DependencyUnavailableError):
+    def __init__(self, dependency: str, retry_in: float):
+        super().__init__(dependency, f"circuit open, next probe in {retry_in:.1f}s")
+        self.retry_in = retry_in
+
+
+@functools.cache
+def transport_errors() -> tuple[type[BaseException], ...]:
+    """Exception types that mean the request did not get a proper answer and may succeed when retried."""
+    errors: list[type[BaseException]] = [asyncio.TimeoutError, ConnectionError]
+    try:
+        import httpx
+        errors.append(httpx.TransportError)
+    except ImportError:
+        pass
+    try:
+        import openai
+        errors.append(openai.APIConnectionError)  # Includes APITimeoutError.
+    except ImportError:
+        pass
+    try:
+        import requests
+        errors.extend([requests.exceptions.ConnectionError, requests.exceptions.Timeout])
+    except ImportError:
+        pass
+    try:
+        from weaviate.exceptions import WeaviateConnectionError, WeaviateGRPCUnavailableError, WeaviateTimeoutError
+        errors.extend([WeaviateConnectionError, WeaviateGRPCUnavailableError, WeaviateTimeoutError])
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def is_transport_error(error: BaseException) -> bool:
+    # The MCP client's connections run in anyio task groups, which raise connection failures inside exception groups.
+    if isinstance(error, BaseExceptionGroup):
+        return error.subgroup(lambda e: not isinstance(e, BaseExceptionGroup) and is_transport_error(e)) is not None
+    # requests' and httpx's HTTP errors carry the response; an overloaded or failing server is worth retrying.
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if isinstance(status, int) and (status >= 500 or status == 429):
+        return True
+    return isinstance(error, transport_errors())
+
+
+@dataclass
+class DependencyPolicy:
+    timeout: float
+    retry_attempts: int = 3
+    failure_threshold: int = 5
+    reset_seconds: float = 30.0
+
+    @classmethod
+    def from_env(cls, dependency: str) -> "DependencyPolicy":
+        prefix = dependency.upper()
+        return cls(
+            timeout=float(os.getenv(f"{prefix}_TIMEOUT_SECONDS", str(DEFAULT_TIMEOUT_SECONDS.get(dependency, 30.0)))),
+            retry_attempts=int(os.getenv(f"{prefix}_RETRY_ATTEMPTS", "3")),
+            failure_threshold=int(os.getenv(f"{prefix}_CIRCUIT_FAILURE_THRESHOLD", "5")),
+            reset_seconds=float(os.getenv(f"{prefix}_CIRCUIT_RESET_SECONDS", "30")),
+        )
+
+    def retry_policy(self) -> RetryPolicy:
+        # Only called for transport errors, see call_dependency.
+        return RetryPolicy(attempts=self.retry_attempts)
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe."""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    def _retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    @property
+    def is_open(self) -> bool:
+        """Whether a call made now would be rejected."""
+        if self.state == OPEN:
+            return self._retry_in() > 0
+        return self.state == HALF_OPEN and self.probe_in_flight
+
+    def before_call(self):
+        """Admit a call or raise `CircuitOpenError`; past the reset time the first caller becomes the probe."""
+        if self.state == OPEN and self._retry_in() <= 0:
+            self.state = HALF_OPEN
+            self.probe_in_flight = False
+        if self.state == OPEN or (self.state == HALF_OPEN and self.probe_in_flight):
+            self.rejected += 1
+            raise CircuitOpenError(self.name, self._retry_in())
+        if self.state == HALF_OPEN:
+            self.probe_in_flight = True
+        self.calls += 1
+
+    def record_success(self):
+        if self.state != CLOSED:
+            print(f"Circuit {self.name} closed.")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.times_opened += 1
+                print(f"Circuit {self.name} opened after {self.consecutive_failures} consecutive failures.")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def release(self):
+        """The admitted call was cancelled; a probe that never finished must not keep the circuit half-open."""
+        self.probe_in_flight = False
+
+    def stats(self) -> Dict:
+        return {
+            'state': OPEN if self.is_open else (HALF_OPEN if self.state != CLOSED else CLOSED),
+            'consecutive_failures': self.consecutive_failures,
+            'calls': self.calls,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'times_opened': self.times_opened,
+            'retry_in_seconds': self._retry_in() if self.state == OPEN else 0.0,
+        }
+
+
+@functools.cache
+def dependency_policy(dependency: str) -> DependencyPolicy:
+    return DependencyPolicy.from_env(dependency)
+
+
+@functools.cache
+def get_breaker(dependency: str) -> CircuitBreaker:
+    policy = dependency_policy(dependency)
+    return CircuitBreaker(dependency, policy.failure_threshold, policy.reset_seconds)
+
+
+def circuit_open(dependency: str) -> bool:
+    return get_breaker(dependency).is_open
+
+
+async def call_dependency(dependency: str, fn: Callable[[], Awaitable[T]], timeout: float | None = None) -> T:
+    """
+    Run `fn` (which makes one request to `dependency`) under the dependency's circuit breaker, timeout and retry
+    policy. Transport errors that outlast the retries are raised as `DependencyUnavailableError`.
+    """
+    policy = dependency_policy(dependency)
+    retry = policy.retry_policy()
+    breaker = get_breaker(dependency)
+    breaker.before_call()
+    attempt = 0
+    try:
+        while True:
+            attempt += 1
+            try:
+                with span(dependency, 'io', attempt=attempt):
+                    result = await asyncio.wait_for(fn(), timeout if timeout is not None else policy.timeout)
+                breaker.record_success()
+                return result
+            except Exception as e:
+                if not is_transport_error(e):
+                    # The dependency answered; a rejected query or a bug says nothing about its health.
+                    breaker.record_success()
+                    raise
+                if retry.should_retry(e, attempt) and not breaker.is_open:
+                    await asyncio.sleep(retry.delay(attempt))
+                    continue
+                breaker.record_failure()
+                raise DependencyUnavailableError(
+                    dependency, f"{type(e).__name__} after {attempt} attempt(s): {e}"
+                ) from e
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+
+
+def circuit_stats() -> Dict:
+    return {dependency: get_breaker(dependency).stats() for dependency in (WEAVIATE, MCP, CONFLUENCE)}
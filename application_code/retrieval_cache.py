@@ -0,0 +1,109 @@
+"""
+In-memory cache for retrieval results: CQL search results, vector hits, query embeddings and downloaded pages.
+
+Fetches are single-flight: when several requests sharing a cache need the same CQL query or page at the same time,
+only the first one calls the MCP server and the others await its result. A failed fetch is not cached; waiting
+requests see the same error, or fetch themselves when the request that was fetching got cancelled.
+"""
+
+import asyncio
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+KINDS = ('cql', 'vector', 'embedding', 'page')
+
+
+class RetrievalCache:
+    """Retrieval results by kind and key. Pages are kept in LRU order and bounded by `max_pages` when set."""
+
+    def __init__(self, max_pages: int | None = None):
+        self.max_pages = max_pages
+        self._entries: Dict[str, OrderedDict] = {kind: OrderedDict() for kind in KINDS}
+        self._in_flight: Dict[str, Dict[str, asyncio.Future]] = {kind: {} for kind in KINDS}
+        self.hits = Counter()
+        self.shared = Counter()
+        self.misses = Counter()
+
+    def has(self, kind: str, key: str) -> bool:
+        return key in self._entries[kind]
+
+    def get(self, kind: str, key: str) -> Any | None:
+        entries = self._entries[kind]
+        if key not in entries:
+            return None
+        entries.move_to_end(key)
+        return entries[key]
+
+    def put(self, kind: str, key: str, value: Any):
+        entries = self._entries[kind]
+        entries[key] = value
+        entries.move_to_end(key)
+        if kind == 'page' and self.max_pages is not None:
+            while len(entries) > self.max_pages:
+                entries.popitem(last=False)
+
+    async def get_or_fetch(self, kind: str, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Cached value for `key`, joining an in-flight fetch of the same key or running `fetch` otherwise."""
+        while True:
+            if self.has(kind, key):
+                self.hits[kind] += 1
+                return self.get(kind, key)
+
+            in_flight = self._in_flight[kind].get(key)
+            if in_flight is None:
+                break
+
+            self.shared[kind] += 1
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    raise
+                # The request doing the fetch was cancelled, not this one; fetch again.
+
+        self.misses[kind] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[kind][key] = future
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Nobody may be waiting; mark the exception as retrieved.
+            raise
+        else:
+            self.put(kind, key, value)
+            future.set_result(value)
+            return value
+        finally:
+            self._in_flight[kind].pop(key, None)
+
+    def approximate_size(self) -> int:
+        """Rough size in bytes, dominated by page contents."""
+        size = 0
+        for kind, entries in self._entries.items():
+            if kind == 'page':
+                size += sum(len(str(page.get('page_content', ''))) for page in entries.values())
+            else:
+                size += sum(len(str(value)) for value in entries.values())
+        return size
+
+    def stats(self) -> Dict:
+        return {
+            kind: {
+                'entries': len(self._entries[kind]),
+                'hits': self.hits[kind],
+                'shared': self.shared[kind],
+                'misses': self.misses[kind],
+            }
+            for kind in KINDS
+        }
+
+
+async def fetch_through(retrieval: RetrievalCache | None, kind: str, key: str, fetch: Callable[[], Awaitable[Any]]):
+    """`retrieval.get_or_fetch(...)`, or just `fetch()` when the request has no retrieval cache."""
+    if retrieval is None:
+        return await fetch()
+    return await retrieval.get_or_fetch(kind, key, fetch)
@@ -0,0 +1,348 @@
+"""
+Production serving entry point for `graph.execute_user_query`.
+
+Runs one or more aiohttp worker processes that share a listening socket. Each worker applies admission control
+before a request reaches the graph:
+
+- at most `max_in_flight` graph runs execute concurrently,
+- up to `max_queued` further requests wait (for at most `queue_timeout` seconds) for a free slot,
+- anything beyond that is rejected immediately with 503 and a Retry-After header,
+- each user may hold at most `per_user_limit` requests (queued or running), beyond that 429. Requests without a user
+  id are counted per client address (the first `X-Forwarded-For` hop, or the peer), not as one shared user.
+
+On SIGTERM/SIGINT a worker stops admitting new requests (503, /readyz turns unhealthy), lets in-flight requests
+finish for up to `drain_timeout` seconds and then exits.
+
+Streaming protocol: POST /chat with `{"message": ..., "history": [...], "user_id": ...}` (or an `X-User-Id` header)
+returns newline-delimited JSON, one `{"chunk": <str>}` line per chunk yielded by `execute_user_query`. The Gradio UI
+uses `stream_chat_from_server` to sit in front of it (set CHAT_SERVER_URL).
+
+GET /metrics serves the worker's event loop lag percentiles and stall count in the Prometheus text format; stalls and
+the stacks that caused them are listed in /healthz (see loop_monitor.py).
+
+Usage:
+    python3 -m server --workers 4 --port 8080
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+from loop_monitor import LoopLagMonitor, loop_monitor_enabled
+
+DEFAULT_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+DEFAULT_PORT = int(os.getenv("SERVER_PORT", "8080"))
+DEFAULT_WORKERS = int(os.getenv("SERVER_WORKERS", "2"))
+DEFAULT_MAX_IN_FLIGHT = int(os.getenv("SERVER_MAX_IN_FLIGHT", "8"))
+DEFAULT_MAX_QUEUED = int(os.getenv("SERVER_MAX_QUEUED", "16"))
+DEFAULT_QUEUE_TIMEOUT = float(os.getenv("SERVER_QUEUE_TIMEOUT", "30"))
+DEFAULT_PER_USER_LIMIT = int(os.getenv("SERVER_PER_USER_LIMIT", "2"))
+DEFAULT_DRAIN_TIMEOUT = float(os.getenv("SERVER_DRAIN_TIMEOUT", "120"))
+
+ANONYMOUS_USER = "anonymous"
+
+
+def admission_key(request: web.Request, user_id: str) -> str:
+    """Key of the per-user cap: the user id, or the client's address for anonymous requests."""
+    if user_id != ANONYMOUS_USER:
+        return user_id
+    forwarded = request.headers.get("X-Forwarded-For")
+    address = forwarded.split(",")[0].strip() if forwarded else request.remote
+    return f"{ANONYMOUS_USER}@{address or 'unknown'}"
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, status: int, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded admission queue with per-user caps and a draining switch."""
+
+    def __init__(self, max_in_flight: int, max_queued: int, queue_timeout: float, per_user_limit: int):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.per_user_limit = per_user_limit
+
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._per_user: Counter = Counter()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected: Counter = Counter()
+        self.draining = False
+
+    @property
+    def saturated(self) -> bool:
+        return self.in_flight >= self.max_in_flight and self.queued >= self.max_queued
+
+    def _reject(self, reason: str, status: int, retry_after: float):
+        self.rejected[reason] += 1
+        raise AdmissionRejected(reason, status, retry_after)
+
+    @asynccontextmanager
+    async def admit(self, user_id: str):
+        if self.draining:
+            self._reject("draining", 503, retry_after=5)
+        if self._per_user[user_id] >= self.per_user_limit:
+            self._reject("per_user_limit", 429, retry_after=2)
+        if self._slots.locked() and self.queued >= self.max_queued:
+            self._reject("queue_full", 503, retry_after=2)
+
+        self._per_user[user_id] += 1
+        self._idle.clear()
+        try:
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject("queue_timeout", 503, retry_after=5)
+            finally:
+                self.queued -= 1
+
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+                self._slots.release()
+        finally:
+            self._per_user[user_id] -= 1
+            if self._per_user[user_id] <= 0:
+                del self._per_user[user_id]
+            if not self._per_user:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """Stop admitting requests and wait for the admitted ones to finish. Returns False on timeout."""
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> Dict:
+        return {
+            'pid': os.getpid(),
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'max_in_flight': self.max_in_flight,
+            'max_queued': self.max_queued,
+            'draining': self.draining,
+            'rejected': dict(self.rejected),
+        }
+
+
+def create_app(controller: AdmissionController, loop_monitor=None) -> web.Application:
+    import rate_limiter
+    from cascade import cascade_stats
+    from hedging import hedge_stats
+    from conversation_store import conversation_store
+    from blob_store import blob_stores
+    from resilience import circuit_stats
+    from near_duplicates import near_duplicate_stats
+    from cql_planner import planner_stats
+    from graph import execute_user_query
+
+    async def chat(request: web.Request) -> web.StreamResponse:
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text="Body must be JSON.")
+        message = body.get("message")
+        if not message:
+            raise web.HTTPBadRequest(text="Field 'message' is required.")
+        user_id = request.headers.get("X-User-Id") or body.get("user_id") or ANONYMOUS_USER
+
+        try:
+            async with controller.admit(admission_key(request, user_id)):
+                response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+                await response.prepare(request)
+                chunks = execute_user_query(
+                    message,
+                    body.get("history"),
+                    user_id=None if user_id == ANONYMOUS_USER else user_id,
+                    conversation_id=body.get("conversation_id"),
+                )
+                try:
+                    async for chunk in chunks:
+                        await response.write(json.dumps({"chunk": chunk}).encode("utf-8") + b"\n")
+                except ConnectionResetError:
+                    print(f"Client for user {user_id} disconnected, stopping the graph run.")
+                    return response
+                except Exception as e:
+                    print(f"Graph run for user {user_id} failed: {e}")
+                    await response.write(json.dumps({"error": str(e)}).encode("utf-8") + b"\n")
+                finally:
+                    await chunks.aclose()
+                await response.write_eof()
+                return response
+        except AdmissionRejected as e:
+            return web.json_response(
+                {"error": e.reason, **controller.stats()},
+                status=e.status,
+                headers={"Retry-After": str(int(e.retry_after))},
+            )
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.json_response({
+            **controller.stats(),
+            'llm_rate_limits': rate_limiter.stats(),
+            'agent_3_cascade': cascade_stats.stats(),
+            'llm_hedging': hedge_stats.stats(),
+            'conversations': conversation_store.stats(),
+            'blob_stores': blob_stores.stats(),
+            'circuits': circuit_stats(),
+            'near_duplicates': near_duplicate_stats.stats(),
+            'cql_planner': planner_stats.stats(),
+            'event_loop': loop_monitor.stats() if loop_monitor else None,
+        })
+
+    async def metrics(request: web.Request) -> web.Response:
+        if loop_monitor is None:
+            raise web.HTTPNotFound(text="The event loop monitor is off (LOOP_MONITOR=false).")
+        return web.Response(text=loop_monitor.prometheus_metrics(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    async def readyz(request: web.Request) -> web.Response:
+        ready = not controller.draining and not controller.saturated
+        return web.json_response(controller.stats(), status=200 if ready else 503)
+
+    app = web.Application()
+    app.add_routes([
+        web.post("/chat", chat),
+        web.get("/healthz", healthz),
+        web.get("/readyz", readyz),
+        web.get("/metrics", metrics),
+    ])
+    return app
+
+
+async def serve_worker(sock: socket.socket, args: argparse.Namespace):
+    controller = AdmissionController(
+        max_in_flight=args.max_in_flight,
+        max_queued=args.max_queued,
+        queue_timeout=args.queue_timeout,
+        per_user_limit=args.per_user_limit,
+    )
+    # Measures how long synchronous work holds the worker's event loop, see loop_monitor.py.
+    loop_monitor = LoopLagMonitor.from_env() if loop_monitor_enabled() else None
+    if loop_monitor is not None:
+        loop_monitor.start()
+    runner = web.AppRunner(create_app(controller, loop_monitor), handle_signals=False)
+    await runner.setup()
+    await web.SockSite(runner, sock).start()
+    print(f"Worker {os.getpid()} serving on {sock.getsockname()}.")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    print(f"Worker {os.getpid()} draining {controller.in_flight} in-flight and {controller.queued} queued requests.")
+    drained = await controller.drain(args.drain_timeout)
+    if not drained:
+        print(f"Worker {os.getpid()} drain timed out after {args.drain_timeout}s, closing remaining streams.")
+    await runner.cleanup()
+    if loop_monitor is not None:
+        await loop_monitor.stop()
+
+
+def _run_worker(sock: socket.socket, args: argparse.Namespace):
+    asyncio.run(serve_worker(sock, args))
+
+
+def run(args: argparse.Namespace):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    # Import and compile the graph once in the parent, so forked workers start with it already loaded (and share
+    # the pages copy-on-write). No network clients exist yet at this point; each worker creates its own lazily.
+    import graph
+    graph.preload()
+
+    if args.workers <= 1:
+        _run_worker(sock, args)
+        return
+
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_run_worker, args=(sock, args), daemon=False) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    sock.close()
+
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for worker in workers:
+        worker.join()
+    print("All workers stopped.")
+
+
+async def stream_chat_from_server(
+    server_url: str,
+    message: str,
+    history: List | None = None,
+    user_id: str | None = None,
+) -> AsyncIterator[str]:
+    """Client side of the streaming protocol; yields the same chunks `execute_user_query` yields locally."""
+    async with ClientSession(timeout=ClientTimeout(total=None, sock_connect=10)) as session:
+        async with session.post(
+                f"{server_url.rstrip('/')}/chat",
+                data=json.dumps({"message": message, "history": history or [], "user_id": user_id}, default=str),
+                headers={"Content-Type": "application/json", "X-User-Id": user_id or ANONYMOUS_USER},
+        ) as response:
+            if response.status != 200:
+                error = await response.json(content_type=None)
+                retry_after = response.headers.get("Retry-After", "a few")
+                yield f"The assistant is busy ({error.get('error')}). Please retry in {retry_after} seconds."
+                return
+
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                payload = json.loads(line)
+                if "error" in payload:
+                    yield f"The assistant failed to answer: {payload['error']}"
+                    return
+                yield payload["chunk"]
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve execute_user_query with admission control.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT, help="Per worker.")
+    parser.add_argument("--max-queued", type=int, default=DEFAULT_MAX_QUEUED, help="Per worker.")
+    parser.add_argument("--queue-timeout", type=float, default=DEFAULT_QUEUE_TIMEOUT)
+    parser.add_argument("--per-user-limit", type=int, default=DEFAULT_PER_USER_LIMIT, help="Per worker.")
+    parser.add_argument("--drain-timeout", type=float, default=DEFAULT_DRAIN_TIMEOUT)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,520 @@
+"""
+Converter from Confluence storage format (the XHTML in `body.storage`) to Markdown, with section boundaries.
+
+Replaces `html2text` on the page-download path. Storage format is a known, narrow dialect, so a single `HTMLParser` pass
+with a small amount of state is enough:
+
+- headings, paragraphs, emphasis, inline code, links, nested lists, block quotes and `<pre>` blocks become Markdown;
+- tables are rendered as compact pipe tables, one line per row with whitespace and line breaks inside cells flattened;
+- `ac:` macros are flattened: `code`/`noformat` bodies become fenced code blocks, panels (`info`, `note`, `warning`,
+  `tip`, `panel`, `expand`) become labelled block quotes, `status` becomes its title, task lists become checkboxes,
+  page links become their link text or page title, and macros without a body (`toc`, `children`, `jira`, ...) are
+  dropped together with their parameters;
+- every top-level heading starts a `Section`, whose `start`/`end` are offsets into the returned Markdown.
+
+Large pages are converted in a process pool (`convert_storage_format_async`) so the conversion does not hold up the
+event loop of the MCP server or the ingestion crawler.
+
+Configuration (environment):
+    STORAGE_FORMAT_POOL_THRESHOLD   pages with more characters than this are converted in the process pool
+                                    (default 100000)
+    STORAGE_FORMAT_POOL_WORKERS     size of the process pool (default: number of CPUs)
+
+Benchmark against html2text:
+    python3 -m storage_format                       # ingested pages rendered back to storage format
+    python3 -m storage_format --page-id 123 456     # real pages fetched from Confluence
+    python3 -m storage_format --html-dir pages/     # saved storage-format .html files
+"""
+
+import argparse
+import asyncio
+import functools
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from typing import Dict, List, Sequence
+
+from profiling import span
+
+_WHITESPACE = re.compile(r"\s+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+_TRAILING_SPACES = re.compile(r"[ \t]+\n")
+
+_BLOCK_TAGS = {"p", "div", "section", "article", "header", "footer", "center", "dl", "dt", "dd", "hr"}
+_EMPHASIS = {"strong": "**", "b": "**", "em": "*", "i": "*", "s": "~~", "del": "~~", "strike": "~~"}
+_SKIPPED_TAGS = {"style", "script", "ac:placeholder", "ac:emoticon", "ac:task-id"}
+_PANEL_MACROS = {"info": "Info", "note": "Note", "warning": "Warning", "tip": "Tip", "panel": "", "expand": ""}
+_CODE_MACROS = {"code", "noformat"}
+
+
+@dataclass
+class Section:
+    level: int
+    title: str
+    start: int
+    end: int = 0
+
+
+@dataclass
+class ConvertedPage:
+    markdown: str
+    sections: List[Section] = field(default_factory=list)
+
+
+class _StorageFormatParser(HTMLParser):
+    """Single-pass converter; output goes to the innermost open buffer (root, table cell, heading or panel)."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.buffers: List[List[str]] = [[]]
+        self.root_length = 0
+        self.sections: List[Section] = []
+        self.skip_depth = 0
+        self.pre_depth = 0
+        self.lists: List[List] = []  # [tag, next number]
+        self.tables: List[Dict] = []  # {'rows': [...], 'row': [...] | None, 'header': bool}
+        self.links: List[str | None] = []
+        self.ac_links: List[Dict] = []
+        self.macros: List[Dict] = []  # {'name', 'params', 'param', 'buffered'}
+        self.heading_level = 0
+        self.task_status: str | None = None
+        self.param_buffer: List[str] | None = None
+
+    # Output helpers
+
+    def write(self, text: str):
+        if not text:
+            return
+        if self.param_buffer is not None:
+            self.param_buffer.append(text)
+            return
+        self.buffers[-1].append(text)
+        if len(self.buffers) == 1:
+            self.root_length += len(text)
+
+    def tail(self) -> str:
+        buffer = self.buffers[-1]
+        for part in reversed(buffer):
+            if part:
+                return part[-2:]
+        return "\n\n"
+
+    def block(self):
+        """Make the next output start a new paragraph."""
+        ending = self.tail()
+        if len(self.buffers) > 1 and self.tables and self.tables[-1]['row'] is not None:
+            if not ending.endswith(" "):
+                self.write(" ")  # Inside a table cell blocks are flattened.
+            return
+        if ending.endswith("\n\n"):
+            return
+        self.write("\n" if ending.endswith("\n") else "\n\n")
+
+    def line(self):
+        if not self.tail().endswith("\n"):
+            self.write("\n")
+
+    def push(self):
+        self.buffers.append([])
+
+    def pop(self) -> str:
+        return "".join(self.buffers.pop())
+
+    # Parser callbacks
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_depth:
+            if tag in _SKIPPED_TAGS or tag == "ac:parameter":
+                self.skip_depth += 1
+            return
+        if tag in _SKIPPED_TAGS:
+            self.skip_depth += 1
+            return
+
+        if tag[0] == "h" and len(tag) == 2 and tag[1] in "123456":
+            self.block()
+            self.heading_level = int(tag[1])
+            self.push()
+        elif tag in _BLOCK_TAGS:
+            self.block()
+            if tag == "hr":
+                self.write("---")
+                self.block()
+        elif tag in _EMPHASIS:
+            self.write(_EMPHASIS[tag])
+        elif tag == "br":
+            self.write(" " if self.tables and self.tables[-1]['row'] is not None else "\n")
+        elif tag in ("ul", "ol", "ac:task-list"):
+            if not self.lists:
+                self.block()
+            self.lists.append([tag, 1])
+        elif tag == "li":
+            self.open_list_item()
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            self.links.append(href)
+            if href:
+                self.write("[")
+        elif tag == "code":
+            if not self.pre_depth:
+                self.write("`")
+        elif tag == "pre":
+            self.block()
+            self.write("```\n")
+            self.pre_depth += 1
+        elif tag == "blockquote":
+            self.block()
+            self.push()
+        elif tag == "table":
+            self.block()
+            self.tables.append({'rows': [], 'row': None, 'header': False})
+        elif tag == "tr":
+            if self.tables:
+                self.tables[-1]['row'] = []
+        elif tag in ("td", "th"):
+            if self.tables:
+                if tag == "th" and not self.tables[-1]['rows']:
+                    self.tables[-1]['header'] = True
+                self.push()
+        elif tag == "time":
+            self.write(dict(attrs).get("datetime") or "")
+        elif tag == "ac:structured-macro" or tag == "ac:macro":
+            self.open_macro(dict(attrs).get("ac:name", ""))
+        elif tag == "ac:parameter":
+            if self.macros:
+                self.macros[-1]['param'] = dict(attrs).get("ac:name", "")
+                self.param_buffer = []
+            else:
+                self.skip_depth += 1
+        elif tag == "ac:link":
+            self.ac_links.append({'title': None, 'body': False})
+        elif tag in ("ac:link-body", "ac:plain-text-link-body"):
+            if self.ac_links:
+                self.ac_links[-1]['body'] = True
+        elif tag == "ri:page" or tag == "ri:blog-post":
+            if self.ac_links:
+                self.ac_links[-1]['title'] = dict(attrs).get("ri:content-title")
+        elif tag == "ri:attachment":
+            filename = dict(attrs).get("ri:filename")
+            if self.ac_links:
+                self.ac_links[-1]['title'] = filename
+            elif filename:
+                self.write(f"[image: {filename}]")
+        elif tag == "ri:url":
+            if self.ac_links:
+                self.ac_links[-1]['title'] = dict(attrs).get("ri:value")
+        elif tag == "ac:task":
+            self.task_status = None
+        elif tag == "ac:task-status":
+            self.param_buffer = []
+        elif tag == "ac:task-body":
+            self.open_list_item(checkbox="[x] " if self.task_status == "complete" else "[ ] ")
+
+    def handle_endtag(self, tag):
+        if self.skip_depth:
+            if tag in _SKIPPED_TAGS or tag == "ac:parameter":
+                self.skip_depth -= 1
+            return
+
+        if tag[0] == "h" and len(tag) == 2 and tag[1] in "123456" and self.heading_level:
+            self.close_heading()
+        elif tag in _BLOCK_TAGS:
+            self.block()
+        elif tag in _EMPHASIS:
+            self.write(_EMPHASIS[tag])
+        elif tag in ("ul", "ol", "ac:task-list"):
+            if self.lists:
+                self.lists.pop()
+            if not self.lists:
+                self.block()
+        elif tag == "a":
+            href = self.links.pop() if self.links else None
+            if href:
+                self.write(f"]({href})")
+        elif tag == "code":
+            if not self.pre_depth:
+                self.write("`")
+        elif tag == "pre":
+            if self.pre_depth:
+                self.pre_depth -= 1
+                self.line()
+                self.write("```")
+                self.block()
+        elif tag == "blockquote":
+            if len(self.buffers) > 1:
+                self.write_quote(self.pop())
+        elif tag in ("td", "th"):
+            if self.tables and len(self.buffers) > 1:
+                cell = _WHITESPACE.sub(" ", self.pop()).strip().replace("|", "\\|")
+                row = self.tables[-1]['row']
+                if row is not None:
+                    row.append(cell)
+        elif tag == "tr":
+            if self.tables and self.tables[-1]['row'] is not None:
+                self.tables[-1]['rows'].append(self.tables[-1]['row'])
+                self.tables[-1]['row'] = None
+        elif tag == "table":
+            if self.tables:
+                self.write_table(self.tables.pop())
+        elif tag == "ac:structured-macro" or tag == "ac:macro":
+            self.close_macro()
+        elif tag == "ac:parameter":
+            if self.macros and self.param_buffer is not None:
+                macro = self.macros[-1]
+                macro['params'][macro['param']] = "".join(self.param_buffer).strip()
+            self.param_buffer = None
+        elif tag == "ac:link":
+            link = self.ac_links.pop() if self.ac_links else None
+            if link and not link['body'] and link['title']:
+                self.write(link['title'])
+        elif tag == "ac:task-status":
+            if self.param_buffer is not None:
+                self.task_status = "".join(self.param_buffer).strip()
+            self.param_buffer = None
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self.pre_depth or self.param_buffer is not None:
+            self.write(data)
+            return
+        text = _WHITESPACE.sub(" ", data)
+        if text == " " and self.tail().endswith(("\n", " ")):
+            return
+        self.write(text)
+
+    def unknown_decl(self, data):
+        # `<![CDATA[...]]>`, used for code macro bodies and plain-text link bodies.
+        if self.skip_depth or not data.startswith("CDATA["):
+            return
+        text = data[len("CDATA["):]
+        macro = self.macros[-1] if self.macros else None
+        if macro is not None and macro['name'] in _CODE_MACROS and self.param_buffer is None:
+            self.block()
+            self.write(f"```{macro['params'].get('language', '')}\n{text.rstrip()}\n```")
+            self.block()
+        else:
+            self.write(text)
+
+    # Structures
+
+    def open_list_item(self, checkbox: str = ""):
+        if self.tables and self.tables[-1]['row'] is not None:
+            self.write(" - " + checkbox)
+            return
+        self.line()
+        depth = max(len(self.lists), 1)
+        kind = self.lists[-1] if self.lists else ["ul", 1]
+        if kind[0] == "ol":
+            marker = f"{kind[1]}. "
+            kind[1] += 1
+        else:
+            marker = "- "
+        self.write("  " * (depth - 1) + marker + checkbox)
+
+    def close_heading(self):
+        title = _WHITESPACE.sub(" ", self.pop()).strip()
+        level, self.heading_level = self.heading_level, 0
+        if not title:
+            return
+        if len(self.buffers) == 1:
+            self.sections.append(Section(level=level, title=title, start=self.root_length))
+        self.write("#" * level + " " + title)
+        self.block()
+
+    def open_macro(self, name: str):
+        macro = {'name': name, 'params': {}, 'param': None, 'buffered': name in _PANEL_MACROS}
+        self.macros.append(macro)
+        if macro['buffered']:
+            self.block()
+            self.push()
+
+    def close_macro(self):
+        if not self.macros:
+            return
+        macro = self.macros.pop()
+        if macro['buffered']:
+            body = self.pop() if len(self.buffers) > 1 else ""
+            label = _PANEL_MACROS[macro['name']] or macro['params'].get('title', "")
+            self.write_quote(body, label)
+        elif macro['name'] == "status" and macro['params'].get('title'):
+            self.write(f"[{macro['params']['title']}]")
+
+    def write_quote(self, body: str, label: str = ""):
+        body = _BLANK_LINES.sub("\n\n", body.strip())
+        if label:
+            body = f"**{label}:** {body}" if body else f"**{label}**"
+        if not body:
+            return
+        self.block()
+        self.write("\n".join("> " + line if line else ">" for line in body.split("\n")))
+        self.block()
+
+    def write_table(self, table: Dict):
+        rows = [row for row in table['rows'] if any(row)]
+        if not rows:
+            return
+        width = max(len(row) for row in rows)
+        lines = []
+        for index, row in enumerate(rows):
+            lines.append("| " + " | ".join(row + [""] * (width - len(row))) + " |")
+            if index == 0:
+                lines.append("|" + " --- |" * width)
+        if len(self.buffers) > 1 and self.tables:
+            self.write(" ".join(lines))  # A table nested in a cell is flattened into that cell.
+            return
+        self.block()
+        self.write("\n".join(lines))
+        self.block()
+
+    def result(self) -> ConvertedPage:
+        while len(self.buffers) > 1:
+            text = self.pop()
+            self.buffers[-1].append(text)
+        raw = "".join(self.buffers[0])
+        markdown = _BLANK_LINES.sub("\n\n", _TRAILING_SPACES.sub("\n", raw)).strip() + "\n"
+        sections = self.sections
+        if sections and markdown != raw:
+            # Offsets were taken on the raw output; map every title to its position in the cleaned text.
+            position = 0
+            for section in sections:
+                found = markdown.find("#" * section.level + " " + section.title, position)
+                section.start = found if found >= 0 else position
+                position = section.start
+        for index, section in enumerate(sections):
+            following = [later.start for later in sections[index + 1:] if later.level <= section.level]
+            section.end = following[0] if following else len(markdown)
+        return ConvertedPage(markdown=markdown, sections=sections)
+
+
+def convert_storage_format(storage: str) -> ConvertedPage:
+    """Markdown and sections of a page's storage-format body."""
+    parser = _StorageFormatParser()
+    parser.feed(storage or "")
+    parser.close()
+    return parser.result()
+
+
+def storage_to_markdown(storage: str) -> str:
+    return convert_storage_format(storage).markdown
+
+
+@functools.cache
+def get_process_pool() -> ProcessPoolExecutor:
+    workers = os.getenv("STORAGE_FORMAT_POOL_WORKERS")
+    return ProcessPoolExecutor(max_workers=int(workers) if workers else None)
+
+
+async def convert_storage_format_async(storage: str) -> ConvertedPage:
+    """`convert_storage_format` off the event loop: in the process pool for large pages, a thread otherwise."""
+    with span("convert storage format", 'cpu', characters=len(storage or "")):
+        if len(storage or "") > int(os.getenv("STORAGE_FORMAT_POOL_THRESHOLD", "100000")):
+            return await asyncio.get_running_loop().run_in_executor(get_process_pool(), convert_storage_format, storage)
+        return await asyncio.to_thread(convert_storage_format, storage)
+
+
+def markdown_to_storage(markdown: str) -> str:
+    """Rough storage-format rendering of an ingested page, for benchmarking when no real storage bodies are at hand."""
+    from html import escape
+
+    html = []
+    lines = markdown.splitlines()
+    index = 0
+    while index < len(lines):
+        line = lines[index].strip()
+        if not line:
+            index += 1
+            continue
+        heading = re.match(r"^(#{1,6})\s+(.*)", line)
+        if heading:
+            level = len(heading.group(1))
+            html.append(f"<h{level}>{escape(heading.group(2))}</h{level}>")
+        elif line.startswith("|"):
+            rows = []
+            while index < len(lines) and lines[index].strip().startswith("|"):
+                cells = [cell.strip() for cell in lines[index].strip().strip("|").split("|")]
+                if not all(set(cell) <= set("-: ") for cell in cells):
+                    rows.append("<tr>" + "".join(f"<td><p>{escape(cell)}</p></td>" for cell in cells) + "</tr>")
+                index += 1
+            html.append(f'<table data-layout="default"><colgroup><col /></colgroup><tbody>{"".join(rows)}</tbody></table>')
+            continue
+        elif line.startswith(("- ", "* ")):
+            items = []
+            while index < len(lines) and lines[index].strip().startswith(("- ", "* ")):
+                items.append(f"<li><p>{escape(lines[index].strip()[2:])}</p></li>")
+                index += 1
+            html.append(f"<ul>{''.join(items)}</ul>")
+            continue
+        elif line.startswith(">"):
+            html.append(
+                '<ac:structured-macro ac:name="info" ac:schema-version="1"><ac:rich-text-body>'
+                f"<p>{escape(line.lstrip('> '))}</p></ac:rich-text-body></ac:structured-macro>"
+            )
+        else:
+            html.append(f"<p>{escape(line).replace('**', '')}</p>")
+        index += 1
+    html.insert(0, '<ac:structured-macro ac:name="toc" ac:schema-version="1"><ac:parameter ac:name="maxLevel">3'
+                   '</ac:parameter></ac:structured-macro>')
+    return "".join(html)
+
+
+def load_benchmark_pages(args: argparse.Namespace) -> List[tuple[str, str]]:
+    if args.page_id:
+        from mcp_server import get_confluence
+        pages = []
+        for page_id in args.page_id:
+            response = get_confluence().get_page_by_id(page_id, expand="body.storage")
+            pages.append((f"{page_id}_{response['title']}", response["body"]["storage"]["value"]))
+        return pages
+    if args.html_dir:
+        return [
+            (name, open(os.path.join(args.html_dir, name), encoding="utf-8").read())
+            for name in sorted(os.listdir(args.html_dir)) if name.endswith(".html")
+        ]
+    from corpus import iter_ingested_pages
+    return [(f"{page['page_id']}_{page['title']}", markdown_to_storage(page['text'])) for page in iter_ingested_pages()]
+
+
+def benchmark(pages: Sequence[tuple[str, str]], repeat: int) -> Dict:
+    import html2text
+
+    def timed(convert) -> float:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for _, storage in pages:
+                convert(storage)
+        return (time.perf_counter() - started) / repeat
+
+    html2text_seconds = timed(html2text.html2text)
+    converter_seconds = timed(convert_storage_format)
+    characters = sum(len(storage) for _, storage in pages)
+    return {
+        'pages': len(pages),
+        'storage_characters': characters,
+        'html2text_ms': html2text_seconds * 1000,
+        'storage_format_ms': converter_seconds * 1000,
+        'speedup': html2text_seconds / converter_seconds if converter_seconds else None,
+        'sections': sum(len(convert_storage_format(storage).sections) for _, storage in pages),
+    }
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the storage-format converter against html2text.")
+    parser.add_argument("--page-id", nargs="*", help="Fetch these pages from Confluence.")
+    parser.add_argument("--html-dir", help="Folder of saved storage-format .html files.")
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None):
+    import json
+
+    args = parse_args(argv)
+    print(json.dumps(benchmark(load_benchmark_pages(args), args.repeat), indent=2))
+
+
+if __name__ == '__main__':
+    main()
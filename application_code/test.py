@@ -1,27 +1,30 @@
+import functools
 import os
 
-from atlassian import Confluence
-
 from graph_state import RAGState
 from agents import agent_3_confluence_filter_pages, agent_1_generate_cql, agent_2_search_vector_db
 import asyncio
 from dotenv import load_dotenv
 from agents_helper import search_confluence_with_cql_queries, get_tools, download_page_directly_from_mcp
-from graph import execute_user_query
-import threading
+import load_test
 
 load_dotenv()
 
-confluence = Confluence(
-    url=os.getenv("CONFLUENCE_URL"),
-    username=os.getenv("CONFLUENCE_ACCOUNT"),
-    password=os.getenv("CONFLUENCE_TOKEN"),
-    cloud=True)
+
+@functools.cache
+def get_confluence():
+    # atlassian-python-api is imported and the client created on first use, not at import.
+    from atlassian import Confluence
+    return Confluence(
+        url=os.getenv("CONFLUENCE_URL"),
+        username=os.getenv("CONFLUENCE_ACCOUNT"),
+        password=os.getenv("CONFLUENCE_TOKEN"),
+        cloud=True)
 
 
 def test_search_confluence():
     query = 'siteSearch ~ "Maple trust bank"'
-    result = confluence.cql(query)
+    result = get_confluence().cql(query)
     print(result)
 
 
@@ -87,34 +90,9 @@ async def test_download_page_directly_from_mcp():
     print(file)
 
 
-def run_async_gen(query, loop):
-    async def runner():
-        async for chunk in execute_user_query(query):
-            print(f"[{threading.current_thread().name}] Got chunk: {chunk}")
-
-    asyncio.run(runner())
-
-
 def test_execute_user_query():
-    loop = None
-
-    thread_1 = threading.Thread(target=run_async_gen, args=("What is Maple trust bank?", loop,))
-    thread_2 = threading.Thread(target=run_async_gen, args=("What is Maple trust bank?", loop,))
-    thread_3 = threading.Thread(target=run_async_gen, args=("What is Maple trust bank?", loop,))
-    thread_4 = threading.Thread(target=run_async_gen, args=("What is Maple trust bank?", loop,))
-    thread_5 = threading.Thread(target=run_async_gen, args=("What is Maple trust bank?", loop,))
-
-    thread_1.start()
-    thread_2.start()
-    thread_3.start()
-    thread_4.start()
-    thread_5.start()
-
-    thread_1.join()
-    thread_2.join()
-    thread_3.join()
-    thread_4.join()
-    thread_5.join()
+    """Five concurrent users on one event loop for 30 seconds; see load_test.py for QPS, ramp-up and replay."""
+    load_test.main(["--concurrency", "5", "--duration", "30"])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+import pytest
+
+from cql_index import CQLIndex, UnsupportedCQLError, parse_tokens
+
+PAGES = [
+    {'page_id': '1', 'title': 'DMS Core Service', 'text': "The document management service stores uploads."},
+    {'page_id': '2', 'title': 'DMS Audit', 'text': "Audit of the Orbit migration to the document service."},
+    {'page_id': '3', 'title': 'Release Notes', 'text': "Maple trust bank onboarding release."},
+    {'page_id': '4', 'title': 'Say "hello"', 'text': "Greeting conventions for the maple team."},
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return CQLIndex(PAGES)
+
+
+def page_ids(index, cql, **kwargs):
+    return [result['content']['id'] for result in index.search(cql, **kwargs)['results']]
+
+
+def test_site_search_matches_any_term_in_text_or_title(index):
+    assert set(page_ids(index, 'siteSearch ~ "audit maple"')) == {'2', '3', '4'}
+
+
+def test_text_and_title_match_all_terms(index):
+    assert set(page_ids(index, 'text ~ "document service"')) == {'1', '2'}
+    assert page_ids(index, 'title ~ "dms audit"') == ['2']
+    assert page_ids(index, 'title ~ "audit release"') == []
+
+
+def test_and_binds_tighter_than_or(index):
+    # title ~ "release" OR (text ~ "document" AND title ~ "audit")
+    assert set(page_ids(index, 'title ~ "release" OR text ~ "document" AND title ~ "audit"')) == {'2', '3'}
+
+
+def test_parentheses_override_precedence(index):
+    # (title ~ "release" OR text ~ "document") AND title ~ "audit"
+    assert page_ids(index, '(title ~ "release" OR text ~ "document") AND title ~ "audit"') == ['2']
+
+
+def test_not_excludes_matches(index):
+    assert set(page_ids(index, 'type = page AND NOT title ~ "dms"')) == {'3', '4'}
+    assert set(page_ids(index, 'siteSearch ~ "maple" AND NOT (title ~ "release")')) == {'4'}
+
+
+def test_keywords_are_case_insensitive(index):
+    assert page_ids(index, 'title ~ "dms" and not title ~ "audit"') == ['1']
+
+
+def test_quoting_and_escapes(index):
+    assert parse_tokens(r'title ~ "say \"hello\""') == [('word', 'title'), ('operator', '~'),
+                                                         ('string', r'"say \"hello\""')]
+    assert page_ids(index, r'title ~ "say \"hello\""') == ['4']
+    assert page_ids(index, "title ~ 'release notes'") == ['3']
+
+
+@pytest.mark.parametrize("cql", [
+    'siteSearch ~ "maple" ORDER BY lastmodified DESC',
+    'title ~ "dm*"',
+    'text ~ "rel?ase"',
+    'label = "finance"',
+    'space = "SD"',
+    'type = attachment',
+    '(title ~ "dms"',
+    'title ~ "dms")',
+    'title ~',
+    'siteSearch ~ "maple" AND',
+    'title ~ "dms" ; drop',
+])
+def test_unsupported_cql_falls_back(index, cql):
+    with pytest.raises(UnsupportedCQLError):
+        index.search(cql)
+    assert not index.supports(cql)
+
+
+def test_paging_with_start_and_limit(index):
+    everything = page_ids(index, 'type = page', limit=10)
+    assert sorted(everything) == ['1', '2', '3', '4']
+    first, second = index.search('type = page', start=0, limit=2), index.search('type = page', start=2, limit=2)
+    assert [result['content']['id'] for result in first['results'] + second['results']] == everything
+    assert first['totalSize'] == second['totalSize'] == 4
+    assert (first['start'], first['limit'], first['size']) == (0, 2, 2)
+    assert index.search('type = page', start=4, limit=2)['results'] == []
+
+
+def test_results_are_ranked_and_highlighted(index):
+    results = index.search('siteSearch ~ "document"')['results']
+    assert [result['score'] for result in results] == sorted((result['score'] for result in results), reverse=True)
+    assert all(result['score'] > 0 for result in results)
+    assert '@@@hl@@@document@@@endhl@@@' in results[0]['excerpt']
@@ -0,0 +1,151 @@
+import asyncio
+import json
+
+import pytest
+
+import ingestion
+from ingestion import ConfluenceCrawler, CrawlCheckpoint
+
+
+class StubCrawler(ConfluenceCrawler):
+    """Crawler whose Confluence requests are answered from `spaces` (space key -> [(page id, version)])."""
+
+    def __init__(self, checkpoint, spaces, failing=()):
+        super().__init__(checkpoint, concurrency=2, rate_per_second=1000)
+        self.spaces = spaces
+        self.failing = set(failing)
+        self.requests = []
+
+    async def _request(self, method, *args, timeout=None, **kwargs):
+        self.requests.append((method, args[0]))
+        if method == 'get_all_pages_from_space_raw':
+            return {'results': [
+                {'id': page_id, 'title': f"Page {page_id}", 'version': {'number': version}}
+                for page_id, version in self.spaces[args[0]]
+            ]}
+        if method == 'get_page_by_id':
+            if args[0] in self.failing:
+                raise ConnectionError(f"page {args[0]} failed")
+            return {'body': {'storage': {'value': f"<p>Body of {args[0]}</p>"}}, 'version': {'number': 1}}
+        raise AssertionError(f"unexpected request {method}")
+
+    def downloaded(self):
+        return sorted(page_id for method, page_id in self.requests if method == 'get_page_by_id')
+
+    def listed(self):
+        return sorted(space_key for method, space_key in self.requests if method == 'get_all_pages_from_space_raw')
+
+
+@pytest.fixture
+def written(monkeypatch):
+    pages = {}
+    monkeypatch.setenv("PAGE_STORE_ENABLED", "false")
+    monkeypatch.setattr(ingestion, "write_page", lambda page_id, title, content: pages.__setitem__(page_id, content))
+    return pages
+
+
+def crawl(path, spaces, failing=()):
+    checkpoint = CrawlCheckpoint(path)
+    crawler = StubCrawler(checkpoint, spaces, failing)
+    try:
+        asyncio.run(crawler.crawl(list(spaces)))
+    finally:
+        checkpoint.close()
+    return crawler
+
+
+def test_replay_skips_a_truncated_last_line(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    path.write_text('{"page": "1", "version": 3, "space": "A"}\n{"space": "A"}\n{"page": "2", "vers')
+    checkpoint = CrawlCheckpoint(path)
+    assert checkpoint.pages == {'1': 3}
+    assert checkpoint.spaces_done == {'A'}
+    checkpoint.page_done('2', 1, 'B')
+    checkpoint.close()
+    assert CrawlCheckpoint(path).pages == {'1': 3, '2': 1}
+
+
+def test_unchanged_versions_are_not_downloaded_again(tmp_path, written):
+    path = tmp_path / "checkpoint.jsonl"
+    spaces = {'A': [('1', 1), ('2', 1)], 'B': [('3', 1)]}
+    assert crawl(path, spaces).downloaded() == ['1', '2', '3']
+
+    again = crawl(path, spaces)
+    assert again.listed() == ['A', 'B']
+    assert again.downloaded() == []
+    assert again.stats['unchanged'] == 3
+
+    spaces['A'] = [('1', 2), ('2', 1)]
+    assert crawl(path, spaces).downloaded() == ['1']
+
+
+def test_completed_crawl_clears_finished_spaces_and_keeps_versions(tmp_path, written):
+    path = tmp_path / "checkpoint.jsonl"
+    crawl(path, {'A': [('1', 1)], 'B': [('2', 1)]})
+    checkpoint = CrawlCheckpoint(path)
+    assert checkpoint.spaces_done == set()
+    assert checkpoint.pages == {'1': 1, '2': 1}
+    checkpoint.close()
+    entries = [json.loads(line) for line in path.read_text().splitlines()]
+    assert all('page' in entry for entry in entries)
+
+
+def test_failed_page_keeps_its_space_unfinished(tmp_path, written):
+    path = tmp_path / "checkpoint.jsonl"
+    spaces = {'A': [('1', 1), ('2', 1)], 'B': [('3', 1)]}
+    failed = crawl(path, spaces, failing={'2'})
+    assert failed.stats['failed'] == 1
+    assert sorted(written) == ['1', '3']
+    checkpoint = CrawlCheckpoint(path)
+    assert checkpoint.spaces_done == {'B'}
+    assert '2' not in checkpoint.pages
+    checkpoint.close()
+
+    resumed = crawl(path, spaces)
+    assert resumed.listed() == ['A']
+    assert resumed.downloaded() == ['2']
+    assert CrawlCheckpoint(path).spaces_done == set()
+
+
+def test_restart_of_one_space_keeps_the_others(tmp_path, written, monkeypatch):
+    path = tmp_path / "checkpoint.jsonl"
+    spaces = {'A': [('1', 1)], 'B': [('2', 1), ('3', 1)]}
+    crawl(path, spaces, failing={'2'})
+    crawlers = []
+
+    def from_env(cls, checkpoint):
+        crawlers.append(StubCrawler(checkpoint, spaces))
+        return crawlers[-1]
+
+    monkeypatch.setattr(ingestion, "CHECKPOINT_PATH", path)
+    monkeypatch.setattr(ingestion.ConfluenceCrawler, "from_env", classmethod(from_env))
+    asyncio.run(ingestion.crawl(['A'], restart=True))
+    assert crawlers[0].downloaded() == ['1']
+    checkpoint = CrawlCheckpoint(path)
+    assert checkpoint.pages == {'1': 1, '3': 1}
+    checkpoint.close()
+
+
+def test_every_request_waits_on_the_limiter_once(tmp_path, written, monkeypatch):
+    class Confluence:
+        def get_all_pages_from_space_raw(self, space_key, **kwargs):
+            return {'results': [{'id': page_id, 'title': page_id, 'version': {'number': 1}} for page_id in "123"]}
+
+        def get_page_by_id(self, page_id, **kwargs):
+            return {'body': {'storage': {'value': "<p>Body</p>"}}, 'version': {'number': 1}}
+
+    monkeypatch.setattr(ingestion, "get_confluence", Confluence)
+    checkpoint = CrawlCheckpoint(tmp_path / "checkpoint.jsonl")
+    crawler = ConfluenceCrawler(checkpoint, rate_per_second=1000)
+    waits = []
+    wait = crawler.limiter.wait
+
+    async def counted_wait():
+        waits.append(1)
+        await wait()
+
+    monkeypatch.setattr(crawler.limiter, "wait", counted_wait)
+    asyncio.run(crawler.crawl(['A']))
+    checkpoint.close()
+    assert crawler.stats['written'] == 3
+    assert len(waits) == 4  # One listing and three bodies.
@@ -1,9 +1,31 @@
 import functools
 from typing import Callable, Any, Coroutine, Dict
-from langfuse import get_client
 from llm import GEMINI_FLASH
 
-langfuse_client = get_client()
+
+@functools.cache
+def get_langfuse_client():
+    # langfuse is slow to import and its client starts background threads, so both wait for the first traced call.
+    from langfuse import get_client
+    return get_client()
+
+
+def observe(name: str):
+    """Lazy `langfuse.observe` for async functions: langfuse is only imported when the function first runs."""
+    def decorator(func: Callable[..., Coroutine[Any, Any, Any]]):
+        observed = None
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            nonlocal observed
+            if observed is None:
+                from langfuse import observe as langfuse_observe
+                observed = langfuse_observe(name=name)(func)
+            return await observed(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 def track_llm_generation(name: str, model_name: str = GEMINI_FLASH):
@@ -11,6 +33,7 @@ def track_llm_generation(name: str, model_name: str = GEMINI_FLASH):
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
             print(f"Starting Tracing for: {name}")
+            langfuse_client = get_langfuse_client()
             state = args[0] if args else kwargs.get("state")
 
             try:
@@ -28,7 +51,8 @@ def track_llm_generation(name: str, model_name: str = GEMINI_FLASH):
                     with langfuse_client.start_as_current_generation(name=f"llm_gen_{name}",
                                                                      model=model_name) as generation:
                         result = await func(*args, **kwargs)
-                        print(f"Tracing Output of the {name} is {result}.")
+                        # Formatting the whole result (page contents included) would hold the event loop.
+                        print(f"Tracing Output of the {name} has keys {list(result)}.")
 
                         token_usage_key = f"{name}_token_usage"  # "{function_name}_token_usage"
 